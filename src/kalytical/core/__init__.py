@@ -1,6 +1,10 @@
-from .data_provider import MongoDBProvider, provider_factory
+from .data_provider import MongoDBProvider, ExecutionExistsError, NotFoundError, QueryException, provider_factory
 from .engine import EngineManager
 from .dispatcher import KDispatcher
 from .ext_sched import K8sCronProvider
+from .cron_scheduler import InProcessCronScheduler
 from .job_culler import IncubatingJobCuller
-from .mq_poller import MQ_Poller
\ No newline at end of file
+from .execution_reconciler import ExecutionReconciler
+from .mq_poller import MQ_Poller
+from .mq_transport import LifecycleEventTransport, transport_factory
+from .app_context import AppContext
@@ -0,0 +1,40 @@
+import abc
+from src.kalytical.models import PipelineHeaderModel, RunningPipelineModel, JobQueryModel, JobPageModel, LifecycleEventModel
+from typing import Awaitable, Callable, List
+
+
+class AbstractEngine(abc.ABC):
+    """A processing engine the EngineManager can hand runs to - Kubernetes pods, indexed jobs or local processes.
+    Engines submit, describe (query_jobs), list (get_jobs) and cancel (abort_pipeline) runs"""
+    # Runs on the cluster go through the SubmissionScheduler's quota admission and rate limiting
+    runs_on_cluster = True
+
+    def set_event_sink(self, event_sink: Callable[[LifecycleEventModel], Awaitable]) -> None:
+        """Where the engine sends lifecycle events for outcomes it observes itself"""
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        pass
+
+    @abc.abstractmethod
+    async def query_jobs(self, query: JobQueryModel) -> JobPageModel:
+        pass
+
+    @abc.abstractmethod
+    async def get_jobs(self, limit: int = None, pipeline_uuid: str = None, exec_uuid: str = None, engine_status: List[str] = None) -> List[RunningPipelineModel]:
+        pass
+
+    @abc.abstractmethod
+    async def abort_pipeline(self, engine_tracking_id: str) -> dict:
+        pass
+
+    @abc.abstractmethod
+    async def get_job_logs(self, engine_tracking_id: str, max_kb: int, from_beginning: bool = False) -> str:
+        pass
@@ -0,0 +1,97 @@
+import aioboto3
+import asyncio
+from botocore.config import Config
+from contextlib import AsyncExitStack
+from typing import Any
+from src.kalytical.core.cron_scheduler import InProcessCronScheduler
+from src.kalytical.core.data_provider import provider_factory
+from src.kalytical.core.dispatcher import KDispatcher
+from src.kalytical.core.engine import EngineManager
+from src.kalytical.core.execution_reconciler import ExecutionReconciler
+from src.kalytical.core.ext_sched import K8sCronProvider
+from src.kalytical.core.job_culler import IncubatingJobCuller
+from src.kalytical.core.k8s_client import AsyncK8sClient
+from src.kalytical.core.mq_poller import MQ_Poller
+from src.kalytical.core.mq_transport import transport_factory
+from src.kalytical.utils import KalyticalConfig, get_logger
+
+kalytical_config = KalyticalConfig()
+
+
+class AppContext():
+    """Owns the process-wide clients and services. They are built once on startup, shared by every request and closed on shutdown"""
+
+    def __init__(self):
+        self.log = get_logger(self.__class__.__name__)
+        self.k8s_client = None
+        self.data_provider = None
+        self.engine_mgr = None
+        self.dispatcher = None
+        self.mq_transport = None
+        self.mq_poller = None
+        self.job_culler = None
+        self.reconciler = None
+        self.cron_scheduler = None
+        self._sqs_client = None
+        self._exit_stack = AsyncExitStack()
+        self._tasks = []
+
+    async def startup(self) -> None:
+        self.log.info("Starting application context")
+        self.k8s_client = AsyncK8sClient()
+        cron_provider = K8sCronProvider(k8s_namespace=kalytical_config.k8s_namespace,
+                                        cron_image=kalytical_config.cron_image_uri, k8s_client=self.k8s_client)
+        self.data_provider = provider_factory(
+            db_engine=kalytical_config.db_provider, cron_provider=cron_provider)
+        await self.data_provider.start()
+        self.engine_mgr = EngineManager(k8s_client=self.k8s_client, data_provider=self.data_provider)
+        self.engine_mgr.start()
+        self.dispatcher = KDispatcher(
+            data_provider=self.data_provider, engine_mgr=self.engine_mgr)
+
+        if kalytical_config.mq_transport == 'SqsTransport':
+            self._sqs_client = await self._exit_stack.enter_async_context(aioboto3.Session().client(
+                'sqs', endpoint_url=kalytical_config.sqs_endpoint_url, config=Config(max_pool_connections=kalytical_config.sqs_max_pool_connections)))
+        self.mq_transport = transport_factory(
+            transport_name=kalytical_config.mq_transport, sqs_client=self._sqs_client)
+        await self.mq_transport.start()
+        # Engines that report completion themselves, such as K8sIndexedJobEngine, go through the same queue as the pods do
+        self.engine_mgr.set_event_sink(self.mq_transport.publish)
+        self.mq_poller = MQ_Poller(transport=self.mq_transport, dispatcher=self.dispatcher)
+        self.job_culler = IncubatingJobCuller(
+            data_provider=self.data_provider, dispatcher=self.dispatcher)
+        self.reconciler = ExecutionReconciler(
+            data_provider=self.data_provider, engine_mgr=self.engine_mgr)
+
+        self._tasks = [asyncio.create_task(self.mq_poller.fetch_message_loop()),
+                       asyncio.create_task(self.job_culler.cull_jobs_loop()),
+                       asyncio.create_task(self.reconciler.reconcile_loop())]
+        if kalytical_config.cron_scheduler == 'InProcessCronScheduler':
+            self.cron_scheduler = InProcessCronScheduler(data_provider=self.data_provider, dispatcher=self.dispatcher)
+            self._tasks.append(asyncio.create_task(self.cron_scheduler.schedule_loop()))
+
+    async def shutdown(self) -> None:
+        self.log.warn("Stopping application context")
+        self.mq_poller.shutdown()
+        self.job_culler.shutdown()
+        self.reconciler.shutdown()
+        if self.cron_scheduler is not None:
+            self.cron_scheduler.shutdown()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        self.engine_mgr.shutdown()
+        await self.mq_transport.close()
+        await self._exit_stack.aclose()
+        await self.data_provider.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self.data_provider.close)
+        await asyncio.get_running_loop().run_in_executor(None, self.k8s_client.close)
+        self.log.warn("Application context stopped")
+
+    def pool_stats(self) -> dict:
+        return {
+            'mongo': self.data_provider.pool_stats(),
+            'kubernetes': self.k8s_client.pool_stats(),
+            'sqs': {'open': self._sqs_client is not None, 'max_pool_connections': kalytical_config.sqs_max_pool_connections}
+        }
@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import os
+import socket
+from datetime import datetime, timedelta
+from uuid import uuid4
+from src.kalytical.core.data_provider import MongoDBProvider
+from src.kalytical.core.dispatcher import KDispatcher, gen_uuid
+from src.kalytical.models import LifecycleEventModel, JobLifecycleEventBody, PipelineHeaderModel
+from src.kalytical.utils import KalyticalConfig, CronSchedule, get_logger
+from typing import Dict, List
+
+kalytical_config = KalyticalConfig()
+
+MISFIRE_POLICIES = ['fire_once', 'fire_all', 'skip']
+
+
+class _ScheduleEntry():
+    def __init__(self, header_model: PipelineHeaderModel, cron: CronSchedule, next_fire: datetime):
+        self.header_model = header_model
+        self.cron = cron
+        self.next_fire = next_fire
+
+
+class InProcessCronScheduler():
+    """Fires scheduled pipelines from a heap of next fire times instead of a CronJob per pipeline.
+    Only the replica holding the cron_scheduler lease fires, and every fire is recorded in Mongo first, so a tick is
+    dispatched once even across a change of leader. Times are UTC, as they are for the Kubernetes CronJob controller"""
+    _lease_name = 'cron_scheduler'
+
+    def __init__(self, data_provider: MongoDBProvider, dispatcher: KDispatcher):
+        self.log = get_logger(self.__class__.__name__)
+        self._data_provider = data_provider
+        self._dispatcher = dispatcher
+        self._holder = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}"
+        self._leading = False
+        self._schedules: Dict[str, _ScheduleEntry] = {}
+        self._heap = []
+        self._next_reload = None
+        self._dispatches = set()
+        self._running = True
+
+    async def schedule_loop(self):
+        while self._running:
+            try:
+                sleep_seconds = await self.tick()
+            except Exception:
+                self.log.exception("Error while trying to fire schedules!")
+                sleep_seconds = kalytical_config.cron_lease_seconds / 3
+            await asyncio.sleep(sleep_seconds)
+        if self._leading:
+            await self._data_provider.release_lease(name=self._lease_name, holder=self._holder)
+        self.log.warn("Exiting")
+
+    async def tick(self) -> float:
+        """Fire whatever is due and return how long to sleep before the next tick"""
+        renew_interval = kalytical_config.cron_lease_seconds / 3
+        if not await self._data_provider.acquire_lease(name=self._lease_name, holder=self._holder, ttl_seconds=kalytical_config.cron_lease_seconds):
+            if self._leading:
+                self.log.warning(f"Lost the cron lease, holder={self._holder} stops firing schedules")
+            self._leading = False
+            return renew_interval
+        renew_by = datetime.utcnow() + timedelta(seconds=renew_interval)
+        if not self._leading:
+            self.log.info(f"Took the cron lease, holder={self._holder} now fires schedules")
+            self._leading = True
+            # Whatever happened while another replica led is only known from the fire times it recorded
+            self._schedules, self._heap = {}, []
+            self._next_reload = None
+        if self._next_reload is None or datetime.utcnow() >= self._next_reload:
+            await self._reload()
+        while len(self._heap) > 0 and self._heap[0][0] <= datetime.utcnow() and datetime.utcnow() < renew_by:
+            fire_time, pipeline_uuid = heapq.heappop(self._heap)
+            entry = self._schedules.get(pipeline_uuid)
+            if entry is None or entry.next_fire != fire_time:
+                # Removed or rescheduled since this was pushed
+                continue
+            await self._fire(entry.header_model, fire_time)
+            self._push(entry, entry.cron.next_fire(fire_time))
+        wake = min([renew_by, self._next_reload] + ([self._heap[0][0]] if len(self._heap) > 0 else []))
+        return max(0, (wake - datetime.utcnow()).total_seconds())
+
+    async def _reload(self) -> None:
+        now = datetime.utcnow()
+        self._next_reload = now + timedelta(seconds=kalytical_config.cron_reload_seconds)
+        try:
+            for pipeline_uuid in await self._data_provider.migrate_cronjobs():
+                self.log.info(f"Moved pipeline_uuid={pipeline_uuid} from its CronJob to the in-process scheduler")
+        except Exception:
+            # The pipelines stay on their CronJobs until the next reload tries again
+            self.log.exception("Could not move pipelines off their CronJobs")
+        fire_times = await self._data_provider.get_cron_fire_times()
+        seen = set()
+        for header_model in await self._data_provider.list_scheduled_pipelines():
+            pipeline_uuid = header_model.pipeline_uuid
+            if header_model.scheduler_tracking_id:
+                # Still has a CronJob from before the switch - firing it here as well would run it twice until it is migrated
+                continue
+            seen.add(pipeline_uuid)
+            entry = self._schedules.get(pipeline_uuid)
+            if entry is not None and entry.cron.expression == header_model.schedule:
+                entry.header_model = header_model
+                continue
+            try:
+                cron = CronSchedule(header_model.schedule)
+                next_fire = cron.next_fire(now)
+            except ValueError:
+                # Written before schedules were checked on write - one bad schedule must not stop the others from loading
+                self.log.exception(f"Skipping pipeline_uuid={pipeline_uuid} with an invalid schedule={header_model.schedule}")
+                self._schedules.pop(pipeline_uuid, None)
+                continue
+            entry = _ScheduleEntry(header_model=header_model, cron=cron, next_fire=None)
+            for fire_time in self._missed_fire_times(entry, last_fire=fire_times.get(pipeline_uuid), now=now):
+                await self._fire(header_model, fire_time)
+            self._schedules[pipeline_uuid] = entry
+            self._push(entry, next_fire)
+        for pipeline_uuid in set(self._schedules) - seen:
+            del self._schedules[pipeline_uuid]
+
+    def _missed_fire_times(self, entry: _ScheduleEntry, last_fire: datetime, now: datetime) -> List[datetime]:
+        if last_fire is None:
+            # A new schedule starts from now, like a new CronJob does
+            return []
+        policy = (entry.header_model.tags or {}).get('misfire_policy', kalytical_config.cron_misfire_policy)
+        if policy not in MISFIRE_POLICIES:
+            self.log.warning(
+                f"pipeline_uuid={entry.header_model.pipeline_uuid} has unknown misfire_policy={policy}, using {kalytical_config.cron_misfire_policy}")
+            policy = kalytical_config.cron_misfire_policy
+        on_time = entry.cron.fire_times(after=max(last_fire, now - timedelta(seconds=kalytical_config.cron_misfire_grace_seconds)), until=now)
+        if policy == 'skip' or entry.cron.next_fire(last_fire) > now:
+            return on_time
+        if policy == 'fire_once':
+            # One run stands in for everything missed
+            return [now.replace(second=0, microsecond=0)]
+        missed = []
+        fire_time = entry.cron.next_fire(last_fire)
+        while fire_time <= now and len(missed) < kalytical_config.cron_max_catchup_runs:
+            missed.append(fire_time)
+            fire_time = entry.cron.next_fire(fire_time)
+        if fire_time <= now:
+            self.log.warning(
+                f"pipeline_uuid={entry.header_model.pipeline_uuid} missed more than {kalytical_config.cron_max_catchup_runs} runs, catching up on the oldest only")
+        return missed
+
+    def _push(self, entry: _ScheduleEntry, next_fire: datetime) -> None:
+        entry.next_fire = next_fire
+        heapq.heappush(self._heap, (next_fire, entry.header_model.pipeline_uuid))
+
+    async def _fire(self, header_model: PipelineHeaderModel, fire_time: datetime) -> None:
+        if not await self._data_provider.claim_cron_fire(pipeline_uuid=header_model.pipeline_uuid, fire_time=fire_time):
+            self.log.debug(f"pipeline_uuid={header_model.pipeline_uuid} already fired for fire_time={fire_time}")
+            return
+        lifecycle_event = LifecycleEventModel(event_type='job_exec_update', event_body=JobLifecycleEventBody(
+            pipeline_uuid=header_model.pipeline_uuid, event_subtype='origination', event_time=datetime.now(), exec_uuid=gen_uuid()))
+        self.log.info(f"Firing pipeline_uuid={header_model.pipeline_uuid} for fire_time={fire_time}")
+        # Dispatch can wait on concurrency slots and the submission queue - the timer should not
+        task = asyncio.create_task(self._dispatch(lifecycle_event))
+        self._dispatches.add(task)
+        task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, lifecycle_event: LifecycleEventModel) -> None:
+        try:
+            await self._dispatcher.dispatch(lifecycle_event=lifecycle_event)
+        except Exception:
+            self.log.exception(f"Could not dispatch scheduled run of pipeline_uuid={lifecycle_event.event_body.pipeline_uuid}")
+
+    def shutdown(self):
+        self.log.info("Shutting down cron scheduler!")
+        self._running = False
@@ -0,0 +1,54 @@
+import threading
+from collections import defaultdict
+from src.kalytical.models import PipelineHeaderModel
+from typing import Dict, Iterable, List
+
+
+class DownstreamIndex():
+    """In-memory reverse edges of the pipeline DAG: trigger pipeline_uuid -> headers of the pipelines it triggers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._downstream: Dict[str, Dict[str, PipelineHeaderModel]] = defaultdict(dict)
+        # Forward edges, so an update or delete can drop the reverse edges it no longer has
+        self._triggers: Dict[str, List[str]] = {}
+        self.loaded = False
+
+    def load(self, header_models: Iterable[PipelineHeaderModel]) -> None:
+        downstream = defaultdict(dict)
+        triggers = {}
+        for header_model in header_models:
+            triggers[header_model.pipeline_uuid] = self._trigger_uuids(header_model)
+            for trigger_uuid in triggers[header_model.pipeline_uuid]:
+                downstream[trigger_uuid][header_model.pipeline_uuid] = header_model
+        with self._lock:
+            self._downstream = downstream
+            self._triggers = triggers
+            self.loaded = True
+
+    def upsert(self, header_model: PipelineHeaderModel) -> None:
+        with self._lock:
+            self._drop(header_model.pipeline_uuid)
+            self._triggers[header_model.pipeline_uuid] = self._trigger_uuids(header_model)
+            for trigger_uuid in self._triggers[header_model.pipeline_uuid]:
+                self._downstream[trigger_uuid][header_model.pipeline_uuid] = header_model
+
+    def remove(self, pipeline_uuid: str) -> None:
+        with self._lock:
+            self._drop(pipeline_uuid)
+
+    def downstream(self, pipeline_uuid: str) -> List[PipelineHeaderModel]:
+        with self._lock:
+            return list(self._downstream.get(pipeline_uuid, {}).values())
+
+    def _drop(self, pipeline_uuid: str) -> None:
+        for trigger_uuid in self._triggers.pop(pipeline_uuid, []):
+            edges = self._downstream.get(trigger_uuid)
+            if edges is not None:
+                edges.pop(pipeline_uuid, None)
+                if not edges:
+                    del self._downstream[trigger_uuid]
+
+    @staticmethod
+    def _trigger_uuids(header_model: PipelineHeaderModel) -> List[str]:
+        return [] if header_model.triggers_on is None else list(header_model.triggers_on.pipeline_uuids)
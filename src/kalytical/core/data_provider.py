@@ -1,93 +1,443 @@
 import pymongo
+from pymongo import monitoring, DeleteMany, UpdateOne
 from datetime import datetime, timedelta
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List
 import re
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pymongo.collection import ReturnDocument
-from .. models import PipelineModel, PipelineHeaderModel, IncubatingPipelineModel
-from . core import K8sCronProvider
-from . utils import get_logger, KalyticalConfig, retry
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+from .. models import PipelineModel, PipelineHeaderModel, PipelineApplyResultModel, IncubatingPipelineModel, EventHistoryPageModel, RunningPipelineModel
+from .ext_sched import K8sCronProvider
+from .dag_index import DownstreamIndex
+from .pipeline_cache import PipelineCache
+from .history_buffer import EventHistoryBuffer
+from ..utils import get_logger, KalyticalConfig, CronSchedule
 from bson.objectid import ObjectId
-import copy
 
 kalytical_config = KalyticalConfig()
 
+# An execution only ever moves forward through these - a late or repeated event for an earlier state is ignored
+EXECUTION_STATE_RANK = {'pending': 1, 'running': 2,
+                        'succeeded': 3, 'failed': 3, 'aborted': 3, 'lost': 3}
+ACTIVE_EXECUTION_STATES = ['pending', 'running']
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Tracks pymongo connection pool activity so it can be reported by the facade"""
 
-class MongoDBProvider():
     def __init__(self):
-        self.log = get_logger(self.__class__.__name__)
+        self.stats = {'connections_open': 0, 'connections_in_use': 0,
+                      'checkouts': 0, 'checkout_failures': 0, 'pool_clears': 0}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.stats['pool_clears'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.stats['connections_open'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.stats['connections_open'] -= 1
 
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.stats['checkout_failures'] += 1
+
+    def connection_checked_out(self, event):
+        self.stats['checkouts'] += 1
+        self.stats['connections_in_use'] += 1
+
+    def connection_checked_in(self, event):
+        self.stats['connections_in_use'] -= 1
+
+
+class MongoDBProvider():
+    def __init__(self, cron_provider: K8sCronProvider = None):
+        self.log = get_logger(self.__class__.__name__)
+        if cron_provider is None:
+            cron_provider = K8sCronProvider(k8s_namespace=kalytical_config.k8s_namespace,
+                                            cron_image=kalytical_config.cron_image_uri)
+        self._cron_provider = cron_provider
+        self._pool_listener = PoolStatsListener()
+
+        # pymongo is synchronous - every round trip is offloaded to this bounded pool so the event loop never waits on Mongo
+        self._executor = ThreadPoolExecutor(
+            max_workers=kalytical_config.mongo_executor_max_workers, thread_name_prefix=self.__class__.__name__)
         self._mongodb_client = pymongo.MongoClient(
-            f"mongodb://{kalytical_config.mongo_db_addr}")
-        self._pipeline_db = self._mongodb_client.pipeline_dbself._pipeline_def_coll = self._pipeline_db.pipeline_defs
-        self._run_icubation_coll = self._pipeline_db['run_incubation']
+            f"mongodb://{kalytical_config.mongo_db_addr}", maxPoolSize=kalytical_config.mongo_executor_max_workers, event_listeners=[self._pool_listener])
+        self._pipeline_db = self._mongodb_client.pipeline_db
+        self._pipeline_def_coll = self._pipeline_db.pipeline_defs
+        self._run_incubation_coll = self._pipeline_db['run_incubation']
         self._event_history_coll = self._pipeline_db['event_history']
-        self._lock_coll = self._pipeline_db['lock_coll']
+        self._executions_coll = self._pipeline_db['executions']
+        self._concurrency_slots_coll = self._pipeline_db['concurrency_slots']
+        self._warm_pods_coll = self._pipeline_db['warm_pods']
+        self._warm_pools_coll = self._pipeline_db['warm_pools']
+        self._leases_coll = self._pipeline_db['leases']
+        self._cron_state_coll = self._pipeline_db['cron_state']
 
         self._pipeline_def_coll.create_index(
             [('pipeline_uuid', pymongo.ASCENDING)], unique=True)
-        self._lock_coll.create_index(
-            [('coll_name', pymongo.ASCENDING)], unique=True)
-        self._has_incubation_lock = False
-
-        if self._lock_coll.find_one({'coll_name': 'incubation_coll', 'locked_timestamp': {'$exists': True}, 'locked': {'$exists': True}}) is None:
-            self._lock_coll.insert_one(
-                {'coll_name': 'incubation_coll', 'locked': False, 'locked_timestamp': 'NA'})
+        # Multikey index backing the downstream lookup whenever the in-memory DAG index is not live
+        self._pipeline_def_coll.create_index(
+            [('triggers_on.pipeline_uuids', pymongo.ASCENDING)])
+        # Serves the oldest deferred run lookup in pop_deferred_run
+        self._run_incubation_coll.create_index(
+            [('pipeline_uuid', pymongo.ASCENDING), ('reason', pymongo.ASCENDING), ('create_time', pymongo.ASCENDING)])
+        # At most one open dependency run per pipeline - concurrent upserts in update_incubating_jobs collide here instead of both inserting
+        self._run_incubation_coll.create_index(
+            [('pipeline_uuid', pymongo.ASCENDING)], name='open_dependency_run', unique=True, partialFilterExpression={'open': True})
+        # Lets the culler age runs out without scanning the collection
+        self._run_incubation_coll.create_index(
+            [('create_time', pymongo.ASCENDING)])
+        self._ensure_history_indexes()
+        self._executions_coll.create_index(
+            [('exec_uuid', pymongo.ASCENDING)], unique=True)
+        # Serves the concurrency check and the running pipeline listing
+        self._executions_coll.create_index(
+            [('pipeline_uuid', pymongo.ASCENDING), ('state', pymongo.ASCENDING)])
+        # Serves the reconciler's scan for active executions that have gone quiet
+        self._executions_coll.create_index(
+            [('state', pymongo.ASCENDING), ('update_time', pymongo.ASCENDING)])
+        # Serves counting the executions that hold a slot when repairing its counter
+        self._executions_coll.create_index(
+            [('slots', pymongo.ASCENDING)])
+        # Only finished executions carry finish_time, so only they expire
+        self._executions_coll.create_index(
+            [('finish_time', pymongo.ASCENDING)], expireAfterSeconds=kalytical_config.execution_retention_seconds)
+        # Serves claiming an idle warm pod, newest poll first
+        self._warm_pods_coll.create_index(
+            [('pool_id', pymongo.ASCENDING), ('state', pymongo.ASCENDING), ('last_poll_time', pymongo.DESCENDING)])
+        # Started warm pods are kept a while for the submit-to-start latency figures
+        self._warm_pods_coll.create_index(
+            [('picked_up_time', pymongo.ASCENDING)], expireAfterSeconds=kalytical_config.warm_pool_claim_retention_seconds)
+
+        self._downstream_index = DownstreamIndex()
+        self._pipeline_cache = PipelineCache(
+            maxsize=kalytical_config.pipeline_cache_maxsize, ttl=kalytical_config.pipeline_cache_ttl_seconds)
+        self._pipeline_uuid_by_id = {}
+        self._dag_index_live = False
+        self._watching = False
+        self._watch_thread = None
+        self._history_buffer = EventHistoryBuffer(flush=self._insert_history, max_batch_size=kalytical_config.event_history_flush_max_events,
+                                                  flush_interval_seconds=kalytical_config.event_history_flush_interval_seconds,
+                                                  wait_for_flush=kalytical_config.event_history_durability == 'wait_for_flush')
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking pymongo call on the provider executor and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def pool_stats(self) -> dict:
+        return {**self._pool_listener.stats,
+                'max_pool_size': kalytical_config.mongo_executor_max_workers,
+                'executor_queue_depth': self._executor._work_queue.qsize()}
+
+    async def start(self) -> None:
+        """Begin following pipeline definition changes so the in-memory DAG index stays coherent across replicas"""
+        self._history_buffer.start()
+        self._watching = True
+        self._watch_thread = threading.Thread(
+            target=self._watch_pipeline_defs, name=f"{self.__class__.__name__}-watch", daemon=True)
+        self._watch_thread.start()
+
+    def cache_stats(self) -> dict:
+        return self._pipeline_cache.stats()
+
+    async def stop(self) -> None:
+        """Flush buffered writes - must run on the event loop before close()"""
+        await self._history_buffer.close()
+
+    def close(self) -> None:
+        self._watching = False
+        if self._watch_thread is not None:
+            self._watch_thread.join()
+        self._executor.shutdown(wait=True)
+        self._mongodb_client.close()
+
+    def _follow_changes(self, coll: Any, watch_pipeline: List[dict], on_change: Callable[[dict], None], on_open: Callable[[], None] = None, on_close: Callable[[], None] = None) -> None:
+        """Feed every change on coll to on_change until close(), reopening the stream after transient failures"""
+        while self._watching:
+            try:
+                # Open the stream before on_open runs so no change made during it is lost
+                with coll.watch(pipeline=watch_pipeline, full_document='updateLookup',
+                                max_await_time_ms=kalytical_config.change_stream_max_await_ms) as stream:
+                    if on_open is not None:
+                        on_open()
+                    self.log.info(f"Change stream on {coll.name} is live")
+                    while self._watching and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            on_change(change)
+            except OperationFailure:
+                # Change streams need a replica set
+                self.log.exception(
+                    f"Change streams are not available for {coll.name}")
+                break
+            except PyMongoError:
+                self.log.exception(
+                    f"Change stream on {coll.name} failed, reopening")
+                if on_close is not None:
+                    on_close()
+                time.sleep(kalytical_config.change_stream_retry_seconds)
+        if on_close is not None:
+            on_close()
+
+    def _watch_pipeline_defs(self) -> None:
+        def on_open():
+            self._load_downstream_index()
+            self._dag_index_live = True
+
+        def on_close():
+            # Every lookup falls back to the multikey index until the stream is back
+            self._dag_index_live = False
+
+        # The body is never needed by the index, so keep it off the wire
+        self._follow_changes(self._pipeline_def_coll, [{'$project': {'fullDocument.pipeline_body': 0}}],
+                             on_change=self._apply_pipeline_def_change, on_open=on_open, on_close=on_close)
+
+    def _ensure_history_indexes(self) -> None:
+        # Every history query sorts newest first on (received_time, _id), so each shape ends with the same keys
+        for prefix in [[('event_body.pipeline_uuid', pymongo.ASCENDING)],
+                       [('event_body.exec_uuid', pymongo.ASCENDING)],
+                       [('source_exec_uuids', pymongo.ASCENDING)],
+                       [('event_type', pymongo.ASCENDING), ('event_body.event_subtype', pymongo.ASCENDING)]]:
+            self._event_history_coll.create_index(
+                prefix + [('received_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+        # Retention is handled by the server - the TTL monitor removes expired events in the background
+        try:
+            self._event_history_coll.create_index(
+                [('received_time', pymongo.ASCENDING)], name='received_time_ttl', expireAfterSeconds=kalytical_config.event_history_retention_seconds)
+        except OperationFailure:
+            # The index exists with a different retention - change it in place rather than rebuilding it
+            self._pipeline_db.command('collMod', self._event_history_coll.name,
+                                      index={'name': 'received_time_ttl', 'expireAfterSeconds': kalytical_config.event_history_retention_seconds})
+
+    def _load_downstream_index(self) -> None:
+        header_models = []
+        pipeline_uuid_by_id = {}
+        for e in self._pipeline_def_coll.find({}, {'pipeline_body': False}):
+            pipeline_uuid_by_id[e['_id']] = e['pipeline_uuid']
+            header_models.append(PipelineHeaderModel(**e))
+        self._pipeline_uuid_by_id = pipeline_uuid_by_id
+        self._downstream_index.load(header_models)
+        self.log.info(f"Loaded DAG index pipeline_count={len(header_models)}")
+
+    def _apply_pipeline_def_change(self, change: dict) -> None:
+        doc_id = change['documentKey']['_id']
+        if change['operationType'] in ['insert', 'replace', 'update'] and change.get('fullDocument') is not None:
+            header_model = PipelineHeaderModel(**change['fullDocument'])
+            self._pipeline_uuid_by_id[doc_id] = header_model.pipeline_uuid
+            self._downstream_index.upsert(header_model)
+            self._pipeline_cache.invalidate(header_model.pipeline_uuid, version=header_model.version)
+        elif change['operationType'] == 'delete' and doc_id in self._pipeline_uuid_by_id:
+            pipeline_uuid = self._pipeline_uuid_by_id.pop(doc_id)
+            self._downstream_index.remove(pipeline_uuid)
+            self._pipeline_cache.invalidate(pipeline_uuid)
 
     async def head_downstream_pipelines(self, pipeline_uuid: str) -> List[PipelineHeaderModel]:
-        return [PipelineHeaderModel(**e) for e in self._pipeline_defA_coll.find({'triggers_on.pipeline_uuids': {"$elemMatch": {"$eq": pipeline_uuid}}}, {'pipeline_body': False})]
+        if self._dag_index_live:
+            return self._downstream_index.downstream(pipeline_uuid)
+        return await self._run(lambda: [PipelineHeaderModel(**e) for e in self._pipeline_def_coll.find({'triggers_on.pipeline_uuids': pipeline_uuid}, {'pipeline_body': False})])
 
     async def list_pipelines(self, pipeline_prefix: str = None, filter_tags: Dict[str, str] = None) -> List[PipelineHeaderModel]:
         self.log.debug("Received request to list pipelines")
         query_dict = {}
         if pipeline_prefix is not None:
             the_regex = '[a-zA-Z0-9]+'
-            regex = re.complie(the_regex)
+            regex = re.compile(the_regex)
             if regex.match(pipeline_prefix) is None:
                 raise QueryException(
                     f"The prefix must match against regular expression {the_regex}")
-            query_dict['pipeline_uuid'] = {'$regex': f"{pipeline_prefix}.*"}
-            if filter_tags is not None:
-                for k, v in filter_tags.items():
-                    query_dict[f'tags.{k}'] = v
-
-            return [PipelineHeaderModel(**e) for e in self._pipeline_def_coll.find(query_dict, {'_id': False, 'pipeline_body': False})]
+            # Anchored, so it is a prefix match the pipeline_uuid index can serve
+            query_dict['pipeline_uuid'] = {'$regex': f"^{pipeline_prefix}"}
+        if filter_tags is not None:
+            for k, v in filter_tags.items():
+                query_dict[f'tags.{k}'] = v
+
+        return await self._run(lambda: [PipelineHeaderModel(**e) for e in self._pipeline_def_coll.find(query_dict, {'_id': False, 'pipeline_body': False})])
+
+    async def get_pipeline_hashes(self, pipeline_prefix: str = None) -> Dict[str, str]:
+        """content_hash of every stored definition, for clients deciding what they need to send"""
+        query_dict = {} if pipeline_prefix is None else {'pipeline_uuid': {'$regex': f"^{re.escape(pipeline_prefix)}"}}
+        hashes = {obj['pipeline_uuid']: obj.get('content_hash') for obj in await self._run(
+            lambda: list(self._pipeline_def_coll.find(query_dict, {'_id': False, 'pipeline_uuid': True, 'content_hash': True})))}
+        unhashed = [pipeline_uuid for pipeline_uuid, content_hash in hashes.items() if content_hash is None]
+        if len(unhashed) > 0:
+            # Written before content_hash was stored - hash them from the full document
+            for obj in await self._run(lambda: list(self._pipeline_def_coll.find({'pipeline_uuid': {'$in': unhashed}}, {'_id': False}))):
+                hashes[obj['pipeline_uuid']] = PipelineModel(**obj).content_hash()
+        return hashes
+
+    async def _validate_triggers(self, pipeline_models: List[PipelineModel]) -> None:
+        """Every pipeline_uuid a definition is triggered by must exist, either stored or among pipeline_models - checked with one query"""
+        given = {m.pipeline_uuid for m in pipeline_models}
+        referenced = {trigger for m in pipeline_models if m.triggers_on for trigger in m.triggers_on.pipeline_uuids} - given
+        if len(referenced) == 0:
+            return
+        found = set(await self._run(self._pipeline_def_coll.distinct, 'pipeline_uuid', {'pipeline_uuid': {'$in': list(referenced)}}))
+        for m in pipeline_models:
+            missing = [trigger for trigger in (m.triggers_on.pipeline_uuids if m.triggers_on else []) if trigger in referenced - found]
+            if len(missing) > 0:
+                raise LookupError(
+                    f"pipeline_uuid={m.pipeline_uuid} is triggered by pipeline_uuids={missing} which do not exist")
+
+    async def migrate_cronjobs(self) -> List[str]:
+        """Move pipelines still fired by a Kubernetes CronJob over to the in-process scheduler - delete the CronJob, then clear
+        scheduler_tracking_id so the scheduler picks the pipeline up. Returns the pipeline_uuids that were moved"""
+        stale = await self._run(lambda: list(self._pipeline_def_coll.find({'scheduler_tracking_id': {'$nin': [None, '']}},
+                                                                          {'_id': False, 'pipeline_uuid': True, 'scheduler_tracking_id': True})))
+        migrated = []
+        for obj in stale:
+            await self._cron_provider.delete_cronjob(job_name=obj['scheduler_tracking_id'])
+            # Conditional on the id read, so a pipeline re-applied in the meantime keeps what that write gave it
+            result = await self._run(self._pipeline_def_coll.find_one_and_update,
+                                     {'pipeline_uuid': obj['pipeline_uuid'], 'scheduler_tracking_id': obj['scheduler_tracking_id']},
+                                     {'$set': {'scheduler_tracking_id': None}, '$inc': {'version': 1}},
+                                     projection={'_id': False, 'version': True}, return_document=ReturnDocument.AFTER)
+            if result is not None:
+                self._pipeline_cache.invalidate(obj['pipeline_uuid'], version=result['version'])
+                migrated.append(obj['pipeline_uuid'])
+        return migrated
+
+    async def list_scheduled_pipelines(self) -> List[PipelineHeaderModel]:
+        return await self._run(lambda: [PipelineHeaderModel(**e) for e in self._pipeline_def_coll.find(
+            {'schedule': {'$type': 'string', '$ne': ''}}, {'_id': False, 'pipeline_body': False})])
+
+    async def _get_pipeline_entry(self, pipeline_uuid: str) -> Any:
+        """Read-through lookup of (PipelineModel, PipelineHeaderModel) - one Mongo read fills every view of a definition"""
+        entry = self._pipeline_cache.get(pipeline_uuid)
+        if entry is None:
+            result = await self._run(self._pipeline_def_coll.find_one,
+                                     {'pipeline_uuid': pipeline_uuid}, {'_id': False})
+            if result is None:
+                return result
+            entry = self._pipeline_cache.put(PipelineModel(**result))
+        return entry
 
     async def describe_pipeline(self, pipeline_uuid: str):
-        result = self._pipeline_def_coll.find_one(
-            {'pipeline_uuid': pipeline_uuid}, {'_id': False})
-        if result is None:
-            return result
-        return PipelineModel(**result)
+        entry = await self._get_pipeline_entry(pipeline_uuid=pipeline_uuid)
+        return entry if entry is None else entry[0]
 
     async def head_pipeline_definition(self, pipeline_uuid: str) -> PipelineHeaderModel:
-        result = self._pipeline_def_coll.find_one({'pipeline_uuid': pipeline_uuid}, {
-                                                  '_id': False, 'pipeline_body': False})
-        return result if result is None else PipelineHeaderModel(**result)
+        entry = await self._get_pipeline_entry(pipeline_uuid=pipeline_uuid)
+        return entry if entry is None else entry[1]
 
     async def create_or_update_pipeline(self, pipeline_model: PipelineModel) -> bool:
         existing_model = await self.head_pipeline_definition(pipeline_uuid=pipeline_model.pipeline_uuid)
-        cron_provider = K8sCronProvider(k8s_namepace=kalytical_config.k8s_namespace,
-                                        cron_image=kalytical_config.cron_image_uri, kalytical_api_endpoint=kalytical_config.kalytical_api_endpoint)
-        if pipeline_model.triggers_on:
-            for trigger in pipeline_model.triggers_on.pipeline_uuids:
-                trigger_lookup = await self.head_pipeline_definition(pipeline_uuid=trigger)
-                if trigger_lookup is None:
-                    if pipeline_model.schedule:
-                        pipeline_model.scheudler_tracking_id = cron_provider.create_cronjob(
-                            pipeline_uuid=pipeline_model.pipeline_uuid, schedule=pipeline_model.schedule)
-                        self._pipeline_def_coll.insert_one(
-                            pipeline_model.dict())
-                    else:
-                        if existing_model.scheduler_tracking_id:
-                            cron_provider.delete_cronjob(
-                                job_name=existing_model.scheduler_tracking_id)
-                        if pipeline_model.schedule:
-                            pipeline_model.scheduler_tracking_id = cron_provider.create_cronjob(
-                                pipeline_uuid=pipeline_model.pipeline_uuid, schedule=pipeline_model.schedule)
-                        self._pipeline_def_coll.replace_one(
-                            {'pipeline_uuid': pipeline_model.pipeline_uuid}, pipeline_model.dict())
-
-                    return True
+        cron_provider = self._cron_provider
+        await self._validate_triggers([pipeline_model])
+
+        had_cronjob = existing_model is not None and bool(existing_model.scheduler_tracking_id)
+        if kalytical_config.cron_scheduler == 'K8sCronProvider':
+            # A changed schedule is patched onto the existing CronJob - it is only deleted once the pipeline has no schedule
+            schedules = {pipeline_model.pipeline_uuid: pipeline_model.schedule} if pipeline_model.schedule else {}
+            removed = [pipeline_model.pipeline_uuid] if not pipeline_model.schedule and had_cronjob else []
+            tracking_ids = await cron_provider.reconcile_cronjobs(schedules=schedules, removed=removed) if schedules or removed else {}
+            pipeline_model.scheduler_tracking_id = tracking_ids.get(pipeline_model.pipeline_uuid)
+        else:
+            if pipeline_model.schedule:
+                # Fail the write rather than have the in-process scheduler skip the pipeline later
+                _validate_schedule(pipeline_model.schedule)
+            if had_cronjob:
+                # Left from before the switch to the in-process scheduler
+                await cron_provider.reconcile_cronjobs(schedules={}, removed=[pipeline_model.pipeline_uuid])
+            pipeline_model.scheduler_tracking_id = None
+        result = await self._run(self._pipeline_def_coll.find_one_and_update, {'pipeline_uuid': pipeline_model.pipeline_uuid},
+                                 {'$set': {**pipeline_model.dict(exclude={'version'}), 'content_hash': pipeline_model.content_hash()}, '$inc': {'version': 1}},
+                                 projection={'_id': False, 'version': True}, upsert=True, return_document=ReturnDocument.AFTER)
+        pipeline_model.version = result['version']
+        self._apply_local_write(pipeline_model)
+        return True
+
+    def _apply_local_write(self, pipeline_model: PipelineModel) -> None:
+        # Apply locally straight away - the change stream only has to carry writes made by other replicas
+        self._pipeline_cache.invalidate(pipeline_model.pipeline_uuid, version=pipeline_model.version)
+        self._downstream_index.upsert(PipelineHeaderModel(**pipeline_model.dict(exclude={'pipeline_body'})))
+
+    async def apply_pipelines(self, pipeline_models: List[PipelineModel], prune: bool = False, dry_run: bool = False) -> PipelineApplyResultModel:
+        """Bring the stored definitions in line with pipeline_models in one pass. Definitions whose content_hash has not changed
+        are left alone, the rest are written with one bulk_write and their CronJobs reconciled with one listing.
+        With prune, stored definitions that are not in pipeline_models are deleted as well"""
+        uuids = [m.pipeline_uuid for m in pipeline_models]
+        if len(set(uuids)) != len(uuids):
+            raise ValueError(f"pipeline_uuids={sorted({u for u in uuids if uuids.count(u) > 1})} appear more than once")
+        await self._validate_triggers(pipeline_models)
+        if kalytical_config.cron_scheduler != 'K8sCronProvider':
+            for m in pipeline_models:
+                if m.schedule:
+                    _validate_schedule(m.schedule)
+
+        stored = {obj['pipeline_uuid']: obj for obj in await self._run(
+            lambda: list(self._pipeline_def_coll.find({'pipeline_uuid': {'$in': uuids}}, {'_id': False})))}
+        result = PipelineApplyResultModel()
+        changed = []
+        for m in pipeline_models:
+            obj = stored.get(m.pipeline_uuid)
+            if obj is None:
+                result.created.append(m.pipeline_uuid)
+            elif (obj.get('content_hash') or PipelineModel(**obj).content_hash()) != m.content_hash():
+                result.updated.append(m.pipeline_uuid)
+            else:
+                result.unchanged.append(m.pipeline_uuid)
+                continue
+            changed.append(m)
+        pruned = []
+        if prune:
+            pruned = [obj['pipeline_uuid'] for obj in await self._run(lambda: list(self._pipeline_def_coll.find(
+                {'pipeline_uuid': {'$nin': uuids}}, {'_id': False, 'pipeline_uuid': True, 'triggers_on': True})))]
+            # A surviving definition cannot be left triggered by one that is about to go
+            orphaned = [m.pipeline_uuid for m in pipeline_models if m.triggers_on and not set(uuids).issuperset(m.triggers_on.pipeline_uuids)]
+            if len(orphaned) > 0:
+                raise LookupError(f"pipeline_uuids={orphaned} are triggered by pipelines that would be pruned")
+            result.deleted = pruned
+        if dry_run or (len(changed) == 0 and len(pruned) == 0):
+            return result
+
+        scheduled = {m.pipeline_uuid: m.schedule for m in changed if m.schedule}
+        unscheduled = [m.pipeline_uuid for m in changed if not m.schedule and (stored.get(m.pipeline_uuid) or {}).get('scheduler_tracking_id')] + pruned
+        if kalytical_config.cron_scheduler == 'K8sCronProvider':
+            tracking_ids = await self._cron_provider.reconcile_cronjobs(schedules=scheduled, removed=unscheduled)
+        else:
+            # Changed pipelines drop any CronJob left from before the switch here. Unchanged ones are not written at all,
+            # so the in-process scheduler moves those over itself - see migrate_cronjobs
+            tracking_ids = {}
+            await self._cron_provider.reconcile_cronjobs(schedules={}, removed=unscheduled + [
+                m.pipeline_uuid for m in changed if m.schedule and (stored.get(m.pipeline_uuid) or {}).get('scheduler_tracking_id')])
+        for m in changed:
+            m.scheduler_tracking_id = tracking_ids.get(m.pipeline_uuid)
+
+        operations = [UpdateOne({'pipeline_uuid': m.pipeline_uuid}, {'$set': {**m.dict(exclude={'version'}), 'content_hash': m.content_hash()},
+                                                                     '$inc': {'version': 1}}, upsert=True) for m in changed]
+        if len(pruned) > 0:
+            operations.append(DeleteMany({'pipeline_uuid': {'$in': pruned}}))
+        await self._run(self._pipeline_def_coll.bulk_write, operations, ordered=False)
+
+        versions = {obj['pipeline_uuid']: obj['version'] for obj in await self._run(lambda: list(self._pipeline_def_coll.find(
+            {'pipeline_uuid': {'$in': [m.pipeline_uuid for m in changed]}}, {'_id': False, 'pipeline_uuid': True, 'version': True})))}
+        for m in changed:
+            m.version = versions.get(m.pipeline_uuid)
+            self._apply_local_write(m)
+        for pipeline_uuid in pruned:
+            self._downstream_index.remove(pipeline_uuid)
+            self._pipeline_cache.invalidate(pipeline_uuid)
+        self.log.info(
+            f"Applied pipelines created={len(result.created)} updated={len(result.updated)} unchanged={len(result.unchanged)} deleted={len(result.deleted)}")
+        return result
 
     async def delete_pipeline(self, pipeline_uuid: str, safe_delete: bool = False) -> bool:
         existing_model = await self.head_pipeline_definition(pipeline_uuid=pipeline_uuid)
@@ -97,12 +447,12 @@ class MongoDBProvider():
                 f"Deleting pipeline_uuid{pipeline_uuid} would leave orphaned pipeline_uuids={[phm.pipeline_uuid for phm in downstream_list]}")
         try:
             if existing_model.scheduler_tracking_id:
-                cron_provider = K8sCronProvider(k8s_namespace=kalytical_config.k8s_namespace,
-                                                cron_image=kalytical_config.cron_image_uri, kalytical_api_endpoint=kalytical_config.kalytical_api_endpoint)
-                cron_provider.delete_cronjob(
+                await self._cron_provider.delete_cronjob(
                     job_name=existing_model.scheduler_tracking_id)
-            self._pipeline_def_coll.delete_one(
-                {'pipeline_uuid': pipeline_uuid})
+            await self._run(self._pipeline_def_coll.delete_one,
+                            {'pipeline_uuid': pipeline_uuid})
+            self._downstream_index.remove(pipeline_uuid)
+            self._pipeline_cache.invalidate(pipeline_uuid)
             return True
         except Exception as e:
             self.log.exception(
@@ -112,175 +462,452 @@ class MongoDBProvider():
     async def flush_pipeline(self, pipeline_prefix: str = None, filter_tags: Dict[str, str] = None) -> bool:
         try:
             pipeline_list = await self.list_pipelines(pipeline_prefix=pipeline_prefix, filter_tags=filter_tags)
-            for pipeline in pipeline_list:
-                await self.delete_pipeline(pipeline_uuid=pipeline.pipeline_uuid)
-                return True
+            uuids = [pipeline.pipeline_uuid for pipeline in pipeline_list]
+            await self._cron_provider.reconcile_cronjobs(schedules={}, removed=[
+                pipeline.pipeline_uuid for pipeline in pipeline_list if pipeline.scheduler_tracking_id])
+            await self._run(self._pipeline_def_coll.delete_many, {'pipeline_uuid': {'$in': uuids}})
+            for pipeline_uuid in uuids:
+                self._downstream_index.remove(pipeline_uuid)
+                self._pipeline_cache.invalidate(pipeline_uuid)
+            return True
 
         except Exception as e:
             self.log.exception(e)
             return False
 
     async def fetch_pipeline_body_by_uuid(self, pipeline_uuid: str):
-        result = self._pipeline_def_coll.find_one({"pipeline_uuid": pipeline_uuid}, {
-                                                  '_id': False, 'pipeline_body': True})
-        return result
-
-    async def save_event_to_history(self, history_item: dict) -> None:
-        history_dict = copy.deepcopy(history_item.dict())
-        history_dict['received_time'] = datetime.now()
-        self._event_history_coll.insert_one(history_dict)
-
-    async def get_event_history(self, since_seconds: int, max_records: int, event_type: str, event_subtype: str, exec_uuid: str = None, pipeline_uuid: str = None, source_uuid: str = None) -> Any:
-        query_dict = {"received_time": {
-            "$gte": (datetime.now() - timedelta(seconds=since_seconds))}}
+        entry = await self._get_pipeline_entry(pipeline_uuid=pipeline_uuid)
+        return entry if entry is None else {'pipeline_body': entry[0].pipeline_body}
+
+    async def save_event_to_history(self, history_item: Any) -> None:
+        await self.save_events_to_history([history_item])
+
+    async def save_events_to_history(self, history_items: List[Any]) -> None:
+        # dict() already builds fresh containers, so the buffered records cannot be changed by the caller afterwards
+        received_time = datetime.now()
+        await self._history_buffer.append([self._marshall_history(history_item=history_item, received_time=received_time) for history_item in history_items])
+
+    def _marshall_history(self, history_item: Any, received_time: datetime) -> dict:
+        history_dict = history_item.dict()
+        history_dict['received_time'] = received_time
+        # source_uuids maps pipeline_uuid to exec_uuid - copy the values to an array so a source lookup can use a multikey index
+        source_uuids = history_dict.get('event_body', {}).get('source_uuids')
+        history_dict['source_exec_uuids'] = list(source_uuids.values()) if isinstance(source_uuids, dict) else []
+        return history_dict
+
+    async def _insert_history(self, history_dicts: List[dict]) -> None:
+        # Unordered so one bad record does not stop the rest of the batch from being written
+        await self._run(self._event_history_coll.insert_many, history_dicts, ordered=False)
+
+    async def get_event_history(self, since_seconds: int, max_records: int, event_type: str = None, event_subtype: str = None, exec_uuid: str = None,
+                                pipeline_uuid: str = None, source_uuid: str = None, cursor: str = None) -> EventHistoryPageModel:
+        """Newest events first. Pass the returned next_cursor back in to continue from where the previous page stopped"""
+        query_dict = {'received_time': {
+            '$gte': (datetime.now() - timedelta(seconds=since_seconds))}}
+        if pipeline_uuid is not None:
+            query_dict['event_body.pipeline_uuid'] = pipeline_uuid
+        if source_uuid is not None:
+            query_dict['source_exec_uuids'] = source_uuid
+        if exec_uuid is not None:
+            query_dict['event_body.exec_uuid'] = exec_uuid
+        if event_type is not None:
+            query_dict['event_type'] = event_type
+        if event_subtype is not None:
+            query_dict['event_body.event_subtype'] = event_subtype
+        if cursor is not None:
+            # Seek past the last event of the previous page instead of skipping, so deep pages cost the same as the first
+            last_time, last_id = _decode_history_cursor(cursor)
+            query_dict['$or'] = [{'received_time': {'$lt': last_time}},
+                                 {'received_time': last_time, '_id': {'$lt': last_id}}]
+
+        events = await self._run(lambda: list(self._event_history_coll.find(query_dict, {'source_exec_uuids': False})
+                                              .sort([('received_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]).limit(max_records)))
+        next_cursor = None
+        if len(events) == max_records:
+            next_cursor = _encode_history_cursor(events[-1]['received_time'], events[-1]['_id'])
+        for event in events:
+            del event['_id']
+        return EventHistoryPageModel(events=events, next_cursor=next_cursor)
+
+    async def flush_event_history(self, older_than_seconds: int = None, pipeline_uuid: str = None) -> bool:
+        query_dict = {}
+        if older_than_seconds is not None:
+            query_dict['received_time'] = {'$lt': datetime.now() - timedelta(seconds=older_than_seconds)}
         if pipeline_uuid is not None:
             query_dict['event_body.pipeline_uuid'] = pipeline_uuid
-            if source_uuid is not None:
-                # TODO this should be a query that searches source_uuid dictionaries for this value
-                query_dict['event_body.source_uuid'] = source_uuid
-            if exec_uuid is not None:
-                query_dict['event_body.exec_uuid'] = exec_uuid
-            if event_type is not None:
-                query_dict['event_type'] = event_type
-            if event_subtype is not None:
-                query_dict['event_subtype'] = event_subtype
-            return list(self._event_history_coll.find(query_dict, {'_id': 0}).sort('received_time', pymongo.DESCENDING).limit(max_records))
-
-    async def flush_event_history(self):
         try:
-            self._event_history_coll.delete_many({})
+            await self._run(self._event_history_coll.delete_many, query_dict)
             return True
         except Exception:
             self.log.exception("Could not delete history for some reason")
             return False
 
-    @retry
-    def _get_incubation_lock(self) -> None:
-        if self._has_incubation_lock:
-            return self._has_incubation_lock
-        self._lock_coll.find_one_and_update({'coll_name': 'incubation_coll', 'locked': False}, {
-                                            '$set': {'locked': True, 'locked_timestam': datetime.now()}})
-        if self._lock_coll.find_one({'coll_name': 'incubation_coll', 'locked': True}) is None:
-            self.log.error("Failed to get incubation lock")
-            lock_time = self._lock_coll.find_one({'coll_name': 'incubation_coll})'})[
-                'locked_timestamp']
-            if (datetime.now() - lock_time).seconds > kalytical_config.coll_lock_timeout:
-                self._lock_coll.find_and_modify({'coll_name': 'incubation_coll', 'locked': True}, {
-                                                '$set': {'locked': True, 'locked_timestamp': datetime.now()}})
-                if self._lock_coll.find_one({'coll_name': 'incubation_coll', 'locked': False}) is None:
-                    self.log.error(
-                        "Could not focibly remove the lock on this collection.")
-                    raise CollectionLockError(
-                        "Could not acquire lock on incubation collection")
-                self.log.warn(
-                    "Removed the lock forcibly. You should investigate why this was necessary. Perhaps another service failed to release?")
-            else:
-                self.log.debug("Aquired incubation collection lock")
-                self._has_incubation_lock = True
-
-    @retry
-    def _release_incubation_lock(self) -> None:
-        if self._has_incubation_lock:
-            result = self._lock_coll.find_and_modify(
-                {'coll_name': 'incubation_coll', 'locked': True}, {'$set': {'locked': False}})
-            if result is None:
-                result = self._lock_coll.find({'coll_name': 'incubation_coll'})
-                if result is None:
-                    self.log.error("The collection lock was deleted!")
-                else:
-                    self.log.error(
-                        "The collection lock was released by someone else!")
-            else:
-                self._has_incubation_lock = False
-                self.log.debug("Released incubation collection lock")
-        else:
-            self.log.warning(
-                "Incubation lock was never held, but requested to remove")
+    async def update_execution(self, exec_uuid: str, pipeline_uuid: str, state: str, fields: Dict[str, Any] = None) -> bool:
+        """Move an execution forward to state, creating it if this is the first we hear of it.
+        Returns False when the execution is already at or past state, in which case only fields are applied"""
+        rank = EXECUTION_STATE_RANK[state]
+        now = datetime.now()
+        update_dict = {**(fields or {}), 'pipeline_uuid': pipeline_uuid,
+                       'state': state, 'state_rank': rank, 'update_time': now}
+        terminal = rank == max(EXECUTION_STATE_RANK.values())
+        if terminal:
+            update_dict['finish_time'] = now
+        try:
+            await self._run(self._executions_coll.update_one, {'exec_uuid': exec_uuid, 'state_rank': {'$lt': rank}},
+                            {'$set': update_dict, '$setOnInsert': {'create_time': now}}, upsert=True)
+            if terminal:
+                await self._release_execution_slots(exec_uuid=exec_uuid)
+            return True
+        except DuplicateKeyError:
+            # The filter missed because the execution is already further along, so the upsert collided with it
+            if fields:
+                await self._run(self._executions_coll.update_one, {'exec_uuid': exec_uuid}, {'$set': fields})
+            return False
 
-    def defer_job(self, pipeline_uuid: str, reason: str, retry_count: int, trigger_model: dict = None, created_by_uuid: str = None) -> None:
-        self._run_incubation_coll.insert_one(IncubatingPipelineModel(create_time=datetime.now(
-        ), pipeline_uuid=pipeline_uuid, created_by_uuid=created_by_uuid, reason=reason, trigger_model=trigger_model, retry_count=retry_count).dict())
+    async def acquire_execution_slots(self, exec_uuid: str, pipeline_uuid: str, limits: Dict[str, int], fields: Dict[str, Any] = None) -> bool:
+        """Record a pending execution holding one slot under every key in limits, or nothing at all if any key is at its cap.
+        The slots are given back when the execution reaches a terminal state. Raises ExecutionExistsError, without taking
+        anything, when exec_uuid is already in the ledger - e.g. the event that caused it was delivered twice"""
+        # The execution is written first so a slot can never be held without a ledger entry that will release it
+        now = datetime.now()
+        result = await self._run(self._executions_coll.update_one, {'exec_uuid': exec_uuid}, {'$setOnInsert': {
+            **(fields or {}), 'pipeline_uuid': pipeline_uuid, 'state': 'pending', 'state_rank': EXECUTION_STATE_RANK['pending'],
+            'update_time': now, 'create_time': now, 'slots': list(limits.keys())}}, upsert=True)
+        if result.upserted_id is None:
+            raise ExecutionExistsError(f"exec_uuid={exec_uuid} for pipeline_uuid={pipeline_uuid} is already in the ledger")
+        acquired = []
+        try:
+            for slot_key, cap in limits.items():
+                # An upsert that misses because the counter is already at cap collides on _id instead of inserting
+                await self._run(self._concurrency_slots_coll.update_one, {'_id': slot_key, 'used': {'$lt': cap}},
+                                {'$inc': {'used': 1, 'version': 1}}, upsert=True)
+                acquired.append(slot_key)
+            return True
+        except DuplicateKeyError:
+            self.log.info(
+                f"No free slot for pipeline_uuid={pipeline_uuid} under slot_key={slot_key} cap={cap}")
+            await self._rollback_execution_slots(exec_uuid=exec_uuid, acquired=acquired)
+            return False
+        except Exception:
+            # Whatever did go through is given back, rather than held by an execution that will never be submitted
+            await self._rollback_execution_slots(exec_uuid=exec_uuid, acquired=acquired)
+            raise
+
+    async def _rollback_execution_slots(self, exec_uuid: str, acquired: List[str]) -> None:
+        for slot_key in acquired:
+            await self._decrement_slot(slot_key=slot_key)
+        await self._run(self._executions_coll.delete_one, {'exec_uuid': exec_uuid})
+
+    async def has_free_slots(self, limits: Dict[str, int]) -> bool:
+        used = {obj['_id']: obj['used'] for obj in await self._run(lambda: list(self._concurrency_slots_coll.find({'_id': {'$in': list(limits.keys())}})))}
+        return all(used.get(slot_key, 0) < cap for slot_key, cap in limits.items())
+
+    async def _release_execution_slots(self, exec_uuid: str) -> None:
+        # Clearing the list and reading it back in one step makes sure each slot is given back exactly once
+        obj = await self._run(self._executions_coll.find_one_and_update, {'exec_uuid': exec_uuid, 'slots.0': {'$exists': True}},
+                              {'$set': {'slots': []}}, projection={'slots': True})
+        for slot_key in (obj or {}).get('slots', []):
+            await self._decrement_slot(slot_key=slot_key)
+
+    async def _decrement_slot(self, slot_key: str) -> None:
+        await self._run(self._concurrency_slots_coll.update_one, {'_id': slot_key, 'used': {'$gt': 0}}, {'$inc': {'used': -1, 'version': 1}})
+
+    async def repair_concurrency_slots(self) -> int:
+        """Lower any slot counter that is above the number of executions holding it, e.g. after a crash mid-release"""
+        # A crash between an execution finishing and giving its slots back leaves them listed - give them back now
+        finished = await self._run(lambda: list(self._executions_coll.find(
+            {'state': {'$nin': ACTIVE_EXECUTION_STATES}, 'slots.0': {'$exists': True}}, {'exec_uuid': True})))
+        for obj in finished:
+            await self._release_execution_slots(exec_uuid=obj['exec_uuid'])
+        held = {obj['_id']: obj['used'] for obj in await self._run(lambda: list(self._executions_coll.aggregate([
+            {'$unwind': '$slots'},
+            {'$group': {'_id': '$slots', 'used': {'$sum': 1}}}])))}
+        repaired = 0
+        for obj in await self._run(lambda: list(self._concurrency_slots_coll.find({'used': {'$gt': 0}}))):
+            if obj['used'] > held.get(obj['_id'], 0) and await self._repair_slot(slot_key=obj['_id']):
+                repaired += 1
+        return repaired
+
+    async def _repair_slot(self, slot_key: str) -> bool:
+        """Set one counter to the number of executions listing it. Every acquire and release bumps the counter's version,
+        so reading it before counting and writing only if the version is unchanged never overwrites a concurrent change"""
+        for attempt in range(kalytical_config.slot_repair_max_attempts):
+            obj = await self._run(self._concurrency_slots_coll.find_one, {'_id': slot_key})
+            held = await self._run(self._executions_coll.count_documents, {'slots': slot_key})
+            if obj is None or obj['used'] <= held:
+                return False
+            # A counter from before versioning has no version field, which the None filter matches
+            result = await self._run(self._concurrency_slots_coll.update_one, {'_id': slot_key, 'version': obj.get('version')},
+                                     {'$set': {'used': held}, '$inc': {'version': 1}})
+            if result.modified_count == 1:
+                return True
+        self.log.warning(f"slot_key={slot_key} kept changing while being repaired, leaving it for the next pass")
+        return False
 
-    async def update_incubating_jobs(self, trigger_pipeline_uuid: str, header_model: PipelineHeaderModel, source_uuid: str):
+    async def get_executions(self, states: List[str] = None, pipeline_uuid: str = None, engine_name: str = None, limit: int = None,
+                             updated_before: datetime = None, exec_uuid: str = None) -> List[RunningPipelineModel]:
+        query_dict = {}
+        if exec_uuid is not None:
+            query_dict['exec_uuid'] = exec_uuid
+        if states is not None:
+            query_dict['state'] = {'$in': states}
+        if pipeline_uuid is not None:
+            query_dict['pipeline_uuid'] = pipeline_uuid
+        if engine_name is not None:
+            query_dict['engine'] = engine_name
+        if updated_before is not None:
+            query_dict['update_time'] = {'$lt': updated_before}
+
+        def find():
+            cursor = self._executions_coll.find(query_dict, {'_id': False})
+            return list(cursor.limit(limit) if limit else cursor)
+        return [self._unmarshall_execution(obj) for obj in await self._run(find)]
+
+    def _unmarshall_execution(self, obj: dict) -> RunningPipelineModel:
+        return RunningPipelineModel(exec_uuid=obj['exec_uuid'], pipeline_uuid=obj['pipeline_uuid'], engine=obj.get('engine'), engine_tracking_id=obj.get('engine_tracking_id'),
+                                    engine_status=obj['state'], start_time=obj.get('start_time'), end_time=obj.get('end_time'), owner_host=obj.get('owner_host'))
+
+    async def claim_fanout(self, exec_uuid: str, pipeline_uuid: str) -> bool:
+        """Record that the success of exec_uuid has been passed on to pipeline_uuid. False means it already was"""
+        result = await self._run(self._executions_coll.update_one, {'exec_uuid': exec_uuid, 'fanned_out': {'$ne': pipeline_uuid}},
+                                 {'$addToSet': {'fanned_out': pipeline_uuid}})
+        return result.modified_count == 1
+
+    async def release_fanout(self, exec_uuid: str, pipeline_uuid: str) -> None:
+        """Undo claim_fanout after the hand-off failed, so a redelivered event tries it again"""
+        await self._run(self._executions_coll.update_one, {'exec_uuid': exec_uuid}, {'$pull': {'fanned_out': pipeline_uuid}})
+
+    def _unmarshall_incubating(self, obj: dict) -> IncubatingPipelineModel:
+        return IncubatingPipelineModel(obj_id=str(obj['_id']), pipeline_uuid=obj['pipeline_uuid'], created_by_uuid=obj.get('created_by_uuid'), reason=obj['reason'],
+                                       source_uuids=obj.get('source_uuids'), triggers=obj.get('triggers', {}), create_time=obj['create_time'], retry_count=obj.get('retry_count', 0), version=obj.get('version', 0),
+                                       exec_uuid=obj.get('exec_uuid'), launch_time=obj.get('launch_time'))
+
+    async def defer_job(self, pipeline_uuid: str, reason: str, retry_count: int, trigger_model: dict = None, source_uuids: Dict[str, str] = None,
+                        create_time: datetime = None, exec_uuid: str = None) -> None:
+        """Park a run. Pass the create_time of an earlier deferral to keep a run that was woken but lost the race at the head of the queue.
+        A run is parked at most once per exec_uuid, so deferring it again on a redelivered event is a no-op"""
+        incubating = IncubatingPipelineModel(create_time=create_time or datetime.now(), pipeline_uuid=pipeline_uuid, source_uuids=source_uuids, reason=reason,
+                                             trigger_model=trigger_model, retry_count=retry_count, exec_uuid=exec_uuid).dict(exclude={'obj_id'})
+        if exec_uuid is None:
+            await self._run(self._run_incubation_coll.insert_one, incubating)
+        else:
+            await self._run(self._run_incubation_coll.update_one, {'exec_uuid': exec_uuid, 'reason': reason}, {'$setOnInsert': incubating}, upsert=True)
+
+    async def list_deferred_pipelines(self) -> List[str]:
+        """Every pipeline_uuid with runs deferred on concurrency, the one that has waited longest first"""
+        return [obj['_id'] for obj in await self._run(lambda: list(self._run_incubation_coll.aggregate([
+            {'$match': {'reason': 'concurrency'}},
+            {'$group': {'_id': '$pipeline_uuid', 'create_time': {'$min': '$create_time'}}},
+            {'$sort': {'create_time': pymongo.ASCENDING}}])))]
+
+    async def pop_deferred_run(self, pipeline_uuid: str) -> IncubatingPipelineModel:
+        """Take the oldest run deferred on concurrency for pipeline_uuid off the queue, or None if there is none"""
+        result = await self._run(self._run_incubation_coll.find_one_and_delete, {'pipeline_uuid': pipeline_uuid, 'reason': 'concurrency'},
+                                 sort=[('create_time', pymongo.ASCENDING)])
+        return result if result is None else self._unmarshall_incubating(result)
+
+    async def update_incubating_jobs(self, trigger_pipeline_uuid: str, header_model: PipelineHeaderModel, source_uuid: str) -> IncubatingPipelineModel:
+        """Mark trigger_pipeline_uuid satisfied on the open dependency run of header_model, opening one if there is none.
+        A trigger that succeeds again before the run launches replaces its earlier exec_uuid, so a run always starts from the
+        latest success of every trigger. One upsert per event, so unrelated pipelines never wait on each other"""
+        trigger_key = f"triggers.{trigger_pipeline_uuid}"
+        on_insert = {f"triggers.{e}": 'waiting' for e in header_model.triggers_on.pipeline_uuids if e != trigger_pipeline_uuid}
+        on_insert.update({'create_time': datetime.now(), 'created_by_uuid': source_uuid, 'source_uuids': None, 'retry_count': 0})
+        for attempt in range(kalytical_config.incubation_upsert_max_attempts):
+            try:
+                result = await self._run(self._run_incubation_coll.find_one_and_update,
+                                         {'pipeline_uuid': header_model.pipeline_uuid, 'reason': 'dependencies', 'open': True},
+                                         {'$set': {trigger_key: source_uuid}, '$inc': {'version': 1}, '$setOnInsert': on_insert},
+                                         upsert=True, return_document=ReturnDocument.AFTER)
+                break
+            except DuplicateKeyError:
+                # Another event opened the run between our filter missing and our insert - the retry updates that run instead
+                if attempt == kalytical_config.incubation_upsert_max_attempts - 1:
+                    raise
+                self.log.debug(
+                    f"Open dependency run for pipeline_uuid={header_model.pipeline_uuid} was created concurrently, retrying")
+
+        self.log.info(
+            f"Updated incubating job obj_id={result['_id']} for pipeline_uuid={header_model.pipeline_uuid} with satisfied dependency={trigger_pipeline_uuid}")
+        return self._unmarshall_incubating(result)
+
+    async def claim_incubating_pipeline(self, obj_id: str, version: int, stale_before: datetime = None) -> IncubatingPipelineModel:
+        """Atomically mark a run launching so exactly one caller launches it, closing it to further triggers. A run that has been
+        launching since before stale_before can be claimed again. Returns None if the run changed or was already claimed"""
+        not_launching = [{'launch_time': None}]
+        if stale_before is not None:
+            not_launching.append({'launch_time': {'$lt': stale_before}})
+        result = await self._run(self._run_incubation_coll.find_one_and_update, {'_id': ObjectId(obj_id), 'version': version, '$or': not_launching},
+                                 {'$set': {'launch_time': datetime.now(), 'open': False}}, return_document=ReturnDocument.AFTER)
+        return result if result is None else self._unmarshall_incubating(result)
+
+    async def restore_incubating_pipeline(self, obj_id: str) -> None:
+        """Hand a run whose launch failed back, so the redelivered trigger or the culler launches it again"""
         try:
-            self._get_incubation_lock()
-            if self._run_incbuation_coll.find_one({'pipeline_uuid': header_model.pipeline_uuid, f"triggers.{trigger_pipeline_uuid}": "waiting"}) is None:
-                self.log.info(
-                    f"An incubating pipeline for pipeline_uuid={header_model.pipeline_uuid} does not exist. We will create one.")
-                t_model = {}
-                for e in header_model.triggers_on.pipeline_uuids:
-                    t_model[e] = 'waiting'
-                self._run_incbuation_coll.insert_one(IncubatingPipelineModel(create_time=datetime.now(
-                ), pipeline_uuid=header_model.pipeline_uuid, created_by_uuid=source_uuid, reason='dependencies', triggers=t_model.dict()))
-
-                # Notify the oldest waiting pipeline
-                pipeline_uuids = self._run_incubation_coll.distinct(
-                    'pipeline_uuid', {f"triggers.{trigger_pipeline_uuid}": "waiting"})
-
-                for pipeline_uuid in list(set(pipeline_uuids)):
-                    obj_id = self._run_incubation_coll.find({'pipeline_uuid': pipeline_uuid, f"triggers.{trigger_pipeline_uuid}": "waiting"}).sort(
-                        'create_time', pymongo.ASCENDING)[0]['_id']
-                    self._run_incubation_coll.find_one_and_update(
-                        {'_id': obj_id}, {'$set': {f"triggers.{trigger_pipeline_uuid}": source_uuid}})
-
-                self.log.info(
-                    f"Updated the following jobs with satisfied dependency={trigger_pipeline_uuid} incubating_jobs={pipeline_uuids}")
-
-        finally:
-            self._release_incbuation_lock()
+            await self._run(self._run_incubation_coll.update_one, {'_id': ObjectId(obj_id)}, {'$set': {'open': True}, '$unset': {'launch_time': ''}})
+        except DuplicateKeyError:
+            # A trigger opened a new run while this one was launching - this one stays closed and the culler relaunches it
+            await self._run(self._run_incubation_coll.update_one, {'_id': ObjectId(obj_id)}, {'$unset': {'launch_time': ''}})
+
+    async def age_out_incubating_pipelines(self, created_before: datetime) -> int:
+        result = await self._run(self._run_incubation_coll.delete_many, {'create_time': {'$lt': created_before}})
+        return result.deleted_count
 
     async def delete_incubating_pipeline(self, obj_id: str) -> bool:
         try:
-            self._get_incubation_lock()
-            self._run_incubation_coll.delete_one({'_id': ObjectId(obj_id)})
+            await self._run(self._run_incubation_coll.delete_one, {'_id': ObjectId(obj_id)})
             return True
         except Exception:
             self.log.exception(f"There was a problem deleting obj_id={obj_id}")
             return False
-        finally:
-            self._release_incubation_lock()
 
     async def clear_incubating_pipelines(self) -> bool:
         try:
-            self._get_incubation_lock()
-            self._run_icubation_coll.delete_many({})
+            await self._run(self._run_incubation_coll.delete_many, {})
             return True
         except Exception:
             self.log.exception(
                 "There was a problem clearing all incubating pipelines")
             return False
 
-        finally:
-            self._release_incubation_lock()
-
-    async def update_incubating_pipelines(self, obj_id: str, new_update_deps_dict: Dict[str, str]) -> IncubatingPipelineModel:
+    async def update_incubating_pipelines(self, obj_id: str, new_update_deps_dict: Dict[str, str], expected_version: int = None) -> IncubatingPipelineModel:
+        """Replace the triggers of one run. When expected_version is given the write only applies if nobody changed the run since it was read"""
+        query_dict = {'_id': ObjectId(obj_id)}
+        if expected_version is not None:
+            query_dict['version'] = expected_version
         try:
-            self._get_incubation_lock()
-            return IncubatingPipelineModel(**self._run_incubation_coll.find_one_and_update({'_id': ObjectId(obj_id)}, {'$set': {'triggers': new_update_deps_dict}}, return_document=ReturnDocument.AFTER))
+            result = await self._run(self._run_incubation_coll.find_one_and_update, query_dict, {'$set': {'triggers': new_update_deps_dict}, '$inc': {'version': 1}},
+                                     return_document=ReturnDocument.AFTER)
+            return result if result is None else self._unmarshall_incubating(result)
         except Exception:
             self.log.exception(
                 f"There was a problem updating the entry for obj_id={obj_id}")
-        finally:
-            self._release_incubation_lock()
 
-    async def get_incubating_pipelines(self, obj_id: str = None, pipeline_uuid: str = None) -> List[IncubatingPipelineModel]:
+    async def get_incubating_pipelines(self, obj_id: str = None, pipeline_uuid: str = None, reason: str = None, created_before: datetime = None) -> List[IncubatingPipelineModel]:
         query_dict = {}
-        results = []
         if pipeline_uuid is not None:
             query_dict['pipeline_uuid'] = pipeline_uuid
         if obj_id is not None:
-            query_dict['_id'] = obj_id
-        for obj in self._run_incubation_coll.find(query_dict):
-            results.append(IncubatingPipelineModel(obj_id=str(obj['id']), pipeline_uuid=obj['pipeline_uuid'], created_by_uuid=obj[
-                           'created_by_uuid'], reason=obj['reason'], triggers=obj['triggers'], create_time=obj['create_time']))
-        return results
+            query_dict['_id'] = ObjectId(obj_id)
+        if reason is not None:
+            query_dict['reason'] = reason
+        if created_before is not None:
+            query_dict['create_time'] = {'$lt': created_before}
+        return [self._unmarshall_incubating(obj) for obj in await self._run(lambda: list(self._run_incubation_coll.find(query_dict)))]
+
+    async def acquire_lease(self, name: str, holder: str, ttl_seconds: float) -> bool:
+        """Take or renew the lease called name for holder. Returns False while another holder has it and it has not expired"""
+        now = datetime.now()
+        try:
+            await self._run(self._leases_coll.update_one, {'_id': name, '$or': [{'holder': holder}, {'expire_time': {'$lt': now}}]},
+                            {'$set': {'holder': holder, 'expire_time': now + timedelta(seconds=ttl_seconds)}}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            # The filter missed because someone else holds it, so the upsert collided with their lease
+            return False
+
+    async def release_lease(self, name: str, holder: str) -> None:
+        await self._run(self._leases_coll.delete_one, {'_id': name, 'holder': holder})
+
+    async def get_cron_fire_times(self) -> Dict[str, datetime]:
+        return {obj['_id']: obj['last_fire_time'] for obj in await self._run(lambda: list(self._cron_state_coll.find({})))}
+
+    async def claim_cron_fire(self, pipeline_uuid: str, fire_time: datetime) -> bool:
+        """Record that pipeline_uuid fired at fire_time. False means it already fired at or after it, e.g. under the previous leader"""
+        try:
+            await self._run(self._cron_state_coll.update_one, {'_id': pipeline_uuid, 'last_fire_time': {'$lt': fire_time}},
+                            {'$set': {'last_fire_time': fire_time}}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def register_warm_pod(self, pod_name: str, pool_id: str) -> None:
+        """Written before the pod is created, so its first poll always finds it"""
+        await self._run(self._warm_pods_coll.insert_one, {'_id': pod_name, 'pool_id': pool_id, 'state': 'starting', 'create_time': datetime.now()})
+
+    async def poll_warm_pod(self, pod_name: str) -> Dict[str, Any]:
+        """Called by an idle warm pod. Returns its claim the first time it has one, otherwise None and records the pod as alive.
+        Raises NotFoundError once the pod has been retired, telling it to exit"""
+        now = datetime.now()
+        result = await self._run(self._warm_pods_coll.find_one_and_update, {'_id': pod_name, 'state': 'claimed'},
+                                 {'$set': {'state': 'started', 'picked_up_time': now}}, projection={'claim': True})
+        if result is not None:
+            return result['claim']
+        result = await self._run(self._warm_pods_coll.update_one, {'_id': pod_name, 'state': {'$in': ['starting', 'idle']}},
+                                 {'$set': {'state': 'idle', 'last_poll_time': now}})
+        if result.matched_count == 0:
+            raise NotFoundError(f"No waiting warm pod named pod_name={pod_name}")
+        return None
+
+    async def claim_warm_pod(self, pool_id: str, claim: Dict[str, Any], polled_since: datetime) -> str:
+        """Hand claim to one idle pod of pool_id that has polled since polled_since, returning its name or None if there is none"""
+        result = await self._run(self._warm_pods_coll.find_one_and_update,
+                                 {'pool_id': pool_id, 'state': 'idle', 'last_poll_time': {'$gte': polled_since}},
+                                 {'$set': {'state': 'claimed', 'claim': claim, 'claim_time': datetime.now()}},
+                                 sort=[('last_poll_time', pymongo.DESCENDING)], projection={'_id': True})
+        return None if result is None else result['_id']
+
+    async def release_warm_pod(self, pod_name: str, state: str) -> bool:
+        """Forget a warm pod, as long as it is still in state - False means it moved on, e.g. it picked up its claim meanwhile"""
+        result = await self._run(self._warm_pods_coll.delete_one, {'_id': pod_name, 'state': state})
+        return result.deleted_count == 1
+
+    async def get_warm_pods(self, states: List[str] = None, pool_id: str = None) -> List[dict]:
+        query_dict = {}
+        if states is not None:
+            query_dict['state'] = {'$in': states}
+        if pool_id is not None:
+            query_dict['pool_id'] = pool_id
+        return await self._run(lambda: list(self._warm_pods_coll.find(query_dict, {'claim': False})))
+
+    async def record_warm_pool_request(self, pool_id: str, hit: bool, pod_body: str, demand_args: Dict[str, Any] = None) -> None:
+        """Count a request against pool_id in its minute bucket - the refill sizes each pool from these.
+        pool_id is a hash of pod_body, so the body stored when the pool is created never goes stale"""
+        now = datetime.now()
+        await self._run(self._warm_pools_coll.update_one, {'_id': pool_id},
+                        {'$inc': {'hits' if hit else 'misses': 1, f"demand.{int(now.timestamp() // 60)}": 1},
+                         '$set': {'last_request_time': now}, '$setOnInsert': {'pod_body': pod_body, 'demand_args': demand_args or {}}}, upsert=True)
+
+    async def get_warm_pools(self) -> List[dict]:
+        return await self._run(lambda: list(self._warm_pools_coll.find({})))
+
+    async def lease_warm_pool_refill(self, pool_id: str, seconds: float) -> bool:
+        """Let one replica at a time refill pool_id, so they do not each create the missing pods"""
+        now = datetime.now()
+        result = await self._run(self._warm_pools_coll.update_one, {'_id': pool_id, '$or': [{'refill_until': {'$lt': now}}, {'refill_until': {'$exists': False}}]},
+                                 {'$set': {'refill_until': now + timedelta(seconds=seconds)}})
+        return result.modified_count == 1
+
+    async def trim_warm_pool(self, pool_id: str, buckets: List[str], remove: bool = False) -> None:
+        """Drop demand buckets that fell out of the window, or the whole pool once nothing asks for it"""
+        if remove:
+            await self._run(self._warm_pools_coll.delete_one, {'_id': pool_id})
+        elif len(buckets) > 0:
+            await self._run(self._warm_pools_coll.update_one, {'_id': pool_id}, {'$unset': {f"demand.{b}": '' for b in buckets}})
+
+
+def _validate_schedule(schedule: str) -> None:
+    # Parsing alone lets through expressions such as 0 0 31 2 * that can never fire
+    CronSchedule(schedule).next_fire(datetime.utcnow())
+
+
+def _encode_history_cursor(received_time: datetime, obj_id: ObjectId) -> str:
+    return f"{received_time.isoformat()}|{obj_id}"
+
+
+def _decode_history_cursor(cursor: str) -> Any:
+    try:
+        received_time, obj_id = cursor.split('|')
+        return datetime.fromisoformat(received_time), ObjectId(obj_id)
+    except Exception:
+        raise QueryException(f"Invalid history cursor={cursor}")
 
 
 class NotFoundError(Exception):
     pass
 
 
-class CollectionLockError(Exception):
+class ExecutionExistsError(Exception):
     pass
 
 
@@ -288,8 +915,8 @@ class QueryException(Exception):
     pass
 
 
-def provider_factory(db_engine: str) -> Any:
+def provider_factory(db_engine: str, cron_provider: K8sCronProvider = None) -> Any:
     if db_engine == 'MongoDbProvider':
-        return MongoDBProvider()
+        return MongoDBProvider(cron_provider=cron_provider)
 
     raise NotImplementedError(f"db_engine={db_engine} not implemented")
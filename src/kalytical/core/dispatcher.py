@@ -1,36 +1,154 @@
 from src.kalytical.core.engine import EngineManager
-from src.kalytical.dispatcher.data_provider import MongoDBProvider
-from src.kalytical.models import LifecycleEventModel, JobLifecycleEventBody, PipelineHeaderModel, RunningPipelineModel
-from src.kalytical.utils.log import get_logger
-from typing import List, Dict
+from src.kalytical.core.data_provider import MongoDBProvider, ExecutionExistsError
+from src.kalytical.models import LifecycleEventModel, JobLifecycleEventBody, PipelineHeaderModel, RunningPipelineModel, IncubatingPipelineModel, EventDispatchResultModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Awaitable, List, Dict
 from uuid import uuid1
 from datetime import datetime
+import asyncio
+import hashlib
+
+kalytical_config = KalyticalConfig()
+
+
+class PipelineLookups():
+    """Memoizes pipeline definition reads for the lifetime of one dispatch batch, so events that share a pipeline share the round trip"""
+
+    def __init__(self, data_provider: MongoDBProvider):
+        self._data_provider = data_provider
+        self._downstream = {}
+        self._headers = {}
+
+    def head_downstream_pipelines(self, pipeline_uuid: str) -> Awaitable[List[PipelineHeaderModel]]:
+        if pipeline_uuid not in self._downstream:
+            self._downstream[pipeline_uuid] = asyncio.ensure_future(
+                self._data_provider.head_downstream_pipelines(pipeline_uuid=pipeline_uuid))
+        return self._downstream[pipeline_uuid]
+
+    def head_pipeline_definition(self, pipeline_uuid: str) -> Awaitable[PipelineHeaderModel]:
+        if pipeline_uuid not in self._headers:
+            self._headers[pipeline_uuid] = asyncio.ensure_future(
+                self._data_provider.head_pipeline_definition(pipeline_uuid=pipeline_uuid))
+        return self._headers[pipeline_uuid]
 
 
 class KDispatcher():
-    def __init__(self):
+    def __init__(self, data_provider: MongoDBProvider = None, engine_mgr: EngineManager = None):
         self.log = get_logger(self.__class__.__name__)
-        self._data_provider = MongoDBProvider()
-        self._engine_mgr = EngineManager()
+        self._data_provider = data_provider if data_provider is not None else MongoDBProvider()
+        self._engine_mgr = engine_mgr if engine_mgr is not None else EngineManager()
         self._job_exec_update_map = {
             'success': self._handle_job_success_event,
             'origination': self._handle_job_origination_event,
-            'failure': self_handle_job_failure_event
+            'failure': self._handle_job_failure_event,
+            'submitted': self._handle_job_progress_event,
+            'running': self._handle_job_progress_event
+        }
+        # Lifecycle event subtypes that move an execution forward in the ledger
+        self._execution_state_map = {
+            'submitted': 'pending',
+            'running': 'running',
+            'success': 'succeeded',
+            'failure': 'failed'
         }
 
     # TODO Generalize to any event
-    async def dispatch(self, lifecycle_event: LifecycleEventModel) -> List(RunningPipelineModel):
+    async def dispatch(self, lifecycle_event: LifecycleEventModel) -> List[RunningPipelineModel]:
         self.log.info(
             f'{lifecycle_event.event_type} event received with event_body={lifecycle_event.event_body}')
-        await self._data_providersave_event_to_history(lifecycle_event)
+        await self._data_provider.save_event_to_history(lifecycle_event)
+        return await self._dispatch_event(lifecycle_event=lifecycle_event, lookups=PipelineLookups(self._data_provider))
+
+    async def dispatch_batch(self, lifecycle_events: List[LifecycleEventModel]) -> List[EventDispatchResultModel]:
+        """Dispatch many events with one history write and shared definition lookups.
+        Events for the same pipeline_uuid are handled in order, different pipelines are handled concurrently"""
+        self.log.info(f"Batch of event_count={len(lifecycle_events)} received")
+        await self._data_provider.save_events_to_history(lifecycle_events)
+        lookups = PipelineLookups(self._data_provider)
+        semaphore = asyncio.Semaphore(kalytical_config.dispatch_batch_max_concurrency)
+        results = [None] * len(lifecycle_events)
+
+        by_pipeline = {}
+        for index, lifecycle_event in enumerate(lifecycle_events):
+            by_pipeline.setdefault(lifecycle_event.event_body.pipeline_uuid, []).append(index)
+
+        async def dispatch_in_order(indexes: List[int]):
+            for index in indexes:
+                async with semaphore:
+                    try:
+                        submitted = await self._dispatch_event(lifecycle_event=lifecycle_events[index], lookups=lookups)
+                        # Deferred runs come back as a message rather than a running pipeline
+                        results[index] = EventDispatchResultModel(index=index, dispatched=True,
+                                                                  submitted=[e for e in submitted if isinstance(e, RunningPipelineModel)])
+                    except Exception as e:
+                        self.log.exception(f"Could not dispatch event index={index} of batch")
+                        results[index] = EventDispatchResultModel(index=index, dispatched=False, error=str(e))
+
+        await asyncio.gather(*[dispatch_in_order(indexes) for indexes in by_pipeline.values()])
+        return results
+
+    async def _dispatch_event(self, lifecycle_event: LifecycleEventModel, lookups: PipelineLookups) -> List[RunningPipelineModel]:
         if lifecycle_event.event_type == 'job_exec_update' and lifecycle_event.event_body.event_subtype in self._job_exec_update_map.keys():
-            return await self._job_exec_update_map[lifecycle_event.event_body.event_subtype](event_body=lifecycle_event.event_body)
+            event_body = lifecycle_event.event_body
+            if event_body.exec_uuid is not None and event_body.event_subtype in self._execution_state_map:
+                await self._data_provider.update_execution(exec_uuid=event_body.exec_uuid, pipeline_uuid=event_body.pipeline_uuid,
+                                                           state=self._execution_state_map[event_body.event_subtype])
+            woken = []
+            try:
+                submitted = await self._job_exec_update_map[event_body.event_subtype](event_body=event_body, lookups=lookups)
+            finally:
+                if event_body.event_subtype in ['success', 'failure']:
+                    woken = await self.wake_released_scopes(pipeline_uuid=event_body.pipeline_uuid, lookups=lookups)
+            return submitted + woken
+
+        raise NotImplementedError(
+            f"Unknown event_type={lifecycle_event.event_type} and event_subtype={lifecycle_event.event_body.event_subtype}")
+
+    async def wake_released_scopes(self, pipeline_uuid: str, lookups: PipelineLookups) -> List[RunningPipelineModel]:
+        """A finished run gives back a slot under its pipeline, each of its tags and the global cap. Hand them to the runs
+        deferred on any of those, the finished pipeline's own first and then other pipelines' oldest first"""
+        header_model = await lookups.head_pipeline_definition(pipeline_uuid=pipeline_uuid)
+        woken = await self.wake_deferred_runs(pipeline_uuid=pipeline_uuid, lookups=lookups)
+        # A deleted pipeline's tags are gone with it, but its run still counted against the global cap
+        released = self.concurrency_limits(header_model=header_model) if header_model is not None else (
+            {'global': kalytical_config.global_max_concurrency} if kalytical_config.global_max_concurrency is not None else {})
+        released.pop(f"pipeline:{pipeline_uuid}", None)
+        if len(released) == 0:
+            return woken
+        for deferred_uuid in await self._data_provider.list_deferred_pipelines():
+            if not any([await self._data_provider.has_free_slots(limits={slot_key: cap}) for slot_key, cap in released.items()]):
+                break
+            deferred_header = await lookups.head_pipeline_definition(pipeline_uuid=deferred_uuid)
+            if deferred_uuid == pipeline_uuid or deferred_header is None or released.keys().isdisjoint(self.concurrency_limits(header_model=deferred_header)):
+                continue
+            woken.extend(await self.wake_deferred_runs(pipeline_uuid=deferred_uuid, lookups=lookups))
+        return woken
+
+    async def wake_deferred_runs(self, pipeline_uuid: str, lookups: PipelineLookups = None) -> List[RunningPipelineModel]:
+        """Submit runs deferred on concurrency for pipeline_uuid, oldest first, for as long as there is capacity"""
+        lookups = lookups if lookups is not None else PipelineLookups(self._data_provider)
+        header_model = await lookups.head_pipeline_definition(pipeline_uuid=pipeline_uuid)
+        submitted = []
+        while header_model is not None and await self.has_capacity(header_model=header_model):
+            deferred = await self._data_provider.pop_deferred_run(pipeline_uuid=pipeline_uuid)
+            if deferred is None:
+                break
+            self.log.info(f"Waking run deferred since create_time={deferred.create_time} for pipeline_uuid={pipeline_uuid}")
+            result = await self.queue_pipeline(header_model=header_model, retry_count=deferred.retry_count, source_uuids=deferred.source_uuids,
+                                               deferred_since=deferred.create_time, exec_uuid=deferred.exec_uuid)
+            if not isinstance(result, RunningPipelineModel):
+                # Another dispatch took the slot first - the run went back in at its original position
+                break
+            submitted.append(result)
+        return submitted
 
-        raise NotImplementedError(f"Unknown event_type={event.event_type} and event_subtype={lifecycle_event.event_type.event_subtype")
+    async def _handle_job_progress_event(self, event_body: JobLifecycleEventBody, lookups: PipelineLookups) -> List[RunningPipelineModel]:
+        # Nothing to schedule - the ledger update in _dispatch_event is all these events are for
+        return []
 
-    async def _handle_job_success_event(self, event_body: JobLifecycleEventBody) -> List[RunningPipelineModel]:
+    async def _handle_job_success_event(self, event_body: JobLifecycleEventBody, lookups: PipelineLookups) -> List[RunningPipelineModel]:
         submitted = []
-        header_models = await self._data_provider.head_downstream_pipelines(pipeline_uuid=event_body.pipeline_uuid)
+        header_models = await lookups.head_downstream_pipelines(pipeline_uuid=event_body.pipeline_uuid)
 
         if len(header_models) == 0:
             self.log.info(
@@ -39,15 +157,59 @@ class KDispatcher():
         self.log.info(f"Found candidate pipelines to schedule={header_models}")
         for header_model in header_models:
             if(header_model.triggers_on is None) or ((header_model.triggers_on.operator == 'any') or ((header_model.triggers_on.operator == 'all') and (len(header_model.triggers_on.pipeline_uuids) == 1))):
-                submitted.append(await self.queue_pipeline(source_uuids={event_body.pipeline_uuid: event_body.exec_uuid}, header_model=header_model))
+                # Derived from the finished run, so a redelivered success event finds this run already in the ledger
+                exec_uuid = derive_exec_uuid(event_body.exec_uuid, header_model.pipeline_uuid) if event_body.exec_uuid is not None else None
+                submitted.append(await self.queue_pipeline(source_uuids={event_body.pipeline_uuid: event_body.exec_uuid}, header_model=header_model,
+                                                           exec_uuid=exec_uuid))
             else:
-                self._data_provider.update_incubating_jobs(
-                    trigger_pipeline_uuid=event_body.pipeline_uuid, header_model=header_model, source_uuid=event_body.exec_uuid)
+                submitted.extend(await self._fan_in(event_body=event_body, header_model=header_model))
         return submitted
 
-    async def _handle_job_failure_event(self, event_body: JobLifecycleEventBody) -> List[RunningPipelineModel]:
-        header_model = await self._data_provider.head_pipeline_definition(pipeline_uuid=event_body.pipeline_uuid)
-        await self._data_provider.save_event_to_history(LifecycleEventModel(event_type='job_exec_update', event_body=event_body))
+    async def _fan_in(self, event_body: JobLifecycleEventBody, header_model: PipelineHeaderModel) -> List[RunningPipelineModel]:
+        """Count this success towards a dependency run of header_model, once per exec_uuid however often the event is delivered"""
+        if event_body.exec_uuid is not None and not await self._data_provider.claim_fanout(exec_uuid=event_body.exec_uuid, pipeline_uuid=header_model.pipeline_uuid):
+            self.log.info(f"exec_uuid={event_body.exec_uuid} was already counted towards pipeline_uuid={header_model.pipeline_uuid}. Nothing to do!")
+            return []
+        try:
+            incubating = await self._data_provider.update_incubating_jobs(
+                trigger_pipeline_uuid=event_body.pipeline_uuid, header_model=header_model, source_uuid=event_body.exec_uuid)
+            return await self.resolve_incubation(incubating=incubating, header_model=header_model)
+        except Exception:
+            # Uncounted again, so the redelivered event counts this success and retries the launch
+            if event_body.exec_uuid is not None:
+                await self._data_provider.release_fanout(exec_uuid=event_body.exec_uuid, pipeline_uuid=header_model.pipeline_uuid)
+            raise
+
+    async def resolve_incubation(self, incubating: IncubatingPipelineModel, header_model: PipelineHeaderModel = None,
+                                 stale_before: datetime = None) -> List[RunningPipelineModel]:
+        """Launch a dependency run once none of its triggers are waiting. Safe to call from every replica - only the one that claims the run queues it.
+        The run is only removed once it is queued; if the launch fails it is restored for the next attempt"""
+        if not incubating.is_satisfied():
+            return []
+        if await self._data_provider.claim_incubating_pipeline(obj_id=incubating.obj_id, version=incubating.version, stale_before=stale_before) is None:
+            self.log.debug(
+                f"Incubating run obj_id={incubating.obj_id} was already claimed or has changed since version={incubating.version}")
+            return []
+        self.log.info(
+            f"All dependencies satisfied for pipeline_uuid={incubating.pipeline_uuid} with triggers={incubating.triggers}")
+        try:
+            if header_model is None:
+                header_model = await self._data_provider.head_pipeline_definition(pipeline_uuid=incubating.pipeline_uuid)
+            # Derived from the run, so launching it again after a failure or a crash finds the first attempt in the ledger
+            submitted = await self.queue_pipeline(header_model=header_model, retry_count=0, source_uuids=incubating.triggers,
+                                                  exec_uuid=derive_exec_uuid(incubating.obj_id, incubating.pipeline_uuid))
+        except Exception:
+            await self._data_provider.restore_incubating_pipeline(obj_id=incubating.obj_id)
+            raise
+        await self._data_provider.delete_incubating_pipeline(obj_id=incubating.obj_id)
+        return [submitted]
+
+    async def _handle_job_failure_event(self, event_body: JobLifecycleEventBody, lookups: PipelineLookups) -> List[RunningPipelineModel]:
+        header_model = await lookups.head_pipeline_definition(pipeline_uuid=event_body.pipeline_uuid)
+        if header_model is None:
+            self.log.warning(
+                f"Failure event for pipeline_uuid={event_body.pipeline_uuid} received, but it does not exist. Nothing to retry!")
+            return []
         if int(event_body.retry_count) >= int(header_model.retry_max):
             raise MaxPipelineRetryReachedException(
                 f"pipeline_uuid={event_body.pipeline_uuid} has reached maximum retry_count. Current retry_count={event_body.retry_count}")
@@ -55,29 +217,48 @@ class KDispatcher():
             next_retry_count = int(event_body.retry_count) + 1
             self.log.warning(
                 f"This is an attempt to retry a pipeline. New retry_count={next_retry_count}")
-        return [await self.queue_pipeline(header_model=header_model, source_uuids={event_body.pipeline_uuid: event_body.exec_uuid}, retry_count=next_retry_count)]
+        exec_uuid = derive_exec_uuid(event_body.exec_uuid, header_model.pipeline_uuid, str(next_retry_count)) if event_body.exec_uuid is not None else None
+        return [await self.queue_pipeline(header_model=header_model, source_uuids={event_body.pipeline_uuid: event_body.exec_uuid}, retry_count=next_retry_count,
+                                          exec_uuid=exec_uuid)]
 
-    async def _handle_job_origination_event(self, event_body: JobLifecycleEventBody) -> List[RunningPipelineModel]:
-        header_model = await self._data_provider.head_pipeline_definition(pipeline_uuid=event_body.pipeline_uuid)
+    async def _handle_job_origination_event(self, event_body: JobLifecycleEventBody, lookups: PipelineLookups) -> List[RunningPipelineModel]:
+        header_model = await lookups.head_pipeline_definition(pipeline_uuid=event_body.pipeline_uuid)
 
         self.log.info(f"Found candidate_dict={header_model}")
         if header_model is None:
             self.log.warning(
                 f"Origination event for pipeline_uuid={event_body.pipeline_uuid} received, but it does not exist. Nothing to do!")
             return []
-        return [await self.queue_pipeline(source_uuids={}, header_model=header_model)]
+        exec_uuid = derive_exec_uuid(event_body.exec_uuid, header_model.pipeline_uuid) if event_body.exec_uuid is not None else None
+        return [await self.queue_pipeline(source_uuids={}, header_model=header_model, exec_uuid=exec_uuid)]
 
-    async def queue_pipeline(self, header_model: PipelineHeader_model, retry_count: int = 0, source_uuids: Dict[str, str] = None) -> RunningPipelineModel:
-        if not header_model.concurrency and await self._check_concurrency(pipeline_uuid=header_model.piipeline_uuid):
+    async def queue_pipeline(self, header_model: PipelineHeaderModel, retry_count: int = 0, source_uuids: Dict[str, str] = None, deferred_since: datetime = None,
+                             exec_uuid: str = None) -> RunningPipelineModel:
+        """Submit a run of header_model. A run is submitted once per exec_uuid - queueing an exec_uuid that is already in
+        the ledger, as a redelivered event does, returns that execution instead"""
+        new_exec_uuid = exec_uuid if exec_uuid is not None else gen_uuid()
+        # Slots are taken before the pod exists, so concurrent dispatches can never overshoot a cap
+        try:
+            acquired = await self._data_provider.acquire_execution_slots(exec_uuid=new_exec_uuid, pipeline_uuid=header_model.pipeline_uuid,
+                                                                         limits=self.concurrency_limits(header_model=header_model), fields={'engine': header_model.engine})
+        except ExecutionExistsError:
+            self.log.info(f"exec_uuid={new_exec_uuid} of pipeline_uuid={header_model.pipeline_uuid} was already submitted. Nothing to do!")
+            return (await self._data_provider.get_executions(exec_uuid=new_exec_uuid, limit=1))[0]
+        if not acquired:
             self.log.warning(
-                f"Attempted to schedule pipeline_uuid{header_model.pipeline_u9uid} but failed concurrency check. Deferring request to run job until excisting pipeline_uuid={header_model.pipelin_uuid} has completed.")
-            self._data_provider.defer_job(pipeline_uuid=header_model.pipeline_uuid, created_by_uuid=source_uuids,
-                                          reason='concurrency', trigger_model=None, retry_count=retry_count)
+                f"Attempted to schedule pipeline_uuid={header_model.pipeline_uuid} but it is at its concurrency limit. Deferring request to run job until a running pipeline_uuid={header_model.pipeline_uuid} has completed.")
+            await self._data_provider.defer_job(pipeline_uuid=header_model.pipeline_uuid, source_uuids=source_uuids, reason='concurrency', trigger_model=None,
+                                                retry_count=retry_count, create_time=deferred_since, exec_uuid=new_exec_uuid)
             return "This job was deferred as it would collide with another pipeline. It will be retried."
 
-        new_exec_uuid = gen_uuid()
-
-        submitted_job = await self._engine_mgr.submit_job(header_model=header_model, exec_uuid=new_exec_uuid, source_uuid=source_uuids, retry_count=retry_count)
+        try:
+            submitted_job = await self._engine_mgr.submit_job(header_model=header_model, exec_uuid=new_exec_uuid, source_uuid=source_uuids, retry_count=retry_count)
+        except Exception:
+            await self._data_provider.update_execution(exec_uuid=new_exec_uuid, pipeline_uuid=header_model.pipeline_uuid, state='failed')
+            raise
+        await self._data_provider.update_execution(exec_uuid=new_exec_uuid, pipeline_uuid=header_model.pipeline_uuid, state='pending',
+                                                   fields={'engine_tracking_id': submitted_job.engine_tracking_id, 'start_time': submitted_job.start_time,
+                                                           'owner_host': submitted_job.owner_host})
         # Create history event
         event_body = JobLifecycleEventBody(exec_uuid=submitted_job.exec_uuid, source_uuids=source_uuids,
                                            pipeline_uuid=submitted_job.pipeline_uuid, retry_count=retry_count, event_time=datetime.now(), event_subtype='submitted')
@@ -85,20 +266,31 @@ class KDispatcher():
 
         return submitted_job
 
-    async def _check_concurrency(self, pipeline_uuid: str) -> bool:
-        running_jobs = await self._engine_mgr.get_filtered_jobs(status=['running', 'pending'])
-        running_pipeline_uuids = map(lambda x: x.pipeline_uuid, running_jobs)
+    def concurrency_limits(self, header_model: PipelineHeaderModel) -> Dict[str, int]:
+        """Every cap a run of header_model counts against, keyed by the slot counter that enforces it"""
+        limits = {}
+        if header_model.effective_max_concurrency() is not None:
+            limits[f"pipeline:{header_model.pipeline_uuid}"] = header_model.effective_max_concurrency()
+        for tag_key, tag_value in (header_model.tags or {}).items():
+            tag = f"{tag_key}={tag_value}"
+            if tag in kalytical_config.tag_max_concurrency:
+                limits[f"tag:{tag}"] = kalytical_config.tag_max_concurrency[tag]
+        if kalytical_config.global_max_concurrency is not None:
+            limits['global'] = kalytical_config.global_max_concurrency
+        return limits
 
-        if pipeline_uuid in running_pipeline_uuids:
-            self.log.warning(
-                f"Concurrency for pipeline_uuid={pipeline_uuid} is not supported!")
-            return True
-        return False
+    async def has_capacity(self, header_model: PipelineHeaderModel) -> bool:
+        return await self._data_provider.has_free_slots(limits=self.concurrency_limits(header_model=header_model))
 
 
 def gen_uuid() -> str:
     return str(uuid1())[:8]
 
 
+def derive_exec_uuid(*parts: str) -> str:
+    """An exec_uuid shaped like gen_uuid, but the same every time it is derived from the same parts"""
+    return hashlib.sha1(':'.join(parts).encode()).hexdigest()[:8]
+
+
 class MaxPipelineRetryReachedException(Exception):
     pass
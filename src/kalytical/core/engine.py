@@ -1,201 +1,435 @@
 from fastapi import HTTPException
 from kubernetes import client
-from kubernetes.client.models.v1_env_var import V1EnvVar
-from src.kalytical.models import PipelineHeaderModel, RunningPipelineModel
-from typing import List, Any
-from src.kalytical.utils.log import get_logger
+from kubernetes.client.exceptions import ApiException
+from src.kalytical.models import PipelineHeaderModel, RunningPipelineModel, JobQueryModel, JobPageModel, LifecycleEventModel, JobLifecycleEventBody
+from typing import AsyncIterator, Awaitable, Callable, List, Any
+from src.kalytical.utils import get_logger
 from src.kalytical.utils.config import KalyticalConfig
+from src.kalytical.core.abstract_engine import AbstractEngine
+from src.kalytical.core.k8s_client import AsyncK8sClient
+from src.kalytical.core.data_provider import MongoDBProvider
+from src.kalytical.core.local_engine import LocalProcessEngine
+from src.kalytical.core.warm_pool import WarmPodPool
+from src.kalytical.core.pod_informer import PodInformer
+from src.kalytical.core.pod_template import PodTemplate, run_pod_name
+from src.kalytical.core.submission_scheduler import SubmissionScheduler
 from kubernetes.config.config_exception import ConfigException
-from kubernetes import config
-import abc
+from cachetools import LRUCache
+import asyncio
 import json
+from datetime import datetime
 
 kalytical_config = KalyticalConfig()
 
 
-class AbstractEngine(abc.AbstractClass):
-    # Can represent a particular processing engine implementation - either serverless, or Kubernetes pod
-    pass
-
-
 class EngineManager():
     # TODO will be autoconfigured via self reflection of AbstractEngine instances
-    _engine_dict = {}
-    _engines = ['K8sPodEngine']
+    _engines = ['K8sPodEngine', 'K8sIndexedJobEngine', 'LocalProcessEngine']
 
-    def __init__(self):
+    def __init__(self, k8s_client: AsyncK8sClient = None, data_provider: MongoDBProvider = None):
         self.log = get_logger(self.__class__.__name__)
+        self._k8s_client = k8s_client if k8s_client is not None else AsyncK8sClient()
+        self._scheduler = SubmissionScheduler(
+            k8s_client=self._k8s_client, namespace=kalytical_config.k8spodengine_k8s_namespace)
+        # Warm pods hand runs over through claim records, so there is no pool without a data provider
+        self._warm_pool = WarmPodPool(k8s_client=self._k8s_client, data_provider=data_provider, namespace=kalytical_config.k8spodengine_k8s_namespace,
+                                      scheduler=self._scheduler) if data_provider is not None else None
+        self._engine_dict = {}
         for e in self._engines:
+            if e == 'LocalProcessEngine' and not kalytical_config.local_engine_enabled:
+                continue
             self._engine_dict[e] = self.engine_factory(e)
 
     def engine_factory(self, engine_type: str) -> Any:
         if engine_type == 'K8sPodEngine':
-            return K8sPodEngine()
+            return K8sPodEngine(k8s_client=self._k8s_client, warm_pool=self._warm_pool)
+        if engine_type == 'K8sIndexedJobEngine':
+            return K8sIndexedJobEngine(k8s_client=self._k8s_client)
+        if engine_type == 'LocalProcessEngine':
+            return LocalProcessEngine()
 
         raise NotImplementedError(
             f"This particular engine={engine_type} has not been implemented")
 
-    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> None:
+    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
         marshalled_request = {"header_model": header_model}
         marshalled_request['exec_uuid'] = exec_uuid
         marshalled_request['source_uuid'] = source_uuid
         marshalled_request['retry_count'] = retry_count
         # TODO CLeaner way to handle marshalled request - maybe pydantic? or just pass parameters in
-        return await self._engine_dict[header_model.engine].submit_job(**marshalled_request)
-
-    async def get_filtered_jobs(self, status: List[str] = None, engine_namel: str = None, limit: int = 10, pipeline_uuid: str = None) -> Liast[RunningPipelineModel]:
+        if header_model.engine not in self._engine_dict:
+            raise NotImplementedError(
+                f"pipeline_uuid={header_model.pipeline_uuid} needs engine={header_model.engine}, which is not enabled")
+        engine = self._engine_dict[header_model.engine]
+        if not engine.runs_on_cluster:
+            # The scheduler paces the API server and admits against the namespace quota - neither applies here
+            return await engine.submit_job(**marshalled_request)
+        return await self._scheduler.submit(header_model=header_model, submit=lambda: engine.submit_job(**marshalled_request),
+                                            read_existing=lambda: engine.read_submitted_job(**marshalled_request))
+
+    def set_event_sink(self, event_sink: Callable[[LifecycleEventModel], Awaitable]) -> None:
+        """Where engines publish lifecycle events they raise themselves, rather than leaving it to the job"""
+        for engine in self._engine_dict.values():
+            engine.set_event_sink(event_sink)
+
+    def submission_stats(self) -> dict:
+        return self._scheduler.stats()
+
+    async def warm_pool_stats(self) -> dict:
+        return await self._warm_pool.stats() if self._warm_pool is not None else {}
+
+    async def get_filtered_jobs(self, status: List[str] = None, engine_name: str = None, limit: int = 10, pipeline_uuid: str = None) -> List[RunningPipelineModel]:
         """Query the job list from initialized processing engine(s)"""
+        query = JobQueryModel(engine_status=status,
+                              pipeline_uuid=pipeline_uuid, limit=limit)
         pipeline_list = []
-        if engine_name is None:
-            for engine in list(self._engine_dict.values()):
-                pipeline_list.extend(await engine.get_jobs(limit=limit))
-        else:
-            # TODO ALl of this filtering logic is expensive and broken - it should figureout what it should do first and then execute only one query
-            pipeline_list = await self._engine_dict[engine_name].get_jobs(limit=limit)
-        if status is not None:
-            pipeline_list = list(
-                filter(lambda p: p.engine_status in status, pipeline_list))
-        # Push down whatever filters we can to the engine? Not all engines will support the same filtering, though
-        if pipeline_uuid is not None:
-            pipeline_list = list(
-                filter(lambda p: p.pipeline_uuid == pipeline_uuid, pipeline_list))
-        return pipeline_list[:limit]
+        job_stream = self.iter_filtered_jobs(query=query, engine_name=engine_name)
+        try:
+            async for job in job_stream:
+                pipeline_list.append(job)
+                if limit is not None and len(pipeline_list) >= limit:
+                    break
+        finally:
+            await job_stream.aclose()
+        return pipeline_list
+
+    async def iter_filtered_jobs(self, query: JobQueryModel, engine_name: str = None) -> AsyncIterator[RunningPipelineModel]:
+        """Push the query down to every engine concurrently and yield jobs as each engine answers"""
+        engines = list(self._engine_dict.values()) if engine_name is None else [
+            self._engine_dict[engine_name]]
+        pending = [asyncio.ensure_future(engine.query_jobs(query=query)) for engine in engines]
+        try:
+            for next_page in asyncio.as_completed(pending):
+                page = await next_page
+                for job in page.jobs:
+                    yield job
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def query_jobs(self, engine_name: str, query: JobQueryModel) -> JobPageModel:
+        """A single page from one engine - continue_token is only meaningful to the engine that issued it"""
+        return await self._engine_dict[engine_name].query_jobs(query=query)
 
     async def abort_pipeline(self, engine_name: str, engine_tracking_id: str) -> dict:
         return await self._engine_dict[engine_name].abort_pipeline(engine_tracking_id=engine_tracking_id)
 
+    async def get_job_logs(self, engine_name: str, engine_tracking_id: str, max_kb: int, from_beginning: bool = False) -> str:
+        return await self._engine_dict[engine_name].get_job_logs(engine_tracking_id=engine_tracking_id, max_kb=max_kb, from_beginning=from_beginning)
+
+    def start(self) -> None:
+        self._scheduler.start()
+        if self._warm_pool is not None:
+            self._warm_pool.start()
+        for engine in self._engine_dict.values():
+            engine.start()
+
+    def shutdown(self) -> None:
+        self._scheduler.shutdown()
+        if self._warm_pool is not None:
+            self._warm_pool.shutdown()
+        for engine in self._engine_dict.values():
+            engine.shutdown()
 
-class K8sJobEngine():
 
-    def __init__(self):
-        self.log = get_logger(self.__class_name.__name__)
+class K8sJobEngine(AbstractEngine):
+    _label_selector = 'pod_source=kalytical'
+    _pod_phases = ['Pending', 'Running', 'Succeeded', 'Failed', 'Unknown']
+    _cache_token_prefix = 'cache:'
+
+    def __init__(self, k8s_client: AsyncK8sClient = None, warm_pool: WarmPodPool = None):
+        self.log = get_logger(self.__class__.__name__)
         if kalytical_config.kalytical_endpoint is None:
             # This is the API endpoint we send back to the pod for a callback/interaction during pipeline running. It may be behind a load balancer/DNS - i.e. it can't communicate with local host)
             raise ConfigException(
                 "Config is missing parameter for kalytical API endpoint!")
-        try:
-            # Defaults to the service account asssigned to th epod
-            config.load_incluster_config()
-        except CDonfigException:
-            self.log.warn(
-                f"Could not load kube configuration from pod! Attempting to configure client with local kubeconfig={config.KUBE_CONFIG_DEFAULT_LOCATION}")
-            config.load_kube_config()
-        self._k8s_core_client = client.CoreV1Api()
+        self._k8s = k8s_client if k8s_client is not None else AsyncK8sClient()
+        self._k8s_core_client = self._k8s.core_v1
 
-        self.log = get_logger(self. __class__.__name__)
-        self._running_job_list = None
+        self._pod_informer = PodInformer(core_client=self._k8s_core_client, namespace=kalytical_config.k8spodengine_k8s_namespace,
+                                         label_selector=self._label_selector, unmarshall=self.unmarshall_pod)
+        # Keyed by (pipeline_uuid, version) - an updated pipeline gets a new template and the old one ages out
+        self._pod_templates = LRUCache(maxsize=kalytical_config.pod_template_cache_maxsize)
+        self._event_sink = None
+        self._warm_pool = warm_pool
 
-    @staticmethod
-    def _get_default_container_args() -> list:
-        return kalytical_config.k8spodengine_default_container_args
+    def set_event_sink(self, event_sink: Callable[[LifecycleEventModel], Awaitable]) -> None:
+        self._event_sink = event_sink
 
-    @staticmethod
-    def _get_default_container_uri() -> str:
-        return kalytical_config.default_pipeline_image_uri
+    def start(self) -> None:
+        self._pod_informer.start()
+
+    def shutdown(self) -> None:
+        self._pod_informer.shutdown()
 
     async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        if self._warm_pool is not None and header_model.engine_args.get('warm_pool', False):
+            warm_pod = await self._warm_pool.claim(header_model=header_model, template=self._get_pod_template(header_model=header_model),
+                                                   exec_uuid=exec_uuid, source_uuid=source_uuid, retry_count=retry_count)
+            if warm_pod is not None:
+                return self.unmarshall_pod(pod_obj=warm_pod)
         self.log.info(
             f"Attempting to submit pod for pipeline_uuid={header_model.pipeline_uuid}")
         job_pod = self.marshall_k8s_pod(
             header_model=header_model, exec_uuid=exec_uuid, source_uuid=source_uuid, retry_count=retry_count)
-        # TODO Handle cases where pod create fails - i.e. resource starvation
-        pod_resp = self._k8s_core_client.create_namespaced_pod(
-            namespace=kalytical_config.k8spodengine_k8s_namespace, body=job_pod)
+        # Quota admission, rate limiting and retries on throttling are handled by the SubmissionScheduler in front of this
+        pod_resp = await self._k8s.call(self._k8s_core_client.create_namespaced_pod,
+                                        namespace=kalytical_config.k8spodengine_k8s_namespace, body=job_pod)
 
         return self.unmarshall_pod(pod_obj=pod_resp)
 
-    async def marshall_+k8s_pod(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) 0 > client.V1Pod():
-        common_job_name = '-'.join(exec_uuid,
-                                   header_model.pipeline_uuid, str(retry_count))
-        if 'pipeline_args' in header_model.engine_args.keys():
-            pipeline_args = header_model.engine_args['pipeline_args']
-        else:
-            pipeline_args = self._get_default_engine_args()
-
-        if 'pipeline_command' in header_model.engine_args.keys():
-            pipeline_command = header_model.engine_args['pipeline_command']
-        else:
-            pipeline_command = self._get_default_container_command()
-
-        if 'pipeline_image' in header_model.engine_args.keys():
-            pipeline_image = header_model.engine_args['pipeline_image']
-        else:
-            pipeline_image = self._get_default_container_uri()
-
-        container_spec = client.V1Container(
-            name=common_job_name,
-            image=pipeline_image,
-            args=pipeline_args,
-            command=pipeline_command,
-            env=[
-                client.V1EnvVar(name="PIPELINE_UUID",
-                                value=header_model.pipeline_uuid),
-                client.V1EnvVar(name="SOURCE_UUID", value=json.dumps(
-                    json.dumps(source_uuid))),
-                client.V1EnvVar(name="EXEC_UUID", value=exec_uuid),
-                client.V1EnvVar(name="RETRY_COUNT", value=str(retry_count)),
-                client.V1EnvVar(name="MQ_CALLBACK_URL",
-                                value=kalytical_config.mq_url),
-                client.V1EnvVar(name="KALYTICAL_AUTH_SECRET",
-                                value=kalytical_config.api_secret),
-                client.V1EnvVar(name="KALYTICAL_API_ENDPOINT",
-                                value=kalytical_config.api_endpoint)
-
-            ],
-
-            resources=client.V1ResourceRequirements(
-                limit={'cpu': header_model.engine_args['cpu_count'], 'memory': header_model.engine_args['memory_gi']}),
-            pod_spec=client.V1PodSpec(service_account_name=kalytical_config.k8spodengine_svc_account_name, node_selector={"kalkytical.k8s.node/workload": pipeline, "beta.kubernetes.io/instance-type": header_model.engine_args['instance_type']}, tolerations[client.V1Toleration(key="node.kubernetes.io/pipeline", operator="Exists", effect='NoSchedule')], security_context=client.V1PodSecurityContext(fs_group=100), restart_policy=Never, container=[container_spec])
-            # TODO TOlerations and selectors might not work for a generic use case
-            return client.V1Pod(spec=pod_spec, metadata=client.V1ObjectMeta(name=common_job_name, label{"pod_source": "kalytical", "exec_uuid": exec_uuid, "pipeline_uuid": header_model.pipeline_uuid})))
+    async def read_submitted_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        """The pod an earlier submit_job of this run created"""
+        pod = await self._k8s.call(self._k8s_core_client.read_namespaced_pod, namespace=kalytical_config.k8spodengine_k8s_namespace,
+                                   name=run_pod_name(exec_uuid=exec_uuid, pipeline_uuid=header_model.pipeline_uuid, retry_count=retry_count))
+        return self.unmarshall_pod(pod_obj=pod)
+
+    def marshall_k8s_pod(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> dict:
+        return self._get_pod_template(header_model=header_model).render(exec_uuid=exec_uuid, retry_count=retry_count, source_uuid=source_uuid)
+
+    def _get_pod_template(self, header_model: PipelineHeaderModel) -> PodTemplate:
+        if header_model.version is None:
+            # Single use pipelines are never stored, so there is no version to key them by
+            return self._compile_pod_template(header_model=header_model)
+        key = (header_model.pipeline_uuid, header_model.version)
+        template = self._pod_templates.get(key)
+        if template is None:
+            template = self._pod_templates[key] = self._compile_pod_template(header_model=header_model)
+        return template
+
+    def _compile_pod_template(self, header_model: PipelineHeaderModel) -> PodTemplate:
+        return PodTemplate(header_model=header_model)
 
     async def get_job_logs(self, engine_tracking_id: str, max_kb: int, from_beginning: bool = False) -> str:
         try:
-            request_dict = {"name": engine_tracking_id, "namespace": kalytical_config.k8s_namespace, "limit_bytes": max_kb = 1024}
+            request_dict = {"name": engine_tracking_id, "namespace": kalytical_config.k8spodengine_k8s_namespace, "limit_bytes": max_kb * 1024}
             if from_beginning:
-                request_dict'tail_lines']= 999
-            return self._k8s_core_client.read_namespaced_pod_log(name=engine_tracking_id, namespace=kalytical_config.k8spodengine_k8s_namespace, limit_bytes=(max_kb*1024))
+                request_dict['tail_lines'] = 999
+            return await self._k8s.call(self._k8s_core_client.read_namespaced_pod_log, **request_dict)
         except Exception as e:
             self.log.exception(
                 f"There was a problem retrieving logs for k8s_pod={engine_tracking_id}")
 
     async def abort_pipeline(self, engine_tracking_id: str) -> dict:
         try:
-            self._k8s_core_client.delete_namespaced_pod(
-                name = engine_tracking_id, namespace = kalytical_config.k8spodengine_k8s_namespace)
+            await self._k8s.call(self._k8s_core_client.delete_namespaced_pod,
+                                 name=engine_tracking_id, namespace=kalytical_config.k8spodengine_k8s_namespace)
             return {'resuilt': 'true'}
         except client.exceptions.ApiException as e:
             raise HTTPException(
                 status_code = 404, detail = "An attempt was made on this jobs life, but it is not here...")
 
-    async def get_jobs(self, limit: int = None) -> List[RunningPipelineModel]:
-        if self._running_job_list is not None:
-            return self._running_job_list
-
-        # TODO Filter for pods which match the pipeline app label to avoid this logic - this is broken in the kubernetes ptyon library
-        # https://github.com/kubernetes-client/python/issues/1559
-        pod_list=self._k8s_core_client.list)namnespaced_pod(namespace=kalytical_config.k8spodengine_k8s_namespace)
-        self._running_job_list=[self.unmarshall_pod(pod_obj =e) for e in filter(
-            lambda x: 'pipeline_uuid' in x.metadta.labels.keys(), pod_list.items)]
-        return self._running_job_list
-
-    def marshall_pod(self, pod_obj: client.V1PodSpec) -> RunningPipelineModel:
+    async def get_jobs(self, limit: int = None, pipeline_uuid: str = None, exec_uuid: str = None, engine_status: List[str] = None) -> List[RunningPipelineModel]:
+        page = await self.query_jobs(query=JobQueryModel(limit=limit, pipeline_uuid=pipeline_uuid, exec_uuid=exec_uuid, engine_status=engine_status))
+        return page.jobs
+
+    async def query_jobs(self, query: JobQueryModel) -> JobPageModel:
+        if query.continue_token is None or query.continue_token.startswith(self._cache_token_prefix):
+            if self._pod_informer.has_synced:
+                return self._query_informer(query=query)
+        # The informer has not finished its first LIST yet (or the caller is paging an API listing) - issue one narrow LIST
+        pod_list = await self._k8s.call(self._k8s_core_client.list_namespaced_pod,
+                                        namespace=kalytical_config.k8spodengine_k8s_namespace, **self._to_list_kwargs(query=query))
+        return JobPageModel(jobs=[self.unmarshall_pod(pod_obj=e) for e in pod_list.items], continue_token=pod_list.metadata._continue)
+
+    def _query_informer(self, query: JobQueryModel) -> JobPageModel:
+        job_list = sorted(self._pod_informer.get_jobs(pipeline_uuid=query.pipeline_uuid, exec_uuid=query.exec_uuid,
+                                                      engine_status=query.engine_status), key=lambda j: j.engine_tracking_id)
+        offset = 0 if query.continue_token is None else int(
+            query.continue_token[len(self._cache_token_prefix):])
+        if query.limit is None:
+            return JobPageModel(jobs=job_list[offset:])
+        next_offset = offset + query.limit
+        continue_token = f"{self._cache_token_prefix}{next_offset}" if next_offset < len(job_list) else None
+        return JobPageModel(jobs=job_list[offset:next_offset], continue_token=continue_token)
+
+    def _to_list_kwargs(self, query: JobQueryModel) -> dict:
+        """Translate a query into label and field selectors so the API server does the filtering"""
+        label_selectors = [self._label_selector]
+        if query.pipeline_uuid is not None:
+            label_selectors.append(f"pipeline_uuid={query.pipeline_uuid}")
+        if query.exec_uuid is not None:
+            label_selectors.append(f"exec_uuid={query.exec_uuid}")
+        list_kwargs = {'label_selector': ','.join(label_selectors)}
+        if query.engine_status is not None:
+            # Field selectors cannot OR values, so exclude every phase that was not requested instead
+            wanted = [s.lower() for s in query.engine_status]
+            list_kwargs['field_selector'] = ','.join(
+                f"status.phase!={p}" for p in self._pod_phases if p.lower() not in wanted)
+        if query.limit is not None:
+            list_kwargs['limit'] = query.limit
+        if query.continue_token is not None:
+            list_kwargs['_continue'] = query.continue_token
+        return list_kwargs
+
+    def unmarshall_pod(self, pod_obj: client.V1Pod) -> RunningPipelineModel:
         def __decode_finish_time(container_statuses: list):
-            the_status= list(filter(lambda x: 'state' in x.to_dict(
-            ).keys(), container_statuses))[0].to_dict()
-            return the_status['state']['terminated']['finished_at']
-        labels=pod_obj.metadata.labels
-        exec_uuid, pipeline_uuid=labels['exec_uuid'], labels['pipeline_uuid']
-        state=pod_obj.status.phase.lower()
-        end_time='NA'
-        if state.lower() in ['failed', 'succeeded']):
-            end_time= __decode_finish_time(
-                pod_obj.status.container_statuses).strftime('%Y%m%d-%H:%M:%S')
+            # Evicted pods and pods that failed before a container started have no terminated state to read
+            finish_times = [cs.state.terminated.finished_at for cs in container_statuses or []
+                            if cs.state is not None and cs.state.terminated is not None and cs.state.terminated.finished_at is not None]
+            return max(finish_times) if len(finish_times) > 0 else None
+        labels = pod_obj.metadata.labels or {}
+        exec_uuid, pipeline_uuid = labels.get('exec_uuid'), labels.get('pipeline_uuid')
+        status = pod_obj.status
+        state = status.phase.lower() if status is not None and status.phase is not None else 'unknown'
+        end_time = 'NA'
+        if state in ['failed', 'succeeded']:
+            finish_time = __decode_finish_time(status.container_statuses)
+            end_time = finish_time.strftime('%Y%m%d-%H:%M:%S') if finish_time is not None else 'NA'
         pod_name = pod_obj.metadata.name
-        start_time= pod_obj.status.start_time.strftime(
-            "%Y%m%d-%H:%M:%S") if pod_obj.status.start_time is not None else 'NA'
-        return RunningPipelineModel(exec_uuid=exec_uuid, pipeline_uuid=pipeline_uuid, engine_tracking_id=pod_name, start_time=start_time, end_time=end_time, engine_status=state, engine=self.__classs__.__name__)
+        start_time = status.start_time.strftime(
+            "%Y%m%d-%H:%M:%S") if status is not None and status.start_time is not None else 'NA'
+        return RunningPipelineModel(exec_uuid=exec_uuid, pipeline_uuid=pipeline_uuid, engine_tracking_id=pod_name, start_time=start_time, end_time=end_time, engine_status=state, engine=self.__class__.__name__)
 
 
-class K8sPodEngine():
+class K8sPodEngine(K8sJobEngine):
     pass
+
+
+class K8sIndexedJobEngine(K8sJobEngine):
+    """Runs a pipeline as engine_args['completions'] shards of one Indexed Job, at most engine_args['parallelism'] at a time.
+    Each shard pod reads its index from JOB_COMPLETION_INDEX. get_jobs reports the shards individually, and the engine
+    publishes a single success or failure event once the Job as a whole completes - the shards do not report on their own"""
+    _label_selector = 'pod_source=kalytical-indexed'
+    _completion_index_annotation = 'batch.kubernetes.io/job-completion-index'
+    _source_uuids_annotation = 'kalytical.io/source-uuids'
+    _reported_annotation = 'kalytical.io/completion-reported'
+
+    def __init__(self, k8s_client: AsyncK8sClient = None):
+        super().__init__(k8s_client=k8s_client)
+        self._loop = None
+        # Follows the Jobs rather than their pods - a Job only completes once every index has succeeded or backoffLimit runs out
+        self._job_informer = PodInformer(core_client=self._k8s_core_client, namespace=kalytical_config.k8spodengine_k8s_namespace,
+                                         label_selector=self._label_selector, unmarshall=self.unmarshall_job,
+                                         list_func=self._k8s.batch_v1.list_namespaced_job, on_change=self._on_job_change)
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        super().start()
+        self._job_informer.start()
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        self._job_informer.shutdown()
+
+    def _compile_pod_template(self, header_model: PipelineHeaderModel) -> PodTemplate:
+        return PodTemplate(header_model=header_model, pod_source='kalytical-indexed', reports_completion=False)
+
+    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        self.log.info(
+            f"Attempting to submit indexed job for pipeline_uuid={header_model.pipeline_uuid}")
+        job_body = self.marshall_k8s_job(
+            header_model=header_model, exec_uuid=exec_uuid, source_uuid=source_uuid, retry_count=retry_count)
+        job_resp = await self._k8s.call(self._k8s.batch_v1.create_namespaced_job,
+                                        namespace=kalytical_config.k8spodengine_k8s_namespace, body=job_body)
+        return self.unmarshall_job(job_resp)
+
+    async def read_submitted_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        # The job is named after the pod it templates
+        job = await self._k8s.call(self._k8s.batch_v1.read_namespaced_job, namespace=kalytical_config.k8spodengine_k8s_namespace,
+                                   name=run_pod_name(exec_uuid=exec_uuid, pipeline_uuid=header_model.pipeline_uuid, retry_count=retry_count))
+        return self.unmarshall_job(job)
+
+    def marshall_k8s_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> dict:
+        engine_args = header_model.engine_args
+        if 'completions' not in engine_args:
+            raise ValueError(
+                f"pipeline_uuid={header_model.pipeline_uuid} needs engine_args.completions to run on {self.__class__.__name__}")
+        completions = int(engine_args['completions'])
+        pod = self.marshall_k8s_pod(header_model=header_model, exec_uuid=exec_uuid, source_uuid=source_uuid, retry_count=retry_count)
+        container = pod['spec']['containers'][0]
+        container = {**container, 'env': container['env'] + [{'name': 'SHARD_COUNT', 'value': str(completions)}]}
+        labels = {**pod['metadata']['labels'], 'retry_count': str(retry_count)}
+        return {'apiVersion': 'batch/v1', 'kind': 'Job',
+                'metadata': {'name': pod['metadata']['name'], 'labels': labels,
+                             'annotations': {self._source_uuids_annotation: json.dumps(source_uuid)}},
+                'spec': {'completionMode': 'Indexed',
+                         'completions': completions,
+                         'parallelism': int(engine_args.get('parallelism', completions)),
+                         # Per shard retries are up to the pipeline - by default one failed shard fails the run
+                         'backoffLimit': int(engine_args.get('shard_backoff_limit', 0)),
+                         'template': {'metadata': {'labels': pod['metadata']['labels']},
+                                      'spec': {**pod['spec'], 'containers': [container]}}}}
+
+    async def abort_pipeline(self, engine_tracking_id: str) -> dict:
+        """Accepts the job name or the name of any one of its shard pods - deleting a shard pod alone only gets it recreated"""
+        job_name = engine_tracking_id
+        try:
+            pod = await self._k8s.call(self._k8s_core_client.read_namespaced_pod,
+                                       name=engine_tracking_id, namespace=kalytical_config.k8spodengine_k8s_namespace)
+            job_name = pod.metadata.labels.get('job-name', engine_tracking_id)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        try:
+            await self._k8s.call(self._k8s.batch_v1.delete_namespaced_job, name=job_name,
+                                 namespace=kalytical_config.k8spodengine_k8s_namespace, propagation_policy='Foreground')
+            return {'resuilt': 'true'}
+        except ApiException as e:
+            raise HTTPException(
+                status_code=404, detail="An attempt was made on this jobs life, but it is not here...")
+
+    def unmarshall_pod(self, pod_obj: client.V1Pod) -> RunningPipelineModel:
+        job = super().unmarshall_pod(pod_obj)
+        shard_index = (pod_obj.metadata.annotations or {}).get(self._completion_index_annotation)
+        job.shard_index = int(shard_index) if shard_index is not None else None
+        return job
+
+    def unmarshall_job(self, job_obj: client.V1Job) -> RunningPipelineModel:
+        labels = job_obj.metadata.labels
+        status = job_obj.status
+        state = self._job_state(job_obj)
+        start_time = status.start_time.strftime("%Y%m%d-%H:%M:%S") if status is not None and status.start_time is not None else 'NA'
+        end_time = status.completion_time.strftime("%Y%m%d-%H:%M:%S") if status is not None and status.completion_time is not None else 'NA'
+        return RunningPipelineModel(exec_uuid=labels['exec_uuid'], pipeline_uuid=labels['pipeline_uuid'], engine_tracking_id=job_obj.metadata.name,
+                                    start_time=start_time, end_time=end_time, engine_status=state, engine=self.__class__.__name__)
+
+    @staticmethod
+    def _job_state(job_obj: client.V1Job) -> str:
+        status = job_obj.status
+        if status is None:
+            return 'pending'
+        for condition in status.conditions or []:
+            if condition.status == 'True' and condition.type == 'Complete':
+                return 'succeeded'
+            if condition.status == 'True' and condition.type == 'Failed':
+                return 'failed'
+        return 'running' if (status.active or 0) > 0 else 'pending'
+
+    def _on_job_change(self, job_obj: client.V1Job) -> None:
+        # Called on the informer thread for every update - only finished, unreported jobs go over to the loop
+        if self._loop is None or self._job_state(job_obj) not in ['succeeded', 'failed']:
+            return
+        if self._reported_annotation in (job_obj.metadata.annotations or {}):
+            return
+        asyncio.run_coroutine_threadsafe(self._report_completion(job_obj), self._loop)
+
+    async def _report_completion(self, job_obj: client.V1Job) -> None:
+        if self._event_sink is None:
+            self.log.warning(
+                f"No event sink set, cannot report completion of job={job_obj.metadata.name}")
+            return
+        # Every replica sees the same update. The resourceVersion test lets exactly one of them mark the job as reported
+        claim = [{'op': 'test', 'path': '/metadata/resourceVersion', 'value': job_obj.metadata.resource_version},
+                 {'op': 'add', 'path': f"/metadata/annotations/{self._reported_annotation.replace('/', '~1')}", 'value': 'true'}]
+        try:
+            await self._k8s.call(self._k8s.batch_v1.patch_namespaced_job, name=job_obj.metadata.name,
+                                 namespace=kalytical_config.k8spodengine_k8s_namespace, body=claim)
+        except ApiException as e:
+            if e.status in [404, 409, 422]:
+                # Already claimed, changed since we saw it (a later update will try again) or deleted
+                return
+            raise
+        labels = job_obj.metadata.labels
+        state = self._job_state(job_obj)
+        source_uuids = json.loads((job_obj.metadata.annotations or {}).get(self._source_uuids_annotation, 'null'))
+        lifecycle_event = LifecycleEventModel(event_type='job_exec_update', event_body=JobLifecycleEventBody(
+            event_subtype='success' if state == 'succeeded' else 'failure', pipeline_uuid=labels['pipeline_uuid'], exec_uuid=labels['exec_uuid'],
+            source_uuids=source_uuids, event_time=datetime.now(), retry_count=int(labels.get('retry_count', 0))))
+        self.log.info(
+            f"Indexed job={job_obj.metadata.name} finished as {state}, publishing a {lifecycle_event.event_body.event_subtype} event")
+        try:
+            await self._event_sink(lifecycle_event)
+        except Exception:
+            self.log.exception(
+                f"Could not publish completion of job={job_obj.metadata.name} - the execution reconciler will catch up with it")
@@ -0,0 +1,76 @@
+from src.kalytical.core.data_provider import MongoDBProvider, ACTIVE_EXECUTION_STATES
+from src.kalytical.core.engine import EngineManager
+from src.kalytical.core.local_engine import OWNER_HOST
+from src.kalytical.models import RunningPipelineModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import List
+from datetime import datetime, timedelta
+import asyncio
+
+kalytical_config = KalyticalConfig()
+
+
+class ExecutionReconciler():
+    """Corrects drift between the execution ledger and the engines - missed lifecycle events, pods deleted out of band.
+    Active executions that have gone quiet are compared against a single engine listing per pass"""
+
+    def __init__(self, data_provider: MongoDBProvider, engine_mgr: EngineManager):
+        self._data_provider = data_provider
+        self._engine_mgr = engine_mgr
+        self.log = get_logger(self.__class__.__name__)
+        self._running = True
+
+    async def reconcile_loop(self):
+        while self._running:
+            try:
+                await self.reconcile()
+            except Exception:
+                self.log.exception("Error while trying to reconcile executions!")
+            finally:
+                await asyncio.sleep(kalytical_config.execution_reconcile_interval_seconds)
+        self.log.warn("Exiting")
+
+    async def reconcile(self) -> int:
+        repaired = await self._data_provider.repair_concurrency_slots()
+        if repaired > 0:
+            self.log.warning(f"Released slot_count={repaired} concurrency slots held by executions that are no longer active")
+        stale = await self._data_provider.get_executions(states=ACTIVE_EXECUTION_STATES, updated_before=datetime.now() - timedelta(
+            seconds=kalytical_config.execution_reconcile_grace_seconds))
+        if len(stale) == 0:
+            return 0
+        jobs = {}
+        for job in await self._engine_mgr.get_filtered_jobs(limit=None):
+            jobs.setdefault(job.exec_uuid, []).append(job)
+        corrected = 0
+        for execution in stale:
+            if execution.owner_host is not None and execution.owner_host != OWNER_HOST:
+                # Only the host running it can see it, so it is not missing just because it is not listed here
+                continue
+            state = self._aggregate_state(jobs[execution.exec_uuid]) if execution.exec_uuid in jobs else 'lost'
+            if state == execution.engine_status or state not in ['pending', 'running', 'succeeded', 'failed', 'aborted', 'lost']:
+                continue
+            self.log.warning(
+                f"Execution exec_uuid={execution.exec_uuid} for pipeline_uuid={execution.pipeline_uuid} was {execution.engine_status} in the ledger but is {state} in the engine")
+            if await self._data_provider.update_execution(exec_uuid=execution.exec_uuid, pipeline_uuid=execution.pipeline_uuid, state=state):
+                corrected += 1
+        return corrected
+
+    @staticmethod
+    def _aggregate_state(jobs: List[RunningPipelineModel]) -> str:
+        """One execution can span several pods - the shards of an indexed job, or a shard that was retried.
+        It is still active while any of them is, and failed if some shard has failed without a later pod succeeding for it"""
+        states = [job.engine_status for job in jobs]
+        if 'running' in states:
+            return 'running'
+        if 'pending' in states:
+            return 'pending'
+        succeeded_shards = {job.shard_index for job in jobs if job.engine_status == 'succeeded'}
+        if any(job.engine_status == 'failed' and job.shard_index not in succeeded_shards for job in jobs):
+            return 'failed'
+        if all(state in ['succeeded', 'failed'] for state in states):
+            return 'succeeded'
+        return states[0]
+
+    def shutdown(self):
+        self.log.info("Shutting down reconciler!")
+        self._running = False
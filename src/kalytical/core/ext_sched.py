@@ -1,26 +1,30 @@
 import time
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.models.v1_env_var import V1EnvVar
-from kubernetes.config.config_exception import ConfigException
 from kubernetes.client.exceptions import ApiException
 from src.kalytical.utils import KalyticalConfig, get_logger
+from src.kalytical.core.k8s_client import AsyncK8sClient
 import asyncio
+from typing import Dict, List
 
 kalytical_config = KalyticalConfig()
 
 class K8sCronProvider():
-    def __init__(self, k8s_namespace: str, cron_image: str):
-        try:
-            config.load_incluster_config()
-        except ConfigException:
-            self.log.warn(f"Could not load kube configuration from pod! Attempting to configure client with local kubeconfig={config.KUBE_CONFIG_DEFAULT_LOCATION}")
-            self.config.load_kube_config()
-
-        self._k8s_batch_client = client.BatchV1betaApi()
+    def __init__(self, k8s_namespace: str, cron_image: str, k8s_client: AsyncK8sClient = None):
+        self.log = get_logger(self.__class__.__name__)
+        self._k8s_namespace = k8s_namespace
+        self._cron_image = cron_image
+        self._k8s = k8s_client if k8s_client is not None else AsyncK8sClient()
+        self._k8s_batch_client = self._k8s.batch_v1beta1
         
-    def create_cronjob(self, schedule: str, pipeline_uuid: str) -> str:
+    _job_name_prefix = 'kalytical-api-trigger-'
+
+    def job_name(self, pipeline_uuid: str) -> str:
+        return f'{self._job_name_prefix}{pipeline_uuid}'
+
+    def _marshall_cronjob(self, schedule: str, pipeline_uuid: str) -> client.V1beta1CronJob:
         run_job_endpoint= f'{kalytical_config.kalytical_api_endpoint}/pipeline/dispatcher/run_by_pipeline_uuid?pipeline_uuid={pipeline_uuid}'
-        job_name = f'kalytical-api-trigger-{pipeline_uuid}'
+        job_name = self.job_name(pipeline_uuid)
         container = client.V1Container(
             name=job_name,
             image=kalytical_config.ext_cron_image_uri,
@@ -34,39 +38,71 @@ class K8sCronProvider():
         
         job_spec = client.V1JobSpec(
             completions=1, backoff_limit=0, template=pod_template)
-        job_template = client.V1beta1JobTemplateSpec(job_tepmlate = job_template, schedule=schedule), 
-        cron_body = client.V1beta1CronJob(
+        job_template = client.V1beta1JobTemplateSpec(spec=job_spec)
+        cron_spec = client.V1beta1CronJobSpec(job_template=job_template, schedule=schedule)
+        return client.V1beta1CronJob(
             spec=cron_spec, metadata=client.V1ObjectMeta(name=job_name)
         )
 
+    async def create_cronjob(self, schedule: str, pipeline_uuid: str) -> str:
+        cron_body = self._marshall_cronjob(schedule=schedule, pipeline_uuid=pipeline_uuid)
+        job_name = cron_body.metadata.name
         try:
             self.log.debug(f"Attempting to write namespaced cronjob with namespace={self._k8s_namespace} parameters={str(cron_body)}")
-            self._k8s_batch_client.create_namespaced_cron_job(
-                namespace=self._k8s_namespace, body=cron_body)
+            await self._k8s.call(self._k8s_batch_client.create_namespaced_cron_job,
+                                 namespace=self._k8s_namespace, body=cron_body)
 
         except ApiException as e:
             if e.status == 409:
-                self.log.warn("This job already existed. We will re-create it.")
-                self.delete_cronjob(job_name=job_name) #TODO Instead use patching
-                self.create_cronjob(schedule=schedule, pipeline_uuid=pipeline_uuid)
+                self.log.warn("This job already existed. We will patch it.")
+                await self._k8s.call(self._k8s_batch_client.patch_namespaced_cron_job,
+                                     name=job_name, namespace=self._k8s_namespace, body=cron_body)
             else: 
                 raise e
         return job_name
 
-    def delete_cronjob(self, job_name: str) -> None:
+    async def reconcile_cronjobs(self, schedules: Dict[str, str], removed: List[str] = None) -> Dict[str, str]:
+        """Make the CronJobs for the pipeline_uuids in schedules fire on their schedule, and delete the ones for removed.
+        One LIST covers the whole pass - only CronJobs that are missing or differ are written. Returns pipeline_uuid to job name"""
+        cron_list = await self._k8s.call(self._k8s_batch_client.list_namespaced_cron_job, namespace=self._k8s_namespace)
+        existing = {c.metadata.name: c for c in cron_list.items if c.metadata.name.startswith(self._job_name_prefix)}
+        writes = []
+        for pipeline_uuid, schedule in schedules.items():
+            job_name = self.job_name(pipeline_uuid)
+            current = existing.get(job_name)
+            if current is None:
+                writes.append(self.create_cronjob(schedule=schedule, pipeline_uuid=pipeline_uuid))
+            elif current.spec.schedule != schedule:
+                writes.append(self._k8s.call(self._k8s_batch_client.patch_namespaced_cron_job, name=job_name,
+                                             namespace=self._k8s_namespace, body={'spec': {'schedule': schedule}}))
+        for pipeline_uuid in removed or []:
+            if self.job_name(pipeline_uuid) in existing:
+                writes.append(self._delete_cronjob(job_name=self.job_name(pipeline_uuid)))
+        self.log.info(
+            f"Reconciling cronjobs, schedule_count={len(schedules)} removed_count={len(removed or [])} write_count={len(writes)}")
+        # The shared client's executor bounds how many of these reach the API server at once
+        await asyncio.gather(*writes)
+        return {pipeline_uuid: self.job_name(pipeline_uuid) for pipeline_uuid in schedules}
+
+    async def _delete_cronjob(self, job_name: str) -> None:
+        try:
+            await self._k8s.call(self._k8s_batch_client.delete_namespaced_cron_job, namespace=self._k8s_namespace, name=job_name)
+        except ApiException as e:
+            if e.status != 404:
+                raise e
+
+    async def delete_cronjob(self, job_name: str) -> None:
         self.log.info(f"Attempting to delete cronjob={job_name}")
         try:
-            self._k8s_batch_client.delete_namespaced_cron_job(namespace=self._k8s_namespace, name=job_name)
-            del_attempt_max = 3
-            attempt = 0
-            #TODO Use that retry decorator
-            cron_job_list = self._k8s_batch_client.list_namespaced_cron_job(namespace=self._k8s_namespace).items
+            await self._k8s.call(self._k8s_batch_client.delete_namespaced_cron_job, namespace=self._k8s_namespace, name=job_name)
+
+            async def _is_deleted() -> bool:
+                cron_job_list = await self._k8s.call(self._k8s_batch_client.list_namespaced_cron_job, namespace=self._k8s_namespace,
+                                                     field_selector=f"metadata.name={job_name}")
+                return len(cron_job_list.items) == 0
 
-            while job_name in [e.metadata.name for e in cron_job_list] and del_attempt_max > attempt:
-                self.log.info("Job deletion in-progress...")
-                asyncio.sleep(1)
-                cron_job_list = self._k8s_batch_client.list_namespaced_cron_job(namespace=self._k8s_namespace).items
-                attempt += 1
+            if not await self._k8s.wait_for(_is_deleted, timeout_seconds=kalytical_config.k8s_delete_wait_seconds):
+                self.log.warn(f"cronjob={job_name} was still present after waiting for its deletion")
 
         except ApiException as e:
             if e.status == 404:
@@ -0,0 +1,79 @@
+import asyncio
+from src.kalytical.utils import get_logger
+from typing import Awaitable, Callable, List
+
+
+class EventHistoryBuffer():
+    """Write-behind buffer for event history. Records are flushed together once max_batch_size of them are pending
+    or flush_interval_seconds after the first one arrived, whichever happens first.
+    With wait_for_flush set, append only returns once its records are written; otherwise it returns immediately"""
+
+    def __init__(self, flush: Callable[[List[dict]], Awaitable], max_batch_size: int, flush_interval_seconds: float, wait_for_flush: bool = False):
+        self.log = get_logger(self.__class__.__name__)
+        self._flush = flush
+        self._max_batch_size = max_batch_size
+        self._flush_interval_seconds = flush_interval_seconds
+        self._wait_for_flush = wait_for_flush
+        self._pending = []
+        self._pending_flushed = None
+        self._has_pending = None
+        self._batch_full = None
+        self._flush_task = None
+        self._closing = False
+
+    def start(self) -> None:
+        self._pending_flushed = asyncio.get_running_loop().create_future()
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """Write whatever is still pending. Records appended from here on are written straight through"""
+        if self._flush_task is None or self._closing:
+            return
+        self._closing = True
+        self._has_pending.set()
+        self._batch_full.set()
+        await self._flush_task
+
+    async def append(self, records: List[dict]) -> None:
+        if self._flush_task is None or self._closing:
+            # Not started, or shutting down - write straight through
+            await self._flush(records)
+            return
+        self._pending.extend(records)
+        flushed = self._pending_flushed
+        self._has_pending.set()
+        if len(self._pending) >= self._max_batch_size:
+            self._batch_full.set()
+        if self._wait_for_flush:
+            await asyncio.shield(flushed)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=self._flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush_pending()
+            if self._closing and len(self._pending) == 0:
+                return
+
+    async def _flush_pending(self) -> None:
+        records, flushed = self._pending, self._pending_flushed
+        self._pending = []
+        self._pending_flushed = asyncio.get_running_loop().create_future()
+        self._has_pending.clear()
+        self._batch_full.clear()
+        if len(records) == 0:
+            flushed.set_result(None)
+            return
+        try:
+            await self._flush(records)
+            flushed.set_result(None)
+        except Exception as e:
+            self.log.exception(f"Could not write record_count={len(records)} history records")
+            flushed.set_exception(e)
+            # Nobody awaits the batch when running fire-and-forget, so mark the exception as seen
+            flushed.exception()
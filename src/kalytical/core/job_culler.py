@@ -1,41 +1,49 @@
 from src.kalytical.core.data_provider import MongoDBProvider
 from src.kalytical.utils import KalyticalConfig, get_logger
 from src.kalytical.core.dispatcher import KDispatcher
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
-import json
 
 kalytical_config = KalyticalConfig()
 
 class IncubatingJobCuller():
-    def __init__(self):
+    def __init__(self, data_provider: MongoDBProvider, dispatcher: KDispatcher):
         self._culling_interval = kalytical_config.incubating_job_culling_interval
-        self._data_provider = MongoDBProvider()
+        self._data_provider = data_provider
+        self._dispatcher = dispatcher
         self.log = get_logger(self.__class__.__name__)
         self._running = True
 
     async def cull_jobs_loop(self):
+        # Dependency runs are launched by the dispatcher the moment their last trigger lands, and runs deferred on
+        # concurrency are woken by the completion of the run blocking them. This loop is the safety net for wake-ups
+        # that were missed - e.g. a completion event that never arrived - and ages out runs that will never be satisfied
         while self._running:
             try:
-                a_dispatcher = KDispatcher()
-                for job in await self._data_provider.get_incubating_pipelines():
-                    if job.reason == 'concurrency' and (datetime.now() - job.create_time).seconds > kalytical_config.concurrency_debounce_seconds:
-                        self.log.info(f"Cull incubating run for pipeline_uuid={job.pipeline_uuid} for reason={job.reason}")
-                        header_model = await self._data_provider.head_pieline_definition(pipeline_uuid=job.pipeline_uuid)
+                now = datetime.now()
+                stale = await self._data_provider.get_incubating_pipelines(reason='concurrency', created_before=now - timedelta(seconds=kalytical_config.concurrency_debounce_seconds))
+                for pipeline_uuid in {job.pipeline_uuid for job in stale}:
+                    woken = await self._dispatcher.wake_deferred_runs(pipeline_uuid=pipeline_uuid)
+                    if len(woken) > 0:
+                        self.log.info(f"Cull woke run_count={len(woken)} deferred runs for pipeline_uuid={pipeline_uuid}")
 
-                        await a_dispatcher.queue_pipeline(header_model=header_model, retry_count=(job.retry_count + 1), source_uuids=job.source_uuids)
-                        await self._data_provider.delete_incbuating_pipeline(obj_id=job.obj_id)
-                    elif job.reason == 'dependencies' and all(e != 'waiting' or e in job.triggers.values()):
-                        self.log.info(f"Cull incubating run for pipeline_uuid={job.pipeline_uuid} for reason={job.reason}")
-                        header_model = await self._data_provider.head_Pipeline_definition(pipeline_uuid=job.pipeline_uuid)
-                        source_ids = json.dumps(job.triggers)
-                        await a_dispatcher.queue_pipeline(header_model=header_model, retry_count=0, source_uuid=source_ids)
-                        await self._data_provider.delete_incubating_pipeline(obj_id=job.obj_id)
+                # Satisfied runs whose launch failed or whose launching replica died
+                stale_before = now - timedelta(seconds=kalytical_config.incubation_launch_grace_seconds)
+                for incubating in await self._data_provider.get_incubating_pipelines(reason='dependencies', created_before=stale_before):
+                    if not incubating.is_satisfied() or (incubating.launch_time is not None and incubating.launch_time >= stale_before):
+                        continue
+                    try:
+                        launched = await self._dispatcher.resolve_incubation(incubating=incubating, stale_before=stale_before)
+                    except Exception:
+                        self.log.exception(f"Could not launch stalled dependency run obj_id={incubating.obj_id}")
+                        continue
+                    if len(launched) > 0:
+                        self.log.info(f"Cull launched stalled dependency run obj_id={incubating.obj_id} of pipeline_uuid={incubating.pipeline_uuid}")
 
-                    elif (datetime.now() - job.create)time).seconds > kalytical_config.incubating_job_age_out_seconds:
-                        self.log.info(f"This job obj_id={job.obj_id} for pipeline_uuid={job.pipeline_uuid} has aged out, creation_time={job.create_time.strftime('')} and will be removed from the incubating job collection")
-                        await self._data_provider.delete_incubating_pipeline(obj_id=job.obj_id)
-                    
+                aged_out = await self._data_provider.age_out_incubating_pipelines(
+                    created_before=now - timedelta(seconds=kalytical_config.incubating_job_age_out_seconds))
+                if aged_out > 0:
+                    self.log.info(f"Removed {aged_out} incubating runs older than {kalytical_config.incubating_job_age_out_seconds} seconds")
             except Exception:
                 self.log.exception("Error while trying to cull jobs!") 
             finally:
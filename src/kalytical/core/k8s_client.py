@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config
+from kubernetes.config.config_exception import ConfigException
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, Awaitable, Callable
+
+kalytical_config = KalyticalConfig()
+module_logger = get_logger('k8s_client')
+
+
+def load_k8s_api_client() -> client.ApiClient:
+    """Load kube configuration once and build the pooled ApiClient shared by engines and the cron provider"""
+    try:
+        # Defaults to the service account assigned to the pod
+        config.load_incluster_config()
+    except ConfigException:
+        module_logger.warn(
+            f"Could not load kube configuration from pod! Attempting to configure client with local kubeconfig={config.KUBE_CONFIG_DEFAULT_LOCATION}")
+        config.load_kube_config()
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = kalytical_config.k8s_connection_pool_maxsize
+    return client.ApiClient(configuration=configuration)
+
+
+def k8s_pool_stats(api_client: client.ApiClient) -> dict:
+    pool_manager = api_client.rest_client.pool_manager
+    pools = [pool_manager.pools[key] for key in pool_manager.pools.keys()]
+    return {
+        'maxsize': api_client.configuration.connection_pool_maxsize,
+        'host_pools': len(pools),
+        'connections_opened': sum(p.num_connections for p in pools),
+        'requests_served': sum(p.num_requests for p in pools),
+        'idle_connections': sum(p.pool.qsize() for p in pools if p.pool is not None)
+    }
+
+
+class AsyncK8sClient():
+    """Awaitable access to one pooled kubernetes ApiClient, shared by the engines and the cron provider"""
+
+    def __init__(self, api_client: client.ApiClient = None):
+        self.log = get_logger(self.__class__.__name__)
+        self.api_client = api_client if api_client is not None else load_k8s_api_client()
+        self.core_v1 = client.CoreV1Api(api_client=self.api_client)
+        self.batch_v1 = client.BatchV1Api(api_client=self.api_client)
+        self.batch_v1beta1 = client.BatchV1beta1Api(api_client=self.api_client)
+        # The generated client is synchronous - calls run here, and the pool size caps concurrent API server requests
+        self._executor = ThreadPoolExecutor(
+            max_workers=kalytical_config.k8s_max_concurrency, thread_name_prefix=self.__class__.__name__)
+
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        kwargs.setdefault('_request_timeout', kalytical_config.k8s_request_timeout_seconds)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def wait_for(self, condition: Callable[[], Awaitable[bool]], timeout_seconds: float, poll_seconds: float = 1) -> bool:
+        """Await condition() until it is true or timeout_seconds pass, sleeping between attempts without blocking the loop"""
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            if await condition():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(poll_seconds)
+
+    def pool_stats(self) -> dict:
+        return {**k8s_pool_stats(self.api_client),
+                'max_concurrency': kalytical_config.k8s_max_concurrency,
+                'executor_queue_depth': self._executor._work_queue.qsize()}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.api_client.close()
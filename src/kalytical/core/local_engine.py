@@ -0,0 +1,193 @@
+import asyncio
+import os
+import socket
+from collections import deque, OrderedDict
+from datetime import datetime
+from fastapi import HTTPException
+from src.kalytical.core.abstract_engine import AbstractEngine
+from src.kalytical.core.pod_template import pipeline_env, run_env
+from src.kalytical.models import PipelineHeaderModel, RunningPipelineModel, JobQueryModel, JobPageModel, LifecycleEventModel, JobLifecycleEventBody
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, Awaitable, Callable, Dict, List
+
+kalytical_config = KalyticalConfig()
+
+# Runs live in this process, so only this host can report on them
+OWNER_HOST = socket.gethostname()
+
+
+class _LocalRun():
+    def __init__(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: Any, retry_count: int):
+        self.header_model = header_model
+        self.exec_uuid = exec_uuid
+        self.source_uuid = source_uuid
+        self.retry_count = retry_count
+        self.engine_tracking_id = f"{exec_uuid}-{header_model.pipeline_uuid}-{retry_count}"
+        self.state = 'pending'
+        self.start_time = None
+        self.end_time = None
+        self.aborted = False
+        self.process = None
+        self.task = None
+        self.logs = deque(maxlen=kalytical_config.local_engine_log_lines)
+
+
+class LocalProcessEngine(AbstractEngine):
+    """Runs engine_args['pipeline_command'] + engine_args['pipeline_args'] as a subprocess of this host, at most
+    local_engine_max_processes at a time. Meant for short steps where pod scheduling and image pull would dominate, and
+    for exercising the dispatch path without a cluster. Runs and their logs only live in this process's memory.
+    Off unless local_engine_enabled is set, since it runs arbitrary commands on the API host"""
+    runs_on_cluster = False
+    _token_prefix = 'local:'
+
+    def __init__(self):
+        self.log = get_logger(self.__class__.__name__)
+        self._runs: Dict[str, _LocalRun] = OrderedDict()
+        self._slots = None
+        self._event_sink = None
+
+    def set_event_sink(self, event_sink: Callable[[LifecycleEventModel], Awaitable]) -> None:
+        self._event_sink = event_sink
+
+    def start(self) -> None:
+        self._slots = asyncio.Semaphore(kalytical_config.local_engine_max_processes)
+
+    def shutdown(self) -> None:
+        self.log.info("Shutting down local process engine!")
+        for run in self._runs.values():
+            if run.task is not None and not run.task.done():
+                run.aborted = True
+                if run.process is not None and run.process.returncode is None:
+                    run.process.terminate()
+                run.task.cancel()
+
+    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        if 'pipeline_command' not in header_model.engine_args:
+            raise ValueError(
+                f"pipeline_uuid={header_model.pipeline_uuid} needs engine_args.pipeline_command to run on {self.__class__.__name__}")
+        self.log.info(
+            f"Attempting to start local process for pipeline_uuid={header_model.pipeline_uuid}")
+        run = _LocalRun(header_model=header_model, exec_uuid=exec_uuid, source_uuid=source_uuid, retry_count=retry_count)
+        self._runs[run.engine_tracking_id] = run
+        self._forget_finished_runs()
+        run.task = asyncio.create_task(self._run(run))
+        return self.unmarshall_run(run)
+
+    async def _run(self, run: _LocalRun) -> None:
+        engine_args = run.header_model.engine_args
+        command = list(engine_args['pipeline_command']) + list(engine_args.get('pipeline_args', []))
+        # Only what a process needs to start - the API's own credentials stay out of the pipeline's environment
+        env = {name: os.environ[name] for name in kalytical_config.local_engine_env_allowlist if name in os.environ}
+        # This engine publishes the outcome itself once the process exits
+        for var in pipeline_env(header_model=run.header_model, reports_completion=False) + run_env(
+                exec_uuid=run.exec_uuid, retry_count=run.retry_count, source_uuid=run.source_uuid):
+            env[var['name']] = var['value']
+        try:
+            async with self._slots:
+                # Aborted while waiting for a slot - never started
+                if not run.aborted:
+                    run.process = await asyncio.create_subprocess_exec(*command, env=env, cwd=engine_args.get('working_dir'),
+                                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+                    run.state = 'running'
+                    run.start_time = datetime.now()
+                    try:
+                        await asyncio.wait_for(self._capture_logs(run), timeout=engine_args.get('timeout_seconds'))
+                    except asyncio.TimeoutError:
+                        run.logs.append(f"Timed out after {engine_args['timeout_seconds']} seconds")
+                        await self._stop_process(run)
+                    await run.process.wait()
+            if run.aborted:
+                run.state = 'aborted'
+            else:
+                run.state = 'succeeded' if run.process is not None and run.process.returncode == 0 else 'failed'
+        except asyncio.CancelledError:
+            run.state = 'failed'
+            raise
+        except Exception as e:
+            self.log.exception(f"Local process for exec_uuid={run.exec_uuid} could not be run")
+            run.logs.append(str(e))
+            run.state = 'failed'
+        finally:
+            run.end_time = datetime.now()
+        await self._report_exit(run)
+
+    @staticmethod
+    async def _capture_logs(run: _LocalRun) -> None:
+        while True:
+            line = await run.process.stdout.readline()
+            if not line:
+                return
+            run.logs.append(line.decode(errors='replace').rstrip('\n'))
+
+    async def _stop_process(self, run: _LocalRun) -> None:
+        if run.process is None or run.process.returncode is not None:
+            return
+        run.process.terminate()
+        try:
+            await asyncio.wait_for(run.process.wait(), timeout=kalytical_config.local_engine_terminate_grace_seconds)
+        except asyncio.TimeoutError:
+            run.process.kill()
+
+    async def _report_exit(self, run: _LocalRun) -> None:
+        if run.state == 'aborted':
+            # Like a deleted pod, an aborted run was stopped on purpose - a failure event would only get it retried
+            self.log.info(f"Local process for exec_uuid={run.exec_uuid} was aborted")
+            return
+        if self._event_sink is None:
+            self.log.warning(
+                f"No event sink set, cannot report exit of exec_uuid={run.exec_uuid}")
+            return
+        lifecycle_event = LifecycleEventModel(event_type='job_exec_update', event_body=JobLifecycleEventBody(
+            event_subtype='success' if run.state == 'succeeded' else 'failure', pipeline_uuid=run.header_model.pipeline_uuid,
+            exec_uuid=run.exec_uuid, source_uuids=run.source_uuid, event_time=run.end_time, retry_count=run.retry_count))
+        try:
+            await self._event_sink(lifecycle_event)
+        except Exception:
+            self.log.exception(
+                f"Could not publish exit of exec_uuid={run.exec_uuid} - the execution reconciler will catch up with it")
+
+    def _forget_finished_runs(self) -> None:
+        finished = [k for k, run in self._runs.items() if run.state in ['succeeded', 'failed', 'aborted']]
+        for key in finished[:max(0, len(self._runs) - kalytical_config.local_engine_retained_runs)]:
+            del self._runs[key]
+
+    async def get_job_logs(self, engine_tracking_id: str, max_kb: int, from_beginning: bool = False) -> str:
+        run = self._runs.get(engine_tracking_id)
+        if run is None:
+            self.log.warning(f"No local run with engine_tracking_id={engine_tracking_id}")
+            return None
+        logs = '\n'.join(run.logs)
+        max_chars = max_kb * 1024
+        return logs[:max_chars] if from_beginning else logs[-max_chars:]
+
+    async def abort_pipeline(self, engine_tracking_id: str) -> dict:
+        run = self._runs.get(engine_tracking_id)
+        if run is None or run.state in ['succeeded', 'failed', 'aborted']:
+            raise HTTPException(
+                status_code=404, detail="An attempt was made on this jobs life, but it is not here...")
+        run.aborted = True
+        await self._stop_process(run)
+        return {'resuilt': 'true'}
+
+    async def get_jobs(self, limit: int = None, pipeline_uuid: str = None, exec_uuid: str = None, engine_status: List[str] = None) -> List[RunningPipelineModel]:
+        page = await self.query_jobs(query=JobQueryModel(limit=limit, pipeline_uuid=pipeline_uuid, exec_uuid=exec_uuid, engine_status=engine_status))
+        return page.jobs
+
+    async def query_jobs(self, query: JobQueryModel) -> JobPageModel:
+        wanted = None if query.engine_status is None else [s.lower() for s in query.engine_status]
+        job_list = [self.unmarshall_run(run) for run in self._runs.values()
+                    if (query.pipeline_uuid is None or run.header_model.pipeline_uuid == query.pipeline_uuid)
+                    and (query.exec_uuid is None or run.exec_uuid == query.exec_uuid)
+                    and (wanted is None or run.state in wanted)]
+        offset = 0 if query.continue_token is None else int(query.continue_token[len(self._token_prefix):])
+        if query.limit is None:
+            return JobPageModel(jobs=job_list[offset:])
+        next_offset = offset + query.limit
+        continue_token = f"{self._token_prefix}{next_offset}" if next_offset < len(job_list) else None
+        return JobPageModel(jobs=job_list[offset:next_offset], continue_token=continue_token)
+
+    def unmarshall_run(self, run: _LocalRun) -> RunningPipelineModel:
+        start_time = run.start_time.strftime("%Y%m%d-%H:%M:%S") if run.start_time is not None else 'NA'
+        end_time = run.end_time.strftime("%Y%m%d-%H:%M:%S") if run.end_time is not None else 'NA'
+        return RunningPipelineModel(exec_uuid=run.exec_uuid, pipeline_uuid=run.header_model.pipeline_uuid, engine_tracking_id=run.engine_tracking_id,
+                                    start_time=start_time, end_time=end_time, engine_status=run.state, engine=self.__class__.__name__, owner_host=OWNER_HOST)
@@ -1,40 +1,126 @@
-import aioboto3
 import asyncio
 import json
+import zlib
+from src.kalytical.core.dispatcher import MaxPipelineRetryReachedException
+from src.kalytical.core.mq_transport import LifecycleEventTransport, TransportMessage
 from src.kalytical.models import LifecycleEventModel, JobLifecycleEventBody
 from src.kalytical.utils import KalyticalConfig, get_logger
 from typing import Any
 
 kalytical_config = KalyticalConfig()
 
+
 class MQ_Poller():
-    def __init__(self):
+    """Takes batches of lifecycle events off the transport and hands each one to a fixed pool of workers.
+    Messages are sharded by pipeline_uuid so events for one pipeline are always handled in the order they were received.
+    A message is only acknowledged once it was dispatched successfully - failures are released back for redelivery until
+    mq_max_receive_count, after which they are dead-lettered"""
+
+    def __init__(self, transport: LifecycleEventTransport, dispatcher: Any):
         self.log = get_logger(self.__class__.__name__)
-        self._session = aioboto3.Session()
+        self._transport = transport
+        self._dispatcher = dispatcher
         self._running = True
+        # Bounded so a slow dispatcher pushes back on the receive loop instead of piling messages up in memory
+        self._shards = [asyncio.Queue(maxsize=kalytical_config.mq_worker_queue_size)
+                        for _ in range(kalytical_config.mq_worker_count)]
+        self._ack_queue = asyncio.Queue()
 
     async def fetch_message_loop(self):
-        while self._running:
+        tasks = [asyncio.create_task(self._worker_loop(shard)) for shard in self._shards]
+        tasks.append(asyncio.create_task(self._ack_loop()))
+        try:
+            while self._running:
+                try:
+                    messages = await self._transport.receive()
+                    self.log.debug(f"Received message_count={len(messages)}")
+                    for message in messages:
+                        await self._route_message(message=message)
+                except Exception:
+                    self.log.exception("Error while trying to poll for messages!")
+                    await asyncio.sleep(kalytical_config.mq_retry_seconds)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _route_message(self, message: TransportMessage) -> None:
+        if message.lifecycle_event is None:
             try:
-                async with self_session.client('sqs') as sqs_client:
-                    response = await sqs_client.receive_message(QueueUrl=kalytical_config.sqs_url, WaitTimeSeconds=2)
-                    if 'Messages' in response.keys():
-                        self.log.info(f"Received message_count={len(response['Messages'])}")
-                        for message in response['Messages']:
-                            await self._handle_message(message=message, sqs_client=sqs_client)
-                self.log.debug("Completed polling interval")
-            except Exception:
-                self.log.exception("Error while trying to poll for messages!")
+                message.lifecycle_event = self._unmarshall_message(message_dict=json.loads(message.body))
+            except ValueError:
+                self.log.exception(f"Could not decode message_id={message.message_id}")
+        if message.lifecycle_event is None:
+            # Redelivering a message that can never be parsed only delays the ones behind it
+            await self._transport.dead_letter(message, reason='could not be decoded')
+            return
+        shard = zlib.crc32(message.lifecycle_event.event_body.pipeline_uuid.encode()) % len(self._shards)
+        await self._shards[shard].put(message)
 
+    async def _worker_loop(self, shard: asyncio.Queue) -> None:
+        while True:
+            message = await shard.get()
+            try:
+                await self._handle_message(message=message)
+            except Exception:
+                # Releasing or dead-lettering failed too - the message reappears once its visibility lapses, and the
+                # worker has to outlive it or its whole shard stops being consumed
+                self.log.exception(f"Could not settle message_id={message.message_id}")
             finally:
-                await sqs_client.delete_message(QueueUrl=kalytical_config.sqs_url, ReceiptHandle=message['ReceiptHandle'])
-    def _unmarshall_sqs(self, message_dict: dict) -> LifecycleEventModel:
+                shard.task_done()
+
+    async def _handle_message(self, message: TransportMessage) -> None:
+        heartbeat = asyncio.create_task(self._extend_visibility(message=message))
+        try:
+            await self._dispatcher.dispatch(lifecycle_event=message.lifecycle_event)
+            await self._ack_queue.put(message)
+        except MaxPipelineRetryReachedException as e:
+            # Out of retries is an outcome, not a failure to handle the event - redelivering it would only raise again
+            self.log.warning(f"message_id={message.message_id}: {e}")
+            await self._ack_queue.put(message)
+        except Exception as e:
+            if message.receive_count >= kalytical_config.mq_max_receive_count:
+                self.log.exception(f"Could not dispatch message_id={message.message_id} on any of receive_count={message.receive_count} attempts")
+                await self._transport.dead_letter(message, reason=str(e))
+            else:
+                self.log.exception(
+                    f"Could not dispatch message_id={message.message_id}, it will be redelivered")
+                await self._transport.release(message)
+        finally:
+            heartbeat.cancel()
+
+    async def _extend_visibility(self, message: TransportMessage) -> None:
+        # Keep a slow handler's message hidden so another consumer does not pick it up mid-dispatch
+        while True:
+            await asyncio.sleep(kalytical_config.sqs_visibility_timeout_seconds / 2)
+            try:
+                await self._transport.extend(message)
+            except Exception:
+                self.log.exception(f"Could not extend visibility of message_id={message.message_id}")
+
+    async def _ack_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._ack_queue.get()]
+            # Give a partially filled batch a moment to fill before paying for the round trip
+            deadline = loop.time() + kalytical_config.mq_ack_linger_seconds
+            while len(batch) < kalytical_config.mq_receive_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._ack_queue.get(), timeout=max(0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._transport.ack(batch)
+            except Exception:
+                self.log.exception(f"Could not acknowledge message_count={len(batch)}, they will be redelivered")
+
+    def _unmarshall_message(self, message_dict: dict) -> LifecycleEventModel:
         try:
             return LifecycleEventModel(event_type=message_dict['event_type'], event_body=JobLifecycleEventBody(**message_dict['event_body']))
 
         except Exception:
             self.log.exception(f"Could not parse lifecycle_event={message_dict}")
-    
+
     def shutdown(self):
         self.log.info("Shutting down poller!")
-        self._running = False
\ No newline at end of file
+        self._running = False
@@ -0,0 +1,241 @@
+import abc
+import asyncio
+from src.kalytical.models import LifecycleEventModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, List
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+kalytical_config = KalyticalConfig()
+
+# Hard limit imposed by SQS on receive_message and delete_message_batch
+SQS_MAX_BATCH_SIZE = 10
+# Deliveries a message has had, carried across the republish that delays an AMQP redelivery
+AMQP_RECEIVE_COUNT_HEADER = 'x-kalytical-receive-count'
+
+
+class TransportMessage():
+    """A received lifecycle event along with whatever the transport needs to acknowledge it.
+    In-process deliveries carry the parsed event, so the poller only decodes the body when lifecycle_event is None"""
+
+    def __init__(self, message_id: str, body: str = None, lifecycle_event: LifecycleEventModel = None, handle: Any = None, receive_count: int = 1):
+        self.message_id = message_id
+        self.body = body
+        self.lifecycle_event = lifecycle_event
+        self.handle = handle
+        # Deliveries so far, this one included
+        self.receive_count = receive_count
+
+
+class LifecycleEventTransport(abc.ABC):
+    """Moves lifecycle events between producers and MQ_Poller. Delivery is at-least-once - a message is only gone once acked"""
+
+    def __init__(self):
+        self.log = get_logger(self.__class__.__name__)
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def publish(self, lifecycle_event: LifecycleEventModel) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def receive(self) -> List[TransportMessage]:
+        """Wait for the next batch of messages. An empty list is a valid result"""
+        pass
+
+    @abc.abstractmethod
+    async def ack(self, messages: List[TransportMessage]) -> None:
+        pass
+
+    async def release(self, message: TransportMessage) -> None:
+        """Hand back a message that could not be handled so it is delivered again, after release_delay_seconds"""
+        pass
+
+    async def extend(self, message: TransportMessage) -> None:
+        """Keep a message that is still being handled from being redelivered"""
+        pass
+
+    async def dead_letter(self, message: TransportMessage, reason: str) -> None:
+        """Take a message that will never be handled out of circulation. Without a dead letter queue it is only logged"""
+        self.log.error(f"Dropping message_id={message.message_id} after receive_count={message.receive_count}: {reason} body={message.body}")
+        await self.ack([message])
+
+
+class SqsTransport(LifecycleEventTransport):
+    def __init__(self, sqs_client: Any, queue_url: str, dead_letter_url: str = None):
+        super().__init__()
+        # The client is opened once by the application context and shared for the lifetime of the process
+        self._sqs_client = sqs_client
+        self._queue_url = queue_url
+        self._dead_letter_url = dead_letter_url
+
+    async def publish(self, lifecycle_event: LifecycleEventModel) -> None:
+        await self._sqs_client.send_message(QueueUrl=self._queue_url, MessageBody=lifecycle_event.json())
+
+    async def receive(self) -> List[TransportMessage]:
+        response = await self._sqs_client.receive_message(QueueUrl=self._queue_url, MaxNumberOfMessages=SQS_MAX_BATCH_SIZE,
+                                                          WaitTimeSeconds=kalytical_config.sqs_wait_time_seconds,
+                                                          VisibilityTimeout=kalytical_config.sqs_visibility_timeout_seconds,
+                                                          AttributeNames=['ApproximateReceiveCount'])
+        return [TransportMessage(message_id=message['MessageId'], body=message['Body'], handle=message['ReceiptHandle'],
+                                 receive_count=int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)))
+                for message in response.get('Messages', [])]
+
+    async def ack(self, messages: List[TransportMessage]) -> None:
+        for i in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+            batch = messages[i:i + SQS_MAX_BATCH_SIZE]
+            entries = [{'Id': str(n), 'ReceiptHandle': message.handle} for n, message in enumerate(batch)]
+            response = await self._sqs_client.delete_message_batch(QueueUrl=self._queue_url, Entries=entries)
+            for failed in response.get('Failed', []):
+                self.log.error(
+                    f"Could not delete message_id={batch[int(failed['Id'])].message_id} code={failed.get('Code')}, it will be redelivered")
+
+    async def extend(self, message: TransportMessage) -> None:
+        await self._sqs_client.change_message_visibility(QueueUrl=self._queue_url, ReceiptHandle=message.handle,
+                                                         VisibilityTimeout=kalytical_config.sqs_visibility_timeout_seconds)
+
+    async def dead_letter(self, message: TransportMessage, reason: str) -> None:
+        if self._dead_letter_url is None:
+            return await super().dead_letter(message, reason=reason)
+        self.log.error(f"Moving message_id={message.message_id} to the dead letter queue after receive_count={message.receive_count}: {reason}")
+        await self._sqs_client.send_message(QueueUrl=self._dead_letter_url, MessageBody=message.body)
+        await self.ack([message])
+
+    async def release(self, message: TransportMessage) -> None:
+        # Shortening the visibility timeout to the backoff makes the message visible again once it has passed
+        await self._sqs_client.change_message_visibility(QueueUrl=self._queue_url, ReceiptHandle=message.handle,
+                                                         VisibilityTimeout=int(release_delay_seconds(message)))
+
+
+class AmqpTransport(LifecycleEventTransport):
+    """The broker pushes up to prefetch_count unacked messages to this consumer, so there is no polling delay.
+    A released message is parked on <queue>.retry until its expiration, when the queue dead-letters it back onto the
+    main queue. Messages that are given up on end up on <queue>.dead"""
+
+    def __init__(self, amqp_url: str, queue_name: str, prefetch_count: int):
+        super().__init__()
+        if aio_pika is None:
+            raise ImportError("aio_pika must be installed to use AmqpTransport")
+        self._amqp_url = amqp_url
+        self._queue_name = queue_name
+        self._prefetch_count = prefetch_count
+        self._retry_queue_name = f"{queue_name}.retry"
+        self._dead_queue_name = f"{queue_name}.dead"
+        self._connection = None
+        self._channel = None
+        self._deliveries = asyncio.Queue()
+
+    async def start(self) -> None:
+        self._connection = await aio_pika.connect_robust(self._amqp_url)
+        self._channel = await self._connection.channel()
+        await self._channel.set_qos(prefetch_count=self._prefetch_count)
+        queue = await self._channel.declare_queue(self._queue_name, durable=True)
+        # Nothing consumes the retry queue - expired messages are routed back through the default exchange
+        await self._channel.declare_queue(self._retry_queue_name, durable=True, arguments={
+            'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': self._queue_name})
+        await self._channel.declare_queue(self._dead_queue_name, durable=True)
+        await queue.consume(self._on_message)
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._connection.close()
+
+    async def _on_message(self, message: Any) -> None:
+        receive_count = int((message.headers or {}).get(AMQP_RECEIVE_COUNT_HEADER, 1)) + (1 if message.redelivered else 0)
+        await self._deliveries.put(TransportMessage(message_id=message.message_id or str(message.delivery_tag),
+                                                    body=message.body.decode(), handle=message, receive_count=receive_count))
+
+    async def publish(self, lifecycle_event: LifecycleEventModel) -> None:
+        await self._channel.default_exchange.publish(
+            aio_pika.Message(body=lifecycle_event.json().encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT), routing_key=self._queue_name)
+
+    async def receive(self) -> List[TransportMessage]:
+        return await _drain(self._deliveries)
+
+    async def ack(self, messages: List[TransportMessage]) -> None:
+        for message in messages:
+            await message.handle.ack()
+
+    async def release(self, message: TransportMessage) -> None:
+        # Per-message expiration only applies at the head of the retry queue, so a shorter delay can wait behind a longer one
+        await self._republish(message, routing_key=self._retry_queue_name, expiration=release_delay_seconds(message))
+
+    async def dead_letter(self, message: TransportMessage, reason: str) -> None:
+        self.log.error(f"Moving message_id={message.message_id} to queue={self._dead_queue_name} after receive_count={message.receive_count}: {reason}")
+        await self._republish(message, routing_key=self._dead_queue_name)
+
+    async def _republish(self, message: TransportMessage, routing_key: str, expiration: float = None) -> None:
+        # Published before the ack, so a crash in between redelivers the message rather than losing it
+        await self._channel.default_exchange.publish(aio_pika.Message(
+            body=message.body.encode(), message_id=message.message_id, delivery_mode=aio_pika.DeliveryMode.PERSISTENT, expiration=expiration,
+            headers={AMQP_RECEIVE_COUNT_HEADER: message.receive_count + 1}), routing_key=routing_key)
+        await message.handle.ack()
+
+
+class InProcessTransport(LifecycleEventTransport):
+    """Single-node broker. Events posted to the facade go straight to the poller without leaving the process"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._message_count = 0
+        self._delayed = set()
+
+    async def publish(self, lifecycle_event: LifecycleEventModel) -> None:
+        self._message_count += 1
+        await self._queue.put(TransportMessage(message_id=str(self._message_count), lifecycle_event=lifecycle_event))
+
+    async def receive(self) -> List[TransportMessage]:
+        return await _drain(self._queue)
+
+    async def ack(self, messages: List[TransportMessage]) -> None:
+        pass
+
+    async def release(self, message: TransportMessage) -> None:
+        # Put back from a task so the worker that released it is not held up for the delay
+        task = asyncio.create_task(self._put_later(message, delay_seconds=release_delay_seconds(message)))
+        self._delayed.add(task)
+        task.add_done_callback(self._delayed.discard)
+
+    async def _put_later(self, message: TransportMessage, delay_seconds: float) -> None:
+        await asyncio.sleep(delay_seconds)
+        message.receive_count += 1
+        await self._queue.put(message)
+
+    async def close(self) -> None:
+        # Anything still waiting out its delay is lost with the process, as everything else on this transport is
+        for task in self._delayed:
+            task.cancel()
+
+
+def release_delay_seconds(message: TransportMessage) -> float:
+    """Exponential backoff on the number of deliveries that have failed so far"""
+    return min(kalytical_config.mq_release_backoff_seconds * 2 ** (message.receive_count - 1), kalytical_config.mq_release_max_backoff_seconds)
+
+
+async def _drain(queue: asyncio.Queue) -> List[TransportMessage]:
+    # Block for the first message, then take whatever else is already waiting
+    messages = [await queue.get()]
+    while len(messages) < kalytical_config.mq_receive_batch_size and not queue.empty():
+        messages.append(queue.get_nowait())
+    return messages
+
+
+def transport_factory(transport_name: str, sqs_client: Any = None) -> LifecycleEventTransport:
+    if transport_name == 'SqsTransport':
+        return SqsTransport(sqs_client=sqs_client, queue_url=kalytical_config.sqs_url, dead_letter_url=kalytical_config.sqs_dead_letter_url)
+    if transport_name == 'AmqpTransport':
+        return AmqpTransport(amqp_url=kalytical_config.amqp_url, queue_name=kalytical_config.amqp_queue_name,
+                             prefetch_count=kalytical_config.amqp_prefetch_count)
+    if transport_name == 'InProcessTransport':
+        return InProcessTransport(maxsize=kalytical_config.in_process_queue_size)
+
+    raise NotImplementedError(f"transport_name={transport_name} not implemented")
@@ -0,0 +1,45 @@
+import math
+import threading
+from cachetools import TTLCache
+from src.kalytical.models import PipelineModel, PipelineHeaderModel
+from typing import Optional, Tuple
+
+
+class PipelineCache():
+    """Bounded TTL cache of pipeline definitions keyed by pipeline_uuid. Writes invalidate by document version"""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._lock = threading.Lock()
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        # The newest version each recent write produced, so a read that started before the write cannot put back an older copy
+        self._floor_versions = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pipeline_uuid: str) -> Optional[Tuple[PipelineModel, PipelineHeaderModel]]:
+        with self._lock:
+            entry = self._entries.get(pipeline_uuid)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, pipeline_model: PipelineModel) -> Tuple[PipelineModel, PipelineHeaderModel]:
+        entry = (pipeline_model, PipelineHeaderModel(
+            **pipeline_model.dict(exclude={'pipeline_body'})))
+        with self._lock:
+            if (pipeline_model.version or 0) >= self._floor_versions.get(pipeline_model.pipeline_uuid, 0):
+                self._entries[pipeline_model.pipeline_uuid] = entry
+        return entry
+
+    def invalidate(self, pipeline_uuid: str, version: int = None) -> None:
+        """Drop the entry. version is the one the write produced; None means the document was deleted"""
+        with self._lock:
+            self._entries.pop(pipeline_uuid, None)
+            self._floor_versions[pipeline_uuid] = math.inf if version is None else version
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': (self.hits / total) if total else None,
+                'size': len(self._entries), 'maxsize': self._entries.maxsize}
@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import defaultdict
+from kubernetes import client, watch
+from kubernetes.client.exceptions import ApiException
+from src.kalytical.models import RunningPipelineModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, Callable, Dict, List, Set
+
+kalytical_config = KalyticalConfig()
+
+
+class PodInformer():
+    """Watch-driven cache of kalytical pods, indexed by pipeline_uuid, exec_uuid and engine_status.
+    Pass list_func to follow another namespaced kind instead, and on_change to be told about every added or modified object"""
+    _index_keys = ['pipeline_uuid', 'exec_uuid', 'engine_status']
+
+    def __init__(self, core_client: client.CoreV1Api, namespace: str, label_selector: str, unmarshall: Callable[[client.V1Pod], RunningPipelineModel],
+                 list_func: Callable = None, on_change: Callable[[Any], None] = None):
+        self.log = get_logger(self.__class__.__name__)
+        self._core_client = core_client
+        self._list_func = list_func if list_func is not None else core_client.list_namespaced_pod
+        self._on_change = on_change
+        self._namespace = namespace
+        self._label_selector = label_selector
+        self._unmarshall = unmarshall
+
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, RunningPipelineModel] = {}
+        self._indexes: Dict[str, Dict[str, Set[str]]] = {
+            k: defaultdict(set) for k in self._index_keys}
+        self._resource_version = None
+        self._last_list_time = 0
+        self._synced = threading.Event()
+        self._running = False
+        self._watch = None
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        self.log.info("Shutting down pod informer!")
+        self._running = False
+        if self._watch is not None:
+            self._watch.stop()
+
+    @property
+    def has_synced(self) -> bool:
+        return self._synced.is_set()
+
+    def get_jobs(self, pipeline_uuid: str = None, exec_uuid: str = None, engine_status: List[str] = None) -> List[RunningPipelineModel]:
+        """Intersect the requested indexes - each filter is a dictionary lookup rather than a scan of the namespace"""
+        lookups = {'pipeline_uuid': None if pipeline_uuid is None else [pipeline_uuid],
+                   'exec_uuid': None if exec_uuid is None else [exec_uuid],
+                   'engine_status': engine_status}
+        with self._lock:
+            candidates = None
+            for key, values in lookups.items():
+                if values is None:
+                    continue
+                names = set()
+                for v in values:
+                    names |= self._indexes[key].get(v, set())
+                candidates = names if candidates is None else candidates & names
+            if candidates is None:
+                candidates = self._jobs.keys()
+            return [self._jobs[name] for name in candidates]
+
+    def _run(self) -> None:
+        while self._running:
+            try:
+                if self._resource_version is None or (time.monotonic() - self._last_list_time) > kalytical_config.pod_informer_resync_seconds:
+                    self._relist()
+                self._watch = watch.Watch()
+                for event in self._watch.stream(self._list_func, namespace=self._namespace, label_selector=self._label_selector,
+                                                resource_version=self._resource_version, timeout_seconds=kalytical_config.pod_informer_watch_timeout_seconds,
+                                                allow_watch_bookmarks=True):
+                    if not self._running:
+                        break
+                    self._apply_event(event)
+            except ApiException as e:
+                if e.status == 410:
+                    self.log.warn(
+                        f"resource_version={self._resource_version} is too old, resyncing pod cache")
+                    self._resource_version = None
+                else:
+                    self.log.exception("Pod watch failed, retrying")
+                    time.sleep(kalytical_config.pod_informer_retry_seconds)
+            except Exception:
+                self.log.exception("Pod watch failed, retrying")
+                time.sleep(kalytical_config.pod_informer_retry_seconds)
+        self.log.warn("Exiting")
+
+    def _relist(self) -> None:
+        pod_list = self._list_func(
+            namespace=self._namespace, label_selector=self._label_selector)
+        jobs = {}
+        for pod in pod_list.items:
+            # One object we cannot read must not stop the rest of the listing from being cached
+            try:
+                jobs[pod.metadata.name] = self._unmarshall(pod)
+            except Exception:
+                self.log.exception(f"Skipping object={pod.metadata.name} that could not be unmarshalled")
+        with self._lock:
+            self._jobs = {}
+            self._indexes = {k: defaultdict(set) for k in self._index_keys}
+            for name, job in jobs.items():
+                self._add(name, job)
+        self._resource_version = pod_list.metadata.resource_version
+        self._last_list_time = time.monotonic()
+        self._synced.set()
+        self.log.info(
+            f"Listed pod_count={len(jobs)} resource_version={self._resource_version}")
+        if self._on_change is not None:
+            # Anything that changed while we were not watching is only visible here
+            for pod in pod_list.items:
+                self._notify(pod)
+
+    def _apply_event(self, event: dict) -> None:
+        pod = event['object']
+        self._resource_version = pod.metadata.resource_version
+        if event['type'] == 'BOOKMARK':
+            return
+        name = pod.metadata.name
+        job = None
+        if event['type'] in ['ADDED', 'MODIFIED']:
+            try:
+                job = self._unmarshall(pod)
+            except Exception:
+                # The resourceVersion has already moved past this event, so the watch carries on with the next one
+                self.log.exception(f"Dropping object={name} from the cache, it could not be unmarshalled")
+        with self._lock:
+            self._remove(name)
+            if job is not None:
+                self._add(name, job)
+        if self._on_change is not None and event['type'] in ['ADDED', 'MODIFIED']:
+            self._notify(pod)
+
+    def _notify(self, pod: Any) -> None:
+        try:
+            self._on_change(pod)
+        except Exception:
+            self.log.exception(f"on_change failed for object={pod.metadata.name}")
+
+    def _add(self, name: str, job: RunningPipelineModel) -> None:
+        self._jobs[name] = job
+        for key in self._index_keys:
+            self._indexes[key][getattr(job, key)].add(name)
+
+    def _remove(self, name: str) -> None:
+        job = self._jobs.pop(name, None)
+        if job is None:
+            return
+        for key in self._index_keys:
+            names = self._indexes[key].get(getattr(job, key))
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._indexes[key][getattr(job, key)]
@@ -0,0 +1,80 @@
+import json
+from src.kalytical.models import PipelineHeaderModel
+from src.kalytical.utils import KalyticalConfig
+from typing import Any, List
+
+kalytical_config = KalyticalConfig()
+
+
+def pipeline_env(header_model: PipelineHeaderModel, reports_completion: bool = True) -> List[dict]:
+    """The environment every engine hands a pipeline, apart from the per run variables in run_env"""
+    return [{'name': 'PIPELINE_UUID', 'value': header_model.pipeline_uuid},
+            {'name': 'MQ_CALLBACK_URL', 'value': kalytical_config.mq_url},
+            {'name': 'KALYTICAL_AUTH_SECRET', 'value': kalytical_config.api_secret},
+            {'name': 'KALYTICAL_API_ENDPOINT', 'value': kalytical_config.api_endpoint},
+            # False when the engine reports the outcome instead of the pipeline, e.g. one shard of many
+            {'name': 'KALYTICAL_REPORT_COMPLETION', 'value': str(reports_completion).lower()}]
+
+
+def run_pod_name(exec_uuid: str, pipeline_uuid: str, retry_count: int = 0) -> str:
+    """The same for every attempt at creating one run, so a create the API server saw but did not answer ends in a 409"""
+    return f"{exec_uuid}-{pipeline_uuid}-{retry_count}"
+
+
+def run_env(exec_uuid: str, retry_count: int = 0, source_uuid: Any = None) -> List[dict]:
+    # Pipelines decode SOURCE_UUID twice - it has always been a JSON string holding the JSON of the triggers
+    return [{'name': 'SOURCE_UUID', 'value': json.dumps(json.dumps(source_uuid))},
+            {'name': 'EXEC_UUID', 'value': exec_uuid},
+            {'name': 'RETRY_COUNT', 'value': str(retry_count)}]
+
+
+class PodTemplate():
+    """The pod body for one version of a pipeline, built once. render() only fills in the fields that change per run
+    and shares every other part of the body between runs, so nothing in a rendered body may be modified in place"""
+
+    def __init__(self, header_model: PipelineHeaderModel, pod_source: str = 'kalytical', reports_completion: bool = True):
+        engine_args = header_model.engine_args
+        self.pipeline_uuid = header_model.pipeline_uuid
+        self._labels = {'pod_source': pod_source,
+                        'pipeline_uuid': header_model.pipeline_uuid}
+
+        container = {
+            'name': 'pipeline',
+            'image': engine_args.get('pipeline_image', kalytical_config.default_pipeline_image_uri),
+            'args': engine_args.get('pipeline_args', kalytical_config.k8spodengine_default_container_args),
+            'env': pipeline_env(header_model=header_model, reports_completion=reports_completion),
+            'resources': {'limits': {'cpu': str(engine_args['cpu_count']), 'memory': f"{engine_args['memory_gi']}Gi"}}
+        }
+        if 'pipeline_command' in engine_args:
+            container['command'] = engine_args['pipeline_command']
+        self._container = container
+
+        node_selector = {'kalytical.k8s.node/workload': 'pipeline'}
+        if 'instance_type' in engine_args:
+            node_selector['beta.kubernetes.io/instance-type'] = engine_args['instance_type']
+        # TODO Tolerations and selectors might not work for a generic use case
+        self._spec = {
+            'serviceAccountName': kalytical_config.k8spodengine_svc_account_name,
+            'nodeSelector': node_selector,
+            'tolerations': [{'key': 'node.kubernetes.io/pipeline', 'operator': 'Exists', 'effect': 'NoSchedule'}],
+            'securityContext': {'fsGroup': 100},
+            'restartPolicy': 'Never'
+        }
+
+    def render_idle(self, pod_name: str, pool_id: str, env: List[dict], command: List[str] = None) -> dict:
+        """A pod with this template's image, resources and placement that runs nothing until it is handed a run - see WarmPodPool"""
+        container = {k: v for k, v in self._container.items() if k not in ['args', 'command']}
+        container['env'] = env
+        if command is not None:
+            container['command'] = command
+        return {'apiVersion': 'v1', 'kind': 'Pod',
+                'metadata': {'name': pod_name, 'labels': {'pod_source': 'kalytical-warm', 'warm_pool': pool_id}},
+                'spec': {**self._spec, 'containers': [container]}}
+
+    def render(self, exec_uuid: str, retry_count: int = 0, source_uuid: Any = None) -> dict:
+        container = {**self._container, 'env': self._container['env'] + run_env(
+            exec_uuid=exec_uuid, retry_count=retry_count, source_uuid=source_uuid)}
+        return {'apiVersion': 'v1', 'kind': 'Pod',
+                'metadata': {'name': run_pod_name(exec_uuid=exec_uuid, pipeline_uuid=self.pipeline_uuid, retry_count=retry_count),
+                             'labels': {**self._labels, 'exec_uuid': exec_uuid}},
+                'spec': {**self._spec, 'containers': [container]}}
@@ -0,0 +1,323 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from kubernetes.client.rest import ApiException
+from src.kalytical.core.k8s_client import AsyncK8sClient
+from src.kalytical.models import PipelineHeaderModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+kalytical_config = KalyticalConfig()
+
+_QUANTITY_SUFFIXES = {'m': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12,
+                      'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40}
+
+
+def parse_quantity(quantity: Any) -> float:
+    """Convert a kubernetes resource quantity such as 500m or 16Gi to a plain number"""
+    quantity = str(quantity)
+    for suffix in sorted(_QUANTITY_SUFFIXES, key=len, reverse=True):
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * _QUANTITY_SUFFIXES[suffix]
+    return float(quantity)
+
+
+class TokenBucket():
+    def __init__(self, rate_per_second: float, burst: int):
+        self._rate = rate_per_second
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller back, e.g. after the API server asked us to slow down"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class _SubmissionRequest():
+    def __init__(self, header_model: PipelineHeaderModel, submit: Callable[[], Awaitable], demand: Dict[str, float], future: asyncio.Future,
+                 read_existing: Callable[[], Awaitable] = None):
+        self.header_model = header_model
+        self.submit = submit
+        self.read_existing = read_existing
+        self.demand = demand
+        self.future = future
+        self.enqueue_time = time.monotonic()
+
+
+class SubmissionScheduler():
+    """Sits in front of the engines so a large fan-out drains at a steady rate instead of all at once.
+    Requests are ordered by the priority_class tag of their pipeline, admitted only while the namespace ResourceQuota
+    has room for their cpu_count/memory_gi, rate limited by a token bucket and retried with backoff on 429 and 5xx.
+    A request that could never fit the quota is refused when it is queued, and one still waiting for room after
+    submission_admission_timeout_seconds is failed"""
+
+    def __init__(self, k8s_client: AsyncK8sClient, namespace: str):
+        self.log = get_logger(self.__class__.__name__)
+        self._k8s = k8s_client
+        self._namespace = namespace
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._bucket = TokenBucket(rate_per_second=kalytical_config.submission_rate_per_second,
+                                   burst=kalytical_config.submission_burst)
+        self._in_flight = None
+        self._headroom = None
+        self._hard = None
+        self._headroom_expires = 0
+        # Consecutive quota reads that failed, and whether not being allowed to read the quota was already reported
+        self._quota_failures = 0
+        self._quota_unreadable = False
+        self._task = None
+        self._runs = set()
+        self._stats = {'submitted': 0, 'failed': 0, 'retried': 0, 'throttled': 0, 'rejected': 0, 'expired': 0,
+                       'admission_waits': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(kalytical_config.submission_max_in_flight)
+        self._task = asyncio.create_task(self._schedule_loop())
+
+    def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        for _, _, request in self._queue:
+            if not request.future.done():
+                request.future.cancel()
+        self._queue = []
+
+    async def submit(self, header_model: PipelineHeaderModel, submit: Callable[[], Awaitable], read_existing: Callable[[], Awaitable] = None) -> Any:
+        """Queue submit() and return its result once it has been admitted and run. When a retried submit() gets a 409 because
+        an earlier attempt did create the object, read_existing() is returned in its place"""
+        demand = self._demand(header_model)
+        await self._refresh_quota()
+        self._check_fits(header_model, demand)
+        request = _SubmissionRequest(header_model=header_model, submit=submit, demand=demand,
+                                     future=asyncio.get_running_loop().create_future(), read_existing=read_existing)
+        heapq.heappush(self._queue, (self._priority(header_model), next(self._sequence), request))
+        self._wakeup.set()
+        return await request.future
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        depth_by_priority = {}
+        for priority, _, _ in self._queue:
+            depth_by_priority[priority] = depth_by_priority.get(priority, 0) + 1
+        started = self._stats['submitted'] + self._stats['failed']
+        return {**self._stats,
+                'queue_depth': len(self._queue),
+                'queue_depth_by_priority': depth_by_priority,
+                'oldest_wait_seconds': max([now - r.enqueue_time for _, _, r in self._queue], default=0),
+                'mean_wait_seconds': self._stats['total_wait_seconds'] / started if started > 0 else 0,
+                'headroom': self._headroom}
+
+    @staticmethod
+    def _priority(header_model: PipelineHeaderModel) -> int:
+        priority_class = (header_model.tags or {}).get('priority_class', kalytical_config.default_priority_class)
+        return kalytical_config.priority_classes.get(priority_class, kalytical_config.priority_classes[kalytical_config.default_priority_class])
+
+    @staticmethod
+    def _demand(header_model: PipelineHeaderModel) -> Dict[str, float]:
+        engine_args = header_model.engine_args or {}
+        # An indexed job runs up to parallelism shards at once, each with the pipeline's requests
+        pods = 1
+        if header_model.engine == 'K8sIndexedJobEngine' and 'completions' in engine_args:
+            pods = min(int(engine_args.get('parallelism', engine_args['completions'])), int(engine_args['completions']))
+        return {'cpu': parse_quantity(engine_args.get('cpu_count', 0)) * pods,
+                'memory': parse_quantity(engine_args.get('memory_gi', 0)) * 2 ** 30 * pods}
+
+    def _check_fits(self, header_model: PipelineHeaderModel, demand: Dict[str, float]) -> None:
+        # Waiting for room that the quota can never have would only hold up everything queued behind this
+        for resource, amount in demand.items():
+            if self._hard is not None and amount > self._hard.get(resource, float('inf')):
+                self._stats['rejected'] += 1
+                raise QuotaExceededException(
+                    f"pipeline_uuid={header_model.pipeline_uuid} requests {resource}={amount:g} but the quota in namespace={self._namespace} only allows {self._hard[resource]:g}")
+
+    def _expire_requests(self) -> None:
+        """Fail every queued request that has waited longer than submission_admission_timeout_seconds for admission"""
+        deadline = time.monotonic() - kalytical_config.submission_admission_timeout_seconds
+        expired = [entry for entry in self._queue if entry[2].enqueue_time < deadline]
+        if len(expired) == 0:
+            return
+        self._queue = [entry for entry in self._queue if entry[2].enqueue_time >= deadline]
+        heapq.heapify(self._queue)
+        for _, _, request in expired:
+            self._stats['expired'] += 1
+            if not request.future.done():
+                request.future.set_exception(AdmissionTimeoutException(
+                    f"pipeline_uuid={request.header_model.pipeline_uuid} was not admitted within {kalytical_config.submission_admission_timeout_seconds}s"))
+
+    async def _schedule_loop(self) -> None:
+        while True:
+            try:
+                while len(self._queue) == 0:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                self._expire_requests()
+                if len(self._queue) == 0:
+                    continue
+                _, _, request = self._queue[0]
+                if request.future.done():
+                    # The caller gave up while queued
+                    heapq.heappop(self._queue)
+                    continue
+                await self._refresh_quota()
+                try:
+                    # Queued before the quota was known, or the quota was lowered since
+                    self._check_fits(request.header_model, request.demand)
+                except QuotaExceededException as e:
+                    heapq.heappop(self._queue)
+                    request.future.set_exception(e)
+                    continue
+                if not await self._admit(request.demand):
+                    # Strict priority - nothing jumps the head of the queue, it waits for capacity or a higher priority request
+                    self._stats['admission_waits'] += 1
+                    if self._quota_failures == 0:
+                        # Re-read for the next attempt, unless reads are failing and backing off
+                        self._headroom_expires = 0
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=kalytical_config.submission_quota_refresh_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._queue)
+                await self._in_flight.acquire()
+                task = asyncio.create_task(self._run(request))
+                self._runs.add(task)
+                task.add_done_callback(self._on_run_done)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error while scheduling submissions!")
+                await asyncio.sleep(1)
+
+    def _on_run_done(self, task: asyncio.Task) -> None:
+        self._runs.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error("Submission task failed outside of its request", exc_info=task.exception())
+
+    async def _refresh_quota(self) -> None:
+        if time.monotonic() < self._headroom_expires:
+            return
+        try:
+            self._headroom, self._hard = await self._fetch_headroom()
+            self._quota_failures, self._quota_unreadable = 0, False
+        except ApiException as e:
+            if e.status not in [403, 404]:
+                # Admit against what was last known rather than stall every submission on one failed read
+                self._quota_failures += 1
+                delay = min(kalytical_config.submission_backoff_max_seconds,
+                            kalytical_config.submission_quota_refresh_seconds * 2 ** self._quota_failures)
+                self.log.warning(f"Could not read the quota in namespace={self._namespace} status={e.status}, keeping the last known headroom for {delay:g}s")
+                self._headroom_expires = time.monotonic() + delay
+                return
+            # Not allowed to see quotas, or the API is not there - submit as if there were none and let the API server enforce it
+            if not self._quota_unreadable:
+                self.log.warning(f"Cannot read the quota in namespace={self._namespace} status={e.status}, admitting without it")
+                self._quota_unreadable = True
+            self._headroom, self._hard = None, None
+        self._headroom_expires = time.monotonic() + kalytical_config.submission_quota_refresh_seconds
+
+    async def _admit(self, demand: Dict[str, float]) -> bool:
+        await self._refresh_quota()
+        if self._headroom is None:
+            # No ResourceQuota in the namespace - nothing to admit against
+            return True
+        if any(self._headroom.get(resource, float('inf')) < amount for resource, amount in demand.items()):
+            return False
+        # Pods admitted since the last refresh are not in the quota's used figures yet
+        for resource, amount in demand.items():
+            if resource in self._headroom:
+                self._headroom[resource] -= amount
+        return True
+
+    async def _fetch_headroom(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """What is free under the namespace ResourceQuotas, and their hard limits. Both None when there is no quota"""
+        quotas = await self._k8s.call(self._k8s.core_v1.list_namespaced_resource_quota, namespace=self._namespace)
+        if len(quotas.items) == 0:
+            return None, None
+        headroom, limits = {}, {}
+        for quota in quotas.items:
+            hard, used = quota.status.hard or {}, quota.status.used or {}
+            for resource in ['cpu', 'memory']:
+                for key in [f"limits.{resource}", f"requests.{resource}", resource]:
+                    if key in hard:
+                        free = parse_quantity(hard[key]) - parse_quantity(used.get(key, 0))
+                        headroom[resource] = min(headroom.get(resource, float('inf')), free)
+                        limits[resource] = min(limits.get(resource, float('inf')), parse_quantity(hard[key]))
+        return headroom, limits
+
+    async def _run(self, request: _SubmissionRequest) -> None:
+        wait_seconds = time.monotonic() - request.enqueue_time
+        self._stats['total_wait_seconds'] += wait_seconds
+        self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait_seconds)
+        try:
+            for attempt in range(kalytical_config.submission_max_attempts):
+                await self._bucket.acquire()
+                try:
+                    result = await request.submit()
+                except ApiException as e:
+                    if e.status == 409 and attempt > 0 and request.read_existing is not None:
+                        # An earlier attempt that got a 5xx was created after all
+                        self.log.info(f"Submit for pipeline_uuid={request.header_model.pipeline_uuid} was created by an earlier attempt")
+                        result = await request.read_existing()
+                    elif (e.status != 429 and e.status < 500) or attempt == kalytical_config.submission_max_attempts - 1:
+                        raise
+                    else:
+                        delay = self._backoff_seconds(e, attempt)
+                        if e.status == 429:
+                            # The API server is throttling everyone, not just this request
+                            self._stats['throttled'] += 1
+                            self._bucket.pause(delay)
+                        self._stats['retried'] += 1
+                        self.log.warning(
+                            f"Submit for pipeline_uuid={request.header_model.pipeline_uuid} got status={e.status}, retrying in {delay:.2f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                self._stats['submitted'] += 1
+                if not request.future.done():
+                    request.future.set_result(result)
+                return
+        except Exception as e:
+            self._stats['failed'] += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self._in_flight.release()
+
+    @staticmethod
+    def _backoff_seconds(e: ApiException, attempt: int) -> float:
+        retry_after = (e.headers or {}).get('Retry-After')
+        if retry_after is not None and str(retry_after).isdigit():
+            return float(retry_after)
+        # Full jitter keeps retries from a burst of failures from landing together
+        return random.uniform(0, min(kalytical_config.submission_backoff_max_seconds,
+                                     kalytical_config.submission_backoff_base_seconds * 2 ** attempt))
+
+
+class QuotaExceededException(Exception):
+    pass
+
+
+class AdmissionTimeoutException(Exception):
+    pass
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import math
+import uuid
+from datetime import datetime, timedelta
+from kubernetes.client.exceptions import ApiException
+from src.kalytical.core.data_provider import MongoDBProvider
+from src.kalytical.core.k8s_client import AsyncK8sClient
+from src.kalytical.core.pod_template import PodTemplate
+from src.kalytical.core.submission_scheduler import SubmissionScheduler, QuotaExceededException
+from src.kalytical.models import PipelineHeaderModel
+from src.kalytical.utils import KalyticalConfig, get_logger
+from typing import Any, Dict, List, Tuple
+
+kalytical_config = KalyticalConfig()
+
+
+class WarmPodPool():
+    """Idle, already scheduled pods per idle pod spec for pipelines with engine_args.warm_pool.
+    A warm pod polls /pipeline/dispatcher/warm_pool/claim with its name until a submit hands it a claim - the env, command and
+    args the run would have had as a cold pod - and then runs it in place. The image has to support this, by reading
+    KALYTICAL_WARM_POD_NAME at startup. Pools are refilled in the background to cover recent demand, one replica at a time,
+    and refills queue behind runs in the SubmissionScheduler like any other pod"""
+
+    def __init__(self, k8s_client: AsyncK8sClient, data_provider: MongoDBProvider, namespace: str, scheduler: SubmissionScheduler):
+        self.log = get_logger(self.__class__.__name__)
+        self._k8s = k8s_client
+        self._data_provider = data_provider
+        self._namespace = namespace
+        self._scheduler = scheduler
+        self._targets = {}
+        self._running = False
+        self._task = None
+
+    def start(self) -> None:
+        self._running = True
+        self._task = asyncio.create_task(self.refill_loop())
+
+    def shutdown(self) -> None:
+        self.log.info("Shutting down warm pod pool!")
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+
+    def idle_body(self, header_model: PipelineHeaderModel, template: PodTemplate) -> Tuple[str, dict]:
+        """The pool_id and idle pod body for runs of header_model. The pool is keyed on the whole body, so a pipeline whose
+        image, resources or placement changed gets a new pool rather than being handed pods built from the old spec"""
+        command = header_model.engine_args.get('warm_pool_command')
+        spec = template.render_idle(pod_name=None, pool_id=None, env=self._idle_env(None), command=command)
+        pool_id = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+        return pool_id, template.render_idle(pod_name=None, pool_id=pool_id, env=self._idle_env(pool_id), command=command)
+
+    async def claim(self, header_model: PipelineHeaderModel, template: PodTemplate, exec_uuid: str, source_uuid: Any = None, retry_count: int = 0) -> Any:
+        """Hand the run to an idle pod and relabel it as the run's pod. Returns the pod, or None to fall back to a cold start"""
+        pool_id, idle_body = self.idle_body(header_model=header_model, template=template)
+        pod = template.render(exec_uuid=exec_uuid, retry_count=retry_count, source_uuid=source_uuid)
+        container = pod['spec']['containers'][0]
+        claim = {'env': {e['name']: e['value'] for e in container['env']},
+                 'command': container.get('command'), 'args': container.get('args')}
+        pod_name = await self._data_provider.claim_warm_pod(pool_id=pool_id, claim=claim, polled_since=datetime.now() - timedelta(
+            seconds=kalytical_config.warm_pool_poll_stale_seconds))
+        demand_args = {k: header_model.engine_args[k] for k in ['cpu_count', 'memory_gi'] if k in header_model.engine_args}
+        await self._data_provider.record_warm_pool_request(pool_id=pool_id, hit=pod_name is not None, pod_body=json.dumps(idle_body), demand_args=demand_args)
+        if pod_name is None:
+            return None
+        self.log.info(
+            f"Handed exec_uuid={exec_uuid} to warm pod={pod_name} from pool_id={pool_id}")
+        try:
+            # From here on the pod is listed, logged and aborted like any other pod of the run
+            return await self._k8s.call(self._k8s.core_v1.patch_namespaced_pod, name=pod_name, namespace=self._namespace,
+                                        body={'metadata': {'labels': pod['metadata']['labels']}})
+        except ApiException:
+            if await self._data_provider.release_warm_pod(pod_name=pod_name, state='claimed'):
+                # Taken back before the pod saw it, so a cold start cannot run it twice
+                self.log.exception(f"Could not relabel warm pod={pod_name}, starting exec_uuid={exec_uuid} cold")
+                return None
+            raise
+
+    @staticmethod
+    def _idle_env(pool_id: str) -> List[dict]:
+        return [{'name': 'KALYTICAL_WARM_POOL', 'value': pool_id},
+                {'name': 'KALYTICAL_WARM_POD_NAME', 'valueFrom': {'fieldRef': {'fieldPath': 'metadata.name'}}},
+                {'name': 'KALYTICAL_AUTH_SECRET', 'value': kalytical_config.api_secret},
+                {'name': 'KALYTICAL_API_ENDPOINT', 'value': kalytical_config.api_endpoint}]
+
+    async def refill_loop(self):
+        while self._running:
+            try:
+                await self.refill()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error while trying to refill warm pod pools!")
+            finally:
+                await asyncio.sleep(kalytical_config.warm_pool_refill_interval_seconds)
+        self.log.warn("Exiting")
+
+    async def refill(self) -> None:
+        now = datetime.now()
+        pods = await self._data_provider.get_warm_pods(states=['starting', 'idle', 'claimed'])
+        for pool in await self._data_provider.get_warm_pools():
+            pool_id = pool['_id']
+            target = self._targets[pool_id] = self._target_size(pool, now)
+            if not await self._data_provider.lease_warm_pool_refill(pool_id=pool_id, seconds=kalytical_config.warm_pool_refill_interval_seconds):
+                continue
+            live = []
+            for pod in [p for p in pods if p['pool_id'] == pool_id]:
+                if self._is_stale(pod, now):
+                    await self._retire(pod)
+                elif pod['state'] != 'claimed':
+                    live.append(pod)
+            for _ in range(target - len(live)):
+                if not await self._create_pod(pool=pool):
+                    break
+            # Shrink slowly - only pods that have sat idle for a while go, so a short lull does not empty the pool
+            idle_since = now - timedelta(seconds=kalytical_config.warm_pool_idle_ttl_seconds)
+            excess = sorted([p for p in live if p['state'] == 'idle' and p['create_time'] < idle_since], key=lambda p: p['create_time'])
+            for pod in excess[:max(0, len(live) - target)]:
+                await self._retire(pod)
+            await self._data_provider.trim_warm_pool(pool_id=pool_id, buckets=self._expired_buckets(pool, now),
+                                                     remove=target == 0 and len(live) == 0)
+
+    def _target_size(self, pool: dict, now: datetime) -> int:
+        if pool.get('last_request_time', now) < now - timedelta(seconds=kalytical_config.warm_pool_idle_ttl_seconds):
+            # Nothing uses this spec any more, e.g. its pipelines were updated - let the pool drain despite warm_pool_min_size
+            return 0
+        window = kalytical_config.warm_pool_demand_window_seconds
+        demand = sum(count for bucket, count in pool.get('demand', {}).items() if bucket not in self._expired_buckets(pool, now))
+        # Enough pods for the runs expected while a replacement pod is still starting
+        target = math.ceil(demand / window * kalytical_config.warm_pool_lead_seconds)
+        return max(kalytical_config.warm_pool_min_size, min(kalytical_config.warm_pool_max_size, target))
+
+    @staticmethod
+    def _expired_buckets(pool: dict, now: datetime) -> List[str]:
+        oldest = int((now.timestamp() - kalytical_config.warm_pool_demand_window_seconds) // 60)
+        return [bucket for bucket in pool.get('demand', {}) if int(bucket) < oldest]
+
+    @staticmethod
+    def _is_stale(pod: dict, now: datetime) -> bool:
+        if pod['state'] == 'idle':
+            return pod['last_poll_time'] < now - timedelta(seconds=kalytical_config.warm_pool_poll_stale_seconds)
+        # Never came up, or never picked up its claim - either way the pod is not going to do anything
+        started_by = pod['claim_time'] if pod['state'] == 'claimed' else pod['create_time']
+        return started_by < now - timedelta(seconds=kalytical_config.warm_pool_start_timeout_seconds)
+
+    async def _create_pod(self, pool: dict) -> bool:
+        """Queue one pod for pool in the SubmissionScheduler. False when there is no room for it before the next refill"""
+        pool_id = pool['_id']
+        pod_name = f"warm-{pool_id}-{uuid.uuid4().hex[:8]}"
+        pod_body = json.loads(pool['pod_body'])
+        pod_body['metadata']['name'] = pod_name
+
+        async def create():
+            await self._data_provider.register_warm_pod(pod_name=pod_name, pool_id=pool_id)
+            try:
+                await self._k8s.call(self._k8s.core_v1.create_namespaced_pod, namespace=self._namespace, body=pod_body)
+            except Exception:
+                await self._data_provider.release_warm_pod(pod_name=pod_name, state='starting')
+                raise
+
+        # Counted against the quota and paced like a run, but behind every run waiting for room
+        header_model = PipelineHeaderModel(pipeline_uuid=f"warm-{pool_id}", description='warm pool refill', engine='K8sPodEngine',
+                                           engine_args=pool.get('demand_args', {}), tags={'priority_class': kalytical_config.warm_pool_priority_class})
+        try:
+            await asyncio.wait_for(self._scheduler.submit(header_model=header_model, submit=create),
+                                   timeout=kalytical_config.warm_pool_refill_interval_seconds)
+            return True
+        except (asyncio.TimeoutError, QuotaExceededException):
+            self.log.info(f"No room to add a warm pod to pool_id={pool_id}, trying again next refill")
+            return False
+
+    async def _retire(self, pod: dict) -> None:
+        if not await self._data_provider.release_warm_pod(pod_name=pod['_id'], state=pod['state']):
+            return
+        try:
+            await self._k8s.call(self._k8s.core_v1.delete_namespaced_pod, name=pod['_id'], namespace=self._namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    async def stats(self) -> Dict[str, Any]:
+        pods = await self._data_provider.get_warm_pods()
+        since = datetime.now() - timedelta(seconds=kalytical_config.warm_pool_demand_window_seconds)
+        pool_stats = {}
+        for pool in await self._data_provider.get_warm_pools():
+            pool_id = pool['_id']
+            pool_pods = [p for p in pods if p['pool_id'] == pool_id]
+            latencies = sorted((p['picked_up_time'] - p['claim_time']).total_seconds() for p in pool_pods
+                               if p['state'] == 'started' and p['picked_up_time'] >= since)
+            hits, misses = pool.get('hits', 0), pool.get('misses', 0)
+            pool_stats[pool_id] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0,
+                'target_size': self._targets.get(pool_id),
+                'idle': sum(1 for p in pool_pods if p['state'] == 'idle'),
+                'starting': sum(1 for p in pool_pods if p['state'] == 'starting'),
+                # Claim to pickup - how long a warm run waited between submit and starting
+                'mean_start_seconds': sum(latencies) / len(latencies) if latencies else None,
+                'p95_start_seconds': latencies[int(0.95 * (len(latencies) - 1))] if latencies else None}
+        return pool_stats
@@ -7,15 +7,14 @@ from typing import Any, Dict, List
 from models import IncubatingPipelineModel
 from fastapi import Depends, FastAPI, HTTPException
 from datetime import datetime
-from core import provider_factory, EngineManager, KDispatcher, gen_uuid
+from core import AppContext, EngineManager, KDispatcher, LifecycleEventTransport, MongoDBProvider, NotFoundError, QueryException, gen_uuid
 from auth import RoleChecker
 from utils import get_logger, KalyticalConfig
-from models import PipelineModel, PipelineHeaderModel, RunningPipelineModel, JobLifecycleEventBody, LifecycleEventModel
-from core import SQS_Poller, IncubatingJobCuller
+from models import PipelineModel, PipelineHeaderModel, PipelineApplyResultModel, RunningPipelineModel, JobLifecycleEventBody, LifecycleEventModel, JobQueryModel, JobPageModel, EventDispatchResultModel, EventHistoryPageModel
 
 kalytical_config = KalyticalConfig()
 
-app = FastApi(title=f"Kalytical API - {kalytical_config.env_name}",
+app = FastAPI(title=f"Kalytical API - {kalytical_config.env_name}",
               description = 'Kalytical Job Service API - Provides a common entrypoint to manage event driven pipeline operations',
               version=kalytical_config.build_version,
               contct={
@@ -24,127 +23,207 @@ app = FastApi(title=f"Kalytical API - {kalytical_config.env_name}",
 
 
 module_logger = get_logger('facade')
-0
-a_data_provider = provider_factory(db_engine=kalytical_config.db_provider)
+
+app_context = AppContext()
+
+
+@app.on_event("startup")
+async def startup_app_context():
+    await app_context.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown_app_context():
+    await app_context.shutdown()
+
+
+def get_data_provider() -> MongoDBProvider:
+    return app_context.data_provider
+
+
+def get_dispatcher() -> KDispatcher:
+    return app_context.dispatcher
+
+
+def get_engine_manager() -> EngineManager:
+    return app_context.engine_mgr
+
+
+def get_mq_transport() -> LifecycleEventTransport:
+    return app_context.mq_transport
+
 
 @app.post("/pipeline/config/list", dependencies=[Depends(RoleChecker(allowed_roles['read']))], response_model=List[PipelineHeaderModel])
 async def list_pipeline_definitions(pipeline_prefix: str, filter_tags: str):
     pass
 @app.get("/pipeline/config/describe", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=PipelineModel)
-async def describe_pipeline_definition(pipeline_uuid: str) -> PipelineModel:
-    result = await a_data_provider.describe_pipeline(pipeline_uuid=pipeline_uuid)
+async def describe_pipeline_definition(pipeline_uuid: str, data_provider: MongoDBProvider = Depends(get_data_provider)) -> PipelineModel:
+    result = await data_provider.describe_pipeline(pipeline_uuid=pipeline_uuid)
     if result is None:
         raise HTTPException(status_code=404, detail=f'No pipeline_uuid={pipeline_uuid} definition was found')
 
     return result
 
 @app.delete("/pipeline/config/delete", dependencies=[Depends(RoleCHecker(allowed_roles=['read']))], response_model=Dict[str, bool])
-async def delete_all_pipeline_definitions(pipeline_prefix: str = NOne, filter_tags: Dict[str, str] = None) -> Dict(str, bool):
+async def delete_pipeline_definition(pipeline_uuid: str, data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, bool]:
     try:
-        return {"operation_result": await a_data_provider.delete_pipeline(pipeline_uuid)}
+        return {"operation_result": await data_provider.delete_pipeline(pipeline_uuid)}
     except KeyError as e:
         module_logger.exception('Deleting this pipeline would have resulted in orphans')
         raise HTTPException(status_code=404, detail=f"Unable to delete pipeline reason={str(e)}")
     
 @app.delete("/pipeline/config/flush", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
-async def delete_all_pipeline_definitions(pipeline_prefix: str = None, filter_tags: Dict[str, str] = None) -> Dict[str, bool]:
-    return {"operation_result": await a_data_provider.flush_pipelines(pipeline_prefix=pipeline_prefix, filter_tags=filter_tags)}
+async def delete_all_pipeline_definitions(pipeline_prefix: str = None, filter_tags: Dict[str, str] = None, data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, bool]:
+    return {"operation_result": await data_provider.flush_pipeline(pipeline_prefix=pipeline_prefix, filter_tags=filter_tags)}
+
+@app.post("/pipeline/config/apply", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=PipelineApplyResultModel)
+async def apply_pipeline_definitions(pipeline_models: List[PipelineModel], prune: bool = False, dry_run: bool = False, data_provider: MongoDBProvider = Depends(get_data_provider)) -> PipelineApplyResultModel:
+    # Only definitions whose content_hash changed are written - resending an unchanged set is cheap
+    try:
+        return await data_provider.apply_pipelines(pipeline_models=pipeline_models, prune=prune, dry_run=dry_run)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=f"Failed to apply pipelines reason={str(e)}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Failed to apply pipelines reason={str(e)}")
+
+@app.get("/pipeline/config/hashes", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=Dict[str, str])
+async def get_pipeline_definition_hashes(pipeline_prefix: str = None, data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, str]:
+    return await data_provider.get_pipeline_hashes(pipeline_prefix=pipeline_prefix)
 
 @app.post("/pipeline/config/create_or_replace", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
-async def create_or_replace_pipeline_definition(pipeline_uuid: PipelineModel):
+async def create_or_replace_pipeline_definition(pipeline_model: PipelineModel, data_provider: MongoDBProvider = Depends(get_data_provider)):
     try:
-        return {"operation_result": await a_data_provider.create_or_update_pipeline(pipeline_model)}
+        return {"operation_result": await data_provider.create_or_update_pipeline(pipeline_model)}
     except LookupError as e:
         module_logger.exception("There was a problem creating or updating this pipeline")
         raise HTTPException(status_code=404, details=f"Failed to create pipeline_uuid={pipeline_model.pipeline_uuid} reason={str(e)}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Failed to create pipeline_uuid={pipeline_model.pipeline_uuid} reason={str(e)}")
 
 @app.get("/pipeline/config/downstream", dependencies=[Depends(ROleChecker(allowed_roles=['read']))], response_model=List[PipelineHeaderModel])
-async def head_downstream_pipeline_definitions(pipeline_uuid: str) -> List[PipelineHeaderModel]:
-    return await a_data_provider.head_downstream_pipelines(pipeline_uuid)
+async def head_downstream_pipeline_definitions(pipeline_uuid: str, data_provider: MongoDBProvider = Depends(get_data_provider)) -> List[PipelineHeaderModel]:
+    return await data_provider.head_downstream_pipelines(pipeline_uuid)
 
 @app.get("/pipeline_config/fetch_pipeline_body", dependencies=[Depends(RoleChecker(allowed_roles=['read']))])
-async def retrieve_a_pipeline_body_by_uuid(pipeline_uuid: str):
-    result = await a_data_provider.fetch_pipeline_body_by_uuid(pipeline_uuid=pipeline_uuid)
+async def retrieve_a_pipeline_body_by_uuid(pipeline_uuid: str, data_provider: MongoDBProvider = Depends(get_data_provider)):
+    result = await data_provider.fetch_pipeline_body_by_uuid(pipeline_uuid=pipeline_uuid)
     if result is None:
         raise HTTPException(status_code=404, detail=f"pipeline_uuid={pipeline_uuid} body could not be found!")
     return result
 
 @app.post("/pipeline/dispatcher/run_by_pipeline_uuid", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Any)
-async def run_pipeline_by_pipeline_uuid(pipeline_uuid: str, requestor: str = 'api_call') -> RunningPipelineModel:
+async def run_pipeline_by_pipeline_uuid(pipeline_uuid: str, requestor: str = 'api_call', a_dispatcher: KDispatcher = Depends(get_dispatcher)) -> RunningPipelineModel:
     lifecycle_body = JobLifecycleEventBody(pipeline_uuid=pipeline_uuid, event_subtype='origination', event_time=datetime.now(), exec_uuid=gen_uuid(), source_uuid=requestor)
     lifecycle_event = LifecycleEventModel(event_type='job_exec_update', event_body=lifecycle_body)
-    a_dispatcher = KDispatcher()
     module_logger.info(f"Received lifecycle_event={lifecycle_event}")
-    return await a_dispatcher.dispatch(lifecycle_event=lifecycle_event
+    return await a_dispatcher.dispatch(lifecycle_event=lifecycle_event)
     
-@app.post("/pipeline/dispatcher/run_single_use", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))]), response_model=RunningPipelineModel)
-async def run_single_use_pipeline_definition(pipeline_model: PipelineModel) -> RunningPIpelineModel:
-    engine_mgr = EngineManager()
+@app.post("/pipeline/dispatcher/run_single_use", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=RunningPipelineModel)
+async def run_single_use_pipeline_definition(pipeline_model: PipelineModel, engine_mgr: EngineManager = Depends(get_engine_manager)) -> RunningPipelineModel:
     return await engine_mgr.submit_job(pipeline_model, exec_uuid=gen_uuid(), source_uuid="singleuse")
 
 @app.get("/pipeline/dispatcher/running", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=List[RunningPipelineModel])
-async def get_list_of_running_pipelines_with_filter(engine_name: str = None, limit: int = 10, pipeline_uuid: str = None) -> List[RunningPipelineModel]:
-    engine_mgr = EngineManager()
-    return await engine_mgr.get_filtered_jobs(status=['running', 'waiting','pending'], engine_name=engine_name, limit=limit, pipeline_uuid=pipeline_uuid)
+async def get_list_of_running_pipelines_with_filter(engine_name: str = None, limit: int = 10, pipeline_uuid: str = None, data_provider: MongoDBProvider = Depends(get_data_provider)) -> List[RunningPipelineModel]:
+    # Answered from the execution ledger - use /pipeline/dispatcher/running/page to ask the engines directly
+    return await data_provider.get_executions(states=['pending', 'running'], engine_name=engine_name, limit=limit, pipeline_uuid=pipeline_uuid)
+
+@app.get("/pipeline/dispatcher/running/page", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=JobPageModel)
+async def get_page_of_running_pipelines(engine_name: str = 'K8sPodEngine', limit: int = 10, pipeline_uuid: str = None, continue_token: str = None, engine_mgr: EngineManager = Depends(get_engine_manager)) -> JobPageModel:
+    query = JobQueryModel(engine_status=['running', 'waiting', 'pending'], pipeline_uuid=pipeline_uuid, limit=limit, continue_token=continue_token)
+    return await engine_mgr.query_jobs(engine_name=engine_name, query=query)
 
 @app.get("/pipeline/dispatcher/get_logs", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=dict)
-async def get_logs(engine_tracking_id: str, engine_name: str = 'K8sPodEngine', max_kb: int = 10, from_beginning: bool = False) -> dict:
-    engine_mgr = EngineManager()
+async def get_logs(engine_tracking_id: str, engine_name: str = 'K8sPodEngine', max_kb: int = 10, from_beginning: bool = False, engine_mgr: EngineManager = Depends(get_engine_manager)) -> dict:
     return {'logs': await engine_mgr.get_job_logs(engine_name = engine_name, engine_tracking_id=engine_tracking_id, max_kb=max_kb, from_beginning=from_beginning)}
 
 @app.delete("/pipeline/dispatcher/abort_pipeline", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=dict)
-async def abort_pipeline(engine_name: str, engine_tracking_id: str) -> dict:
-    engine_mgr = EngineManager()
+async def abort_pipeline(engine_name: str, engine_tracking_id: str, engine_mgr: EngineManager = Depends(get_engine_manager)) -> dict:
     return await engine_mgr.abort_pipeline(engine_name = engine_name, engine_tracking_id=engine_tracking_id)
 
+@app.post("/pipeline/dispatcher/warm_pool/claim", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=dict)
+async def poll_warm_pod_claim(pod_name: str, data_provider: MongoDBProvider = Depends(get_data_provider)) -> dict:
+    # Polled by idle warm pods - an empty claim means keep waiting, a 410 means the pod was retired and should exit
+    try:
+        return {'claim': await data_provider.poll_warm_pod(pod_name=pod_name)}
+    except NotFoundError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
 @app.post("/pipeline/dispatcher/event", dependcies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=List[RunningPipelineModel])
-async def report_pipeline_event(lifecycle_event: LifecycleEventModel) -> List[RunningPipelineModel]:
-    a_dispatcher = KDispatcher()
+async def report_pipeline_event(lifecycle_event: LifecycleEventModel, a_dispatcher: KDispatcher = Depends(get_dispatcher)) -> List[RunningPipelineModel]:
     module_logger.info(f"Received event={lifecycle_event}")
     return await a_dispatcher.dispatch(lifecycle_event=lifecycle_event)
 
-@app.get("/pipeline/dispatcher/event/history", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=List[dict])
-async def get_job_lifecycle_event_history(since_seconds: int = 1000, max_records: int = 20, pipeline_uuid: str = None, event_type: str = 'job_exec_update', event_subtype: str = None, source_uuid: str = None, exec_uuid: str = None):
-    pass
+@app.post("/pipeline/dispatcher/events", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=List[EventDispatchResultModel])
+async def report_pipeline_events(lifecycle_events: List[LifecycleEventModel], a_dispatcher: KDispatcher = Depends(get_dispatcher)) -> List[EventDispatchResultModel]:
+    if len(lifecycle_events) > kalytical_config.dispatch_batch_max_events:
+        raise HTTPException(status_code=413, detail=f"At most {kalytical_config.dispatch_batch_max_events} events can be sent in one batch")
+    return await a_dispatcher.dispatch_batch(lifecycle_events=lifecycle_events)
+
+@app.post("/pipeline/dispatcher/event/publish", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
+async def publish_pipeline_event(lifecycle_event: LifecycleEventModel, mq_transport: LifecycleEventTransport = Depends(get_mq_transport)) -> Dict[str, bool]:
+    # Returns once the event is on the configured transport - with InProcessTransport it never leaves this process
+    await mq_transport.publish(lifecycle_event=lifecycle_event)
+    return {'published': True}
+
+@app.get("/pipeline/dispatcher/event/history", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=EventHistoryPageModel)
+async def get_job_lifecycle_event_history(since_seconds: int = 1000, max_records: int = 20, pipeline_uuid: str = None, event_type: str = 'job_exec_update', event_subtype: str = None, source_uuid: str = None, exec_uuid: str = None, cursor: str = None, data_provider: MongoDBProvider = Depends(get_data_provider)) -> EventHistoryPageModel:
+    try:
+        return await data_provider.get_event_history(since_seconds=since_seconds, max_records=min(max_records, kalytical_config.event_history_max_page_size), pipeline_uuid=pipeline_uuid,
+                                                     event_type=event_type, event_subtype=event_subtype, source_uuid=source_uuid, exec_uuid=exec_uuid, cursor=cursor)
+    except QueryException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/pipeline/dispatcher/event/history/flush", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
+async def delete_job_lifecycle_event_history(older_than_seconds: int = None, pipeline_uuid: str = None, data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, bool]:
+    return {"operation_result": await data_provider.flush_event_history(older_than_seconds=older_than_seconds, pipeline_uuid=pipeline_uuid)}
 @app.get("/pipeline/incubation/update", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=IncubatingPipelineModel)
-async def update_incubating_pipeline_dependencies(obj_id: str, update_deps_dict: Dict[str, str]) -> List[IncubatingPipelineModel]:
-    result = await a_data_provider.update_incubating_pipelines(obj_id=obj_id, new_update_deps_dict=update_deps_dict)
+async def update_incubating_pipeline_dependencies(obj_id: str, update_deps_dict: Dict[str, str], expected_version: int = None, data_provider: MongoDBProvider = Depends(get_data_provider), a_dispatcher: KDispatcher = Depends(get_dispatcher)) -> List[IncubatingPipelineModel]:
+    result = await data_provider.update_incubating_pipelines(obj_id=obj_id, new_update_deps_dict=update_deps_dict, expected_version=expected_version)
     if result is None:
         raise HTTPException(status_code=404, detail=f"Could not udpate entry for id={obj_id}")
+    # An edit that satisfies the last trigger launches the run straight away
+    await a_dispatcher.resolve_incubation(incubating=result)
     return result
 
 @app.delete("/pipeline/incubation/delete", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
-async def delete_incubating_pipeline(obj_id: str) -> Dict[str, bool]:
-    return {'operation_result': await a_data_provider.delete_incubating_pipeline(obj_id=obj_id)}
+async def delete_incubating_pipeline(obj_id: str, data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, bool]:
+    return {'operation_result': await data_provider.delete_incubating_pipeline(obj_id=obj_id)}
 
 @app.delete("/pipeline_incubation/flush", dependencies=[Depends(RoleChecker(allowed_roles=['admin']))], response_model=Dict[str, bool])
-async def delete_all_incubating_pipelines() -> Dict[str, bool]:
-    return {'operation_result': await a_data_provider.clear_incubating_pipelines()}
+async def delete_all_incubating_pipelines(data_provider: MongoDBProvider = Depends(get_data_provider)) -> Dict[str, bool]:
+    return {'operation_result': await data_provider.clear_incubating_pipelines()}
 
 @app.get("sys/config", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=dict)
 async def get_current_kalytical_config() -> dict:
     return kalytical_config.dict()
 
+@app.get("/sys/pool_stats", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=dict)
+async def get_connection_pool_stats() -> dict:
+    return app_context.pool_stats()
 
-def shutdown():
-    module_logger.warn("attempting graceful shutdown")
-    mq_poller.shutdown()
-    job_culler.shutdown()
+@app.get("/sys/submission_stats", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=dict)
+async def get_submission_scheduler_stats(engine_mgr: EngineManager = Depends(get_engine_manager)) -> dict:
+    return engine_mgr.submission_stats()
 
-    module_logger.warn("Shutdown completed.")
+@app.get("/sys/warm_pool_stats", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=dict)
+async def get_warm_pool_stats(engine_mgr: EngineManager = Depends(get_engine_manager)) -> dict:
+    return await engine_mgr.warm_pool_stats()
 
-    main_loop.stop()
+@app.get("/sys/cache_stats", dependencies=[Depends(RoleChecker(allowed_roles=['read']))], response_model=dict)
+async def get_pipeline_cache_stats(data_provider: MongoDBProvider = Depends(get_data_provider)) -> dict:
+    return data_provider.cache_stats()
 
-mq_poller = MQ_Poller()
-job_culler = IncubatingJobCuller()
+
+def shutdown():
+    module_logger.warn("attempting graceful shutdown")
+    # uvicorn runs the shutdown event, which closes the application context, before serve() returns
+    uv_server.should_exit = True
 
 module_logger.info('Initializing...')
 
 main_loop = asyncio.new_event_loop()
 uv_config = uvicorn.Config(app=app, host="0.0.0.0", port=80, loop=main_loop)
 uv_server = uvicorn.Server(config=uv_config)
-main_loop.cdreate_task(mq_poller.fetch_message_loop())
-main_loop.create_task(job_culler.cull_jobs_loop())
-main_loop.create_task(uv_server.serve())
 main_loop.add_signal_handler(signal.SIGINT, shutdown)
-main_loop.run_forever()
+main_loop.run_until_complete(uv_server.serve())
+module_logger.warn("Shutdown completed.")
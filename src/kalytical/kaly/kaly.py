@@ -0,0 +1,198 @@
+"""Command line utility for the kalytical API facade.
+
+    kaly apply pipelines/ [--dry-run] [--prune] [--prefix PREFIX]
+    kaly create pipeline pipeline.yaml
+"""
+import argparse
+import os
+import sys
+import requests
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from src.kalytical.models import PipelineModel
+from typing import Dict, List, Set
+
+DEFAULT_WORKERS = 8
+DEFAULT_BATCH_SIZE = 100
+
+
+class KalyClient():
+    """One keep-alive session to the facade, with a connection for every worker that shares it"""
+
+    def __init__(self, endpoint: str, token: str, workers: int = DEFAULT_WORKERS, timeout_seconds: float = 60):
+        self._endpoint = endpoint.rstrip('/')
+        self._timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f"Bearer {token}", 'accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(method, f"{self._endpoint}{path}", timeout=self._timeout_seconds, **kwargs)
+        if not response.ok:
+            raise KalyException(f"{method} {path} failed with status={response.status_code} body={response.text}")
+        return response
+
+    def get_hashes(self, prefix: str = None) -> Dict[str, str]:
+        return self._request('GET', '/pipeline/config/hashes', params={} if prefix is None else {'pipeline_prefix': prefix}).json()
+
+    def apply(self, pipeline_models: List[PipelineModel]) -> dict:
+        return self._request('POST', '/pipeline/config/apply', json=[m.dict(exclude={'version', 'scheduler_tracking_id'}) for m in pipeline_models]).json()
+
+    def create_or_replace(self, pipeline_model: PipelineModel) -> dict:
+        return self._request('POST', '/pipeline/config/create_or_replace', json=pipeline_model.dict(exclude={'version', 'scheduler_tracking_id'})).json()
+
+    def delete(self, pipeline_uuid: str) -> dict:
+        return self._request('DELETE', '/pipeline/config/delete', params={'pipeline_uuid': pipeline_uuid}).json()
+
+
+class KalyException(Exception):
+    pass
+
+
+def load_pipeline_tree(root: Path) -> Dict[str, PipelineModel]:
+    """Every pipeline in the .yaml/.yml files under root. A file can hold several pipelines as separate YAML documents"""
+    paths = [root] if root.is_file() else sorted(p for p in root.rglob('*') if p.suffix in ['.yaml', '.yml'])
+    pipelines, sources, errors = {}, {}, []
+    for path in paths:
+        try:
+            with open(path) as f:
+                documents = [d for d in yaml.safe_load_all(f) if d is not None]
+        except yaml.YAMLError as e:
+            errors.append(f"{path}: {e}")
+            continue
+        for document in documents:
+            try:
+                pipeline_model = PipelineModel(**document)
+            except Exception as e:
+                errors.append(f"{path}: {e}")
+                continue
+            if pipeline_model.pipeline_uuid in pipelines:
+                errors.append(f"{path}: pipeline_uuid={pipeline_model.pipeline_uuid} is also defined in {sources[pipeline_model.pipeline_uuid]}")
+                continue
+            pipelines[pipeline_model.pipeline_uuid] = pipeline_model
+            sources[pipeline_model.pipeline_uuid] = path
+    if len(errors) > 0:
+        raise KalyException('\n'.join(errors))
+    return pipelines
+
+
+def validate_trigger_graph(pipelines: Dict[str, PipelineModel], known: Set[str] = None) -> None:
+    """Triggers have to name a pipeline in the tree or in known, and must not form a cycle. With known None, triggers
+    outside the tree are left for the server to check"""
+    errors = []
+    for pipeline_model in pipelines.values():
+        for trigger in (pipeline_model.triggers_on.pipeline_uuids if pipeline_model.triggers_on else []):
+            if trigger not in pipelines and known is not None and trigger not in known:
+                errors.append(f"pipeline_uuid={pipeline_model.pipeline_uuid} is triggered by pipeline_uuid={trigger} which does not exist")
+    # Depth first search over the trigger edges - a node seen again while still on the path closes a cycle
+    state = {}
+
+    def visit(pipeline_uuid: str, path: List[str]):
+        state[pipeline_uuid] = 'visiting'
+        pipeline_model = pipelines.get(pipeline_uuid)
+        for trigger in (pipeline_model.triggers_on.pipeline_uuids if pipeline_model is not None and pipeline_model.triggers_on else []):
+            if state.get(trigger) == 'visiting':
+                errors.append(f"Trigger cycle {' -> '.join(path[path.index(trigger):] + [trigger])}")
+            elif trigger not in state:
+                visit(trigger, path + [trigger])
+        state[pipeline_uuid] = 'done'
+
+    for pipeline_uuid in sorted(pipelines):
+        if pipeline_uuid not in state:
+            visit(pipeline_uuid, [pipeline_uuid])
+    if len(errors) > 0:
+        raise KalyException('\n'.join(errors))
+
+
+def trigger_layers(changed: List[PipelineModel]) -> List[List[PipelineModel]]:
+    """Split changed pipelines so each one comes after the changed pipelines it is triggered by - the server checks that triggers exist"""
+    remaining = {m.pipeline_uuid: m for m in changed}
+    layers = []
+    while len(remaining) > 0:
+        layer = [m for m in remaining.values()
+                 if not any(t in remaining for t in (m.triggers_on.pipeline_uuids if m.triggers_on else []))]
+        layers.append(layer)
+        for m in layer:
+            del remaining[m.pipeline_uuid]
+    return layers
+
+
+def apply(args: argparse.Namespace) -> int:
+    pipelines = load_pipeline_tree(Path(args.path))
+    client = KalyClient(endpoint=args.endpoint, token=args.token, workers=args.workers)
+    server_hashes = client.get_hashes(prefix=args.prefix)
+    # With a prefix the hashes do not cover the whole server, and pruned pipelines will be gone
+    known = None if args.prefix is not None else set() if args.prune else set(server_hashes)
+    validate_trigger_graph(pipelines, known=known)
+
+    created = [m for uuid, m in sorted(pipelines.items()) if uuid not in server_hashes]
+    updated = [m for uuid, m in sorted(pipelines.items()) if uuid in server_hashes and server_hashes[uuid] != m.content_hash()]
+    deleted = sorted(set(server_hashes) - set(pipelines)) if args.prune else []
+    for m in created:
+        print(f"+ {m.pipeline_uuid}")
+    for m in updated:
+        print(f"~ {m.pipeline_uuid}")
+    for pipeline_uuid in deleted:
+        print(f"- {pipeline_uuid}")
+    print(f"{len(created)} to create, {len(updated)} to update, {len(deleted)} to delete, {len(pipelines) - len(created) - len(updated)} unchanged")
+    if args.dry_run:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for layer in trigger_layers(created + updated):
+            batches = [layer[i:i + args.batch_size] for i in range(0, len(layer), args.batch_size)]
+            # list() surfaces the first failure before the next layer, which may depend on this one, is sent
+            list(executor.map(client.apply, batches))
+        list(executor.map(client.delete, deleted))
+    print("Applied")
+    return 0
+
+
+def create(args: argparse.Namespace) -> int:
+    client = KalyClient(endpoint=args.endpoint, token=args.token, workers=1)
+    for pipeline_model in load_pipeline_tree(Path(args.file)).values():
+        client.create_or_replace(pipeline_model)
+        print(f"Created pipeline_uuid={pipeline_model.pipeline_uuid}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='kaly', description='Command line utility for interacting with the kalytical api facade')
+    parser.add_argument('--endpoint', default=os.environ.get('KALYTICAL_API_ENDPOINT'), help='Defaults to $KALYTICAL_API_ENDPOINT')
+    parser.add_argument('--token', default=os.environ.get('KALYTICAL_API_TOKEN'), help='Defaults to $KALYTICAL_API_TOKEN')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    apply_parser = commands.add_parser('apply', help='Sync a directory of pipeline YAML files to the server, sending only what changed')
+    apply_parser.add_argument('path')
+    apply_parser.add_argument('--dry-run', action='store_true', help='Print the changes without making them')
+    apply_parser.add_argument('--prune', action='store_true', help='Delete pipelines on the server that are not in path')
+    apply_parser.add_argument('--prefix', default=None, help='Only compare against, and prune, server pipelines with this pipeline_uuid prefix')
+    apply_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Requests in flight at once')
+    apply_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Pipelines per apply request')
+    apply_parser.set_defaults(func=apply)
+
+    create_parser = commands.add_parser('create', help='Create or replace the pipelines in one file')
+    create_parser.add_argument('kind', choices=['pipeline'])
+    create_parser.add_argument('file')
+    create_parser.set_defaults(func=create)
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.endpoint is None:
+        print("No API endpoint - pass --endpoint or set KALYTICAL_API_ENDPOINT", file=sys.stderr)
+        return 2
+    try:
+        return args.func(args)
+    except (KalyException, requests.RequestException) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import pytest
+from src.kalytical.kaly.kaly import KalyException, trigger_layers, validate_trigger_graph
+from src.kalytical.models import PipelineModel
+
+
+def pipeline(pipeline_uuid: str, *triggers: str) -> PipelineModel:
+    triggers_on = {'operator': 'all', 'pipeline_uuids': list(triggers)} if triggers else None
+    return PipelineModel(pipeline_uuid=pipeline_uuid, description=pipeline_uuid, engine='K8sPodEngine', engine_args={}, triggers_on=triggers_on)
+
+
+def tree(*pipelines: PipelineModel) -> dict:
+    return {m.pipeline_uuid: m for m in pipelines}
+
+
+def layer_uuids(layers) -> list:
+    return [sorted(m.pipeline_uuid for m in layer) for layer in layers]
+
+
+def test_validate_accepts_a_dag():
+    validate_trigger_graph(tree(pipeline('extract'), pipeline('clean', 'extract'), pipeline('report', 'clean', 'extract')), known=set())
+
+
+def test_validate_reports_a_missing_trigger():
+    with pytest.raises(KalyException, match='triggered by pipeline_uuid=missing which does not exist'):
+        validate_trigger_graph(tree(pipeline('report', 'missing')), known={'elsewhere'})
+
+
+def test_validate_accepts_triggers_known_to_the_server_or_unchecked():
+    validate_trigger_graph(tree(pipeline('report', 'on-server')), known={'on-server'})
+    # With known None, triggers outside the tree are the server's to check
+    validate_trigger_graph(tree(pipeline('report', 'anything')), known=None)
+
+
+def test_validate_reports_a_cycle_along_its_trigger_edges():
+    with pytest.raises(KalyException, match='Trigger cycle a -> c -> b -> a'):
+        validate_trigger_graph(tree(pipeline('a', 'c'), pipeline('b', 'a'), pipeline('c', 'b')), known=set())
+
+
+def test_validate_reports_a_pipeline_triggering_itself():
+    with pytest.raises(KalyException, match='Trigger cycle a -> a'):
+        validate_trigger_graph(tree(pipeline('a', 'a')), known=set())
+
+
+def test_trigger_layers_put_each_pipeline_after_its_changed_triggers():
+    layers = trigger_layers([pipeline('report', 'clean'), pipeline('clean', 'extract'), pipeline('extract'), pipeline('other')])
+    assert layer_uuids(layers) == [['extract', 'other'], ['clean'], ['report']]
+
+
+def test_trigger_layers_ignore_triggers_that_did_not_change():
+    # unchanged is already on the server, so nothing has to wait for it
+    layers = trigger_layers([pipeline('clean', 'unchanged'), pipeline('report', 'clean', 'unchanged')])
+    assert layer_uuids(layers) == [['clean'], ['report']]
+
+
+def test_trigger_layers_of_nothing_is_empty():
+    assert trigger_layers([]) == []
@@ -1,5 +1,7 @@
 from pydantic import BaseModel, validator
 from typing import List, Optional, Dict
+import hashlib
+import json
 import re
 
 
@@ -17,20 +19,25 @@ class TriggersOnModel(BaseModel):
         if v not in ['all', 'any']:
             raise ValueError(
                 'Must be either an "any" or "all" value for operator')
+        return v
 
 
 class PipelineHeaderModel(BaseModel):
     pipeline_uuid: str
     description: str
-    # Indicates if we can have more than 1 of this specific pipeline_uuid running at a given time
     retry_max: int = 0
+    # Indicates if we can have more than 1 of this specific pipeline_uuid running at a given time
     concurrency: bool = False
+    # Upper bound on runs of this pipeline_uuid at once, takes precedence over concurrency when set
+    max_concurrency: Optional[int] = None
     engine: str
     engine_args: dict  # TODO we can put engine specific validation in here
     schedule: Optional[str]
     triggers_on: Optional[TriggersOnModel]
     scheduler_tracking_id: Optional[str]
     tags: Optional[Dict[str, str]] = {}
+    # Stamped by the data provider on every write - callers do not set it
+    version: Optional[int]
 
     @validator('pipeline_uuid')
     def valid_logical_operator(cls, v):
@@ -40,8 +47,32 @@ class PipelineHeaderModel(BaseModel):
             raise ValueError(f"The pipeline_uuid did not match the allowed regex={regex_str}")
         return v
 
+    @validator('max_concurrency')
+    def valid_max_concurrency(cls, v):
+        if v is not None and v < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        return v
+
+    def effective_max_concurrency(self) -> Optional[int]:
+        """None means unbounded"""
+        if self.max_concurrency is not None:
+            return self.max_concurrency
+        return None if self.concurrency else 1
+
     # TODO validation trhat an engine exists, checking subclasses of AbstractEngine causes a circule import
 
 
 class PipelineModel(PipelineHeaderModel):
     pipeline_body: Optional[dict]
+
+    def content_hash(self) -> str:
+        """Digest of the fields a caller sets - the same definition always hashes the same, whatever was stamped on it when stored"""
+        content = self.dict(exclude={'version', 'scheduler_tracking_id'})
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PipelineApplyResultModel(BaseModel):
+    created: List[str] = []
+    updated: List[str] = []
+    unchanged: List[str] = []
+    deleted: List[str] = []
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, validator
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List
 
 
 class JobLifecycleEventBody(BaseModel):
@@ -40,6 +40,10 @@ class RunningPipelineModel(BaseModel):
     engine_status: str = None
     start_time: str = None
     end_time: str = None
+    # Set for one shard of a run that the engine split across several pods
+    shard_index: Optional[int] = None
+    # Set for runs that only the host which started them can see, e.g. local processes
+    owner_host: Optional[str] = None
     # There should be sub model for the particular engine - and validation/normalization done there
 
     def validate_engine_status(cls, v):
@@ -54,12 +58,51 @@ class IncubatingPipelineModel(BaseModel):
     pipeline_uuid: str
     create_time: Any
     created_by_uuid: Optional[str] = None
+    # The triggering exec_uuids a deferred run was queued with, passed on when it is finally submitted
+    source_uuids: Optional[Dict[str, str]] = None
+    # The exec_uuid a deferred run is submitted under once it is woken
+    exec_uuid: Optional[str] = None
     reason: str
     retry_count: int = 0
     triggers: dict = {}
+    # Incremented on every change so writers can make conditional updates
+    version: int = 0
+    # Set while a replica is launching a satisfied dependency run, and cleared again if the launch fails
+    launch_time: Any = None
+
+    def is_satisfied(self) -> bool:
+        return len(self.triggers) > 0 and all(v != 'waiting' for v in self.triggers.values())
 
     def validate_reason(cls, v):
         valid_values = ['concurrency', 'dependencies']
         if v.lower() not in valid_values:
             raise ValueError(f"reason must be in {valid_values}")
         return v
+
+
+class JobQueryModel(BaseModel):
+    # Engines translate these into their own native predicates where they can
+    engine_status: Optional[List[str]] = None
+    pipeline_uuid: Optional[str] = None
+    exec_uuid: Optional[str] = None
+    limit: Optional[int] = None
+    continue_token: Optional[str] = None
+
+
+class JobPageModel(BaseModel):
+    jobs: List[RunningPipelineModel] = []
+    continue_token: Optional[str] = None
+
+
+class EventHistoryPageModel(BaseModel):
+    events: List[dict] = []
+    # Pass back as cursor to fetch the next page, None once there are no more events
+    next_cursor: Optional[str] = None
+
+
+class EventDispatchResultModel(BaseModel):
+    # Position of the event in the submitted batch
+    index: int
+    dispatched: bool
+    submitted: List[RunningPipelineModel] = []
+    error: Optional[str] = None
@@ -1,2 +1,4 @@
-from .pipeline_models import *
-from .runtime_models import *
\ No newline at end of file
+from .config import KalyticalConfig
+from .logs import get_logger
+from .retry import retry
+from .cron import CronSchedule
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+from typing import List, Set
+
+_MACROS = {'@yearly': '0 0 1 1 *', '@annually': '0 0 1 1 *', '@monthly': '0 0 1 * *', '@weekly': '0 0 * * 0',
+           '@daily': '0 0 * * *', '@midnight': '0 0 * * *', '@hourly': '0 * * * *'}
+_MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+_DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+
+class CronSchedule():
+    """A standard five field cron expression (minute hour day-of-month month day-of-week), read the way a Kubernetes
+    CronJob reads it - names, ranges, lists, steps and the @daily style macros. As with cron, when both day fields are
+    restricted a time matches if either of them does"""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = _MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression={expression} must have 5 fields")
+        self._minutes = self._parse_field(fields[0], 0, 59)
+        self._hours = self._parse_field(fields[1], 0, 23)
+        self._days = self._parse_field(fields[2], 1, 31)
+        self._months = self._parse_field(fields[3], 1, 12, names=_MONTH_NAMES, name_offset=1)
+        # 7 is also Sunday
+        self._weekdays = {d % 7 for d in self._parse_field(fields[4], 0, 7, names=_DAY_NAMES)}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int, names: List[str] = None, name_offset: int = 0) -> Set[int]:
+        def value(v: str) -> int:
+            if names is not None and v.lower() in names:
+                return names.index(v.lower()) + name_offset
+            return int(v)
+
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = (value(v) for v in span.split('-', 1))
+            else:
+                start = value(span)
+                # a/n runs from a to the end of the range
+                end = high if step else start
+            if start < low or end > high or start > end:
+                raise ValueError(f"Cron field={field} is outside {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, t: datetime) -> bool:
+        # datetime counts Monday as 0, cron counts Sunday as 0
+        weekday = (t.weekday() + 1) % 7
+        if self._any_day or self._any_weekday:
+            return t.day in self._days and weekday in self._weekdays
+        return t.day in self._days or weekday in self._weekdays
+
+    def next_fire(self, after: datetime) -> datetime:
+        """The first matching minute strictly after after"""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Every pattern repeats within 4 years plus a leap day, so anything longer means there is no match at all
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self._months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self._hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self._minutes:
+                t = t + timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression={self.expression} never fires")
+
+    def fire_times(self, after: datetime, until: datetime) -> List[datetime]:
+        """Every fire time in (after, until]"""
+        times = []
+        t = self.next_fire(after)
+        while t <= until:
+            times.append(t)
+            t = self.next_fire(t)
+        return times
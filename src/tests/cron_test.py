@@ -0,0 +1,51 @@
+import pytest
+from datetime import datetime
+from src.kalytical.utils import CronSchedule
+
+
+def test_next_fire_is_strictly_after_the_given_time():
+    cron = CronSchedule('*/15 * * * *')
+    assert cron.next_fire(datetime(2021, 3, 1, 10, 0)) == datetime(2021, 3, 1, 10, 15)
+    assert cron.next_fire(datetime(2021, 3, 1, 10, 7, 30)) == datetime(2021, 3, 1, 10, 15)
+
+
+def test_next_fire_rolls_over_hours_days_months_and_years():
+    assert CronSchedule('30 2 * * *').next_fire(datetime(2021, 3, 1, 3, 0)) == datetime(2021, 3, 2, 2, 30)
+    assert CronSchedule('0 0 1 * *').next_fire(datetime(2021, 1, 31, 12, 0)) == datetime(2021, 2, 1, 0, 0)
+    assert CronSchedule('@yearly').next_fire(datetime(2021, 6, 1)) == datetime(2022, 1, 1, 0, 0)
+
+
+def test_next_fire_reads_names_ranges_and_lists():
+    cron = CronSchedule('0 9 * * mon-fri')
+    # 2021-03-06 is a Saturday
+    assert cron.next_fire(datetime(2021, 3, 6, 12, 0)) == datetime(2021, 3, 8, 9, 0)
+    assert CronSchedule('0 0 * jan,jul *').next_fire(datetime(2021, 2, 1)) == datetime(2021, 7, 1, 0, 0)
+    # 7 is Sunday as well as 0
+    assert CronSchedule('0 0 * * 7').next_fire(datetime(2021, 3, 1)) == datetime(2021, 3, 7, 0, 0)
+
+
+def test_next_fire_matches_either_day_field_when_both_are_restricted():
+    # The 15th, or any Monday - 2021-03-08 is a Monday
+    assert CronSchedule('0 0 15 * mon').next_fire(datetime(2021, 3, 2)) == datetime(2021, 3, 8, 0, 0)
+
+
+def test_next_fire_finds_a_leap_day():
+    assert CronSchedule('0 0 29 2 *').next_fire(datetime(2021, 3, 1)) == datetime(2024, 2, 29, 0, 0)
+
+
+@pytest.mark.parametrize('expression', ['0 0 31 2 *', '0 0 30 2 *', '0 0 31 4,6,9,11 *'])
+def test_next_fire_raises_for_a_schedule_that_never_fires(expression):
+    with pytest.raises(ValueError, match='never fires'):
+        CronSchedule(expression).next_fire(datetime(2021, 1, 1))
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '0 24 * * *', '0 0 0 * *', '0 0 * 13 *', '5-1 * * * *'])
+def test_invalid_expressions_are_rejected_when_parsed(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_fire_times_covers_after_exclusive_to_until_inclusive():
+    cron = CronSchedule('0 * * * *')
+    assert cron.fire_times(after=datetime(2021, 3, 1, 10, 0), until=datetime(2021, 3, 1, 12, 0)) == [
+        datetime(2021, 3, 1, 11, 0), datetime(2021, 3, 1, 12, 0)]
@@ -0,0 +1,310 @@
+import asyncio
+import copy
+from types import SimpleNamespace
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from src.kalytical.core.data_provider import MongoDBProvider
+from src.kalytical.core.dispatcher import KDispatcher
+from src.kalytical.models import PipelineHeaderModel, RunningPipelineModel, TriggersOnModel
+from src.kalytical.utils import get_logger
+
+
+class FakeIncubationCollection():
+    """Just enough of run_incubation for update_incubating_jobs, including the unique open run per pipeline.
+    With race set, another event opens the run between our filter missing and our insert, as two replicas would"""
+
+    def __init__(self, race: bool = False):
+        self.docs = []
+        self.race = race
+        self.calls = 0
+
+    def find_one_and_update(self, filter_dict, update, upsert=False, return_document=None):
+        self.calls += 1
+        doc = next((d for d in self.docs if all(d.get(k) == v for k, v in filter_dict.items())), None)
+        if doc is None and upsert:
+            if self.race:
+                self.race = False
+                self._insert(filter_dict, {**update, '$set': {'triggers.upstream-b': 'b-exec'}})
+                raise DuplicateKeyError('E11000 duplicate key error collection: pipeline_db.run_incubation index: open_dependency_run')
+            return self._insert(filter_dict, update)
+        self._apply(doc, update)
+        return doc
+
+    def _insert(self, filter_dict, update):
+        doc = {'_id': ObjectId(), **filter_dict}
+        for key, value in update.get('$setOnInsert', {}).items():
+            _set_path(doc, key, value)
+        self._apply(doc, update)
+        self.docs.append(doc)
+        return doc
+
+    @staticmethod
+    def _apply(doc, update):
+        for key, value in update.get('$set', {}).items():
+            _set_path(doc, key, value)
+        for key, value in update.get('$inc', {}).items():
+            doc[key] = doc.get(key, 0) + value
+
+
+def _set_path(doc, path, value):
+    *parents, leaf = path.split('.')
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[leaf] = value
+
+
+def make_provider(coll: FakeIncubationCollection) -> MongoDBProvider:
+    provider = MongoDBProvider.__new__(MongoDBProvider)
+    provider.log = get_logger('data_provider_test')
+    # run_in_executor(None, ...) runs on the loop's default executor
+    provider._executor = None
+    provider._run_incubation_coll = coll
+    return provider
+
+
+def fan_in_header() -> PipelineHeaderModel:
+    return PipelineHeaderModel(pipeline_uuid='downstream', description='fan in', engine='K8sPodEngine', engine_args={},
+                               triggers_on=TriggersOnModel(operator='all', pipeline_uuids=['upstream-a', 'upstream-b']))
+
+
+def update(provider: MongoDBProvider, trigger: str, source_uuid: str):
+    return asyncio.run(provider.update_incubating_jobs(trigger_pipeline_uuid=trigger, header_model=fan_in_header(), source_uuid=source_uuid))
+
+
+def test_first_trigger_opens_a_run_waiting_on_the_rest():
+    coll = FakeIncubationCollection()
+    incubating = update(make_provider(coll), 'upstream-a', 'a-exec')
+    assert incubating.triggers == {'upstream-a': 'a-exec', 'upstream-b': 'waiting'}
+    assert incubating.reason == 'dependencies'
+    assert incubating.version == 1
+    assert not incubating.is_satisfied()
+    assert len(coll.docs) == 1 and coll.docs[0]['open'] is True
+
+
+def test_last_trigger_satisfies_the_open_run():
+    coll = FakeIncubationCollection()
+    provider = make_provider(coll)
+    first = update(provider, 'upstream-a', 'a-exec')
+    second = update(provider, 'upstream-b', 'b-exec')
+    assert second.obj_id == first.obj_id
+    assert second.triggers == {'upstream-a': 'a-exec', 'upstream-b': 'b-exec'}
+    assert second.version == 2
+    assert second.is_satisfied()
+    assert len(coll.docs) == 1
+
+
+def test_repeated_trigger_replaces_its_exec_uuid_instead_of_opening_another_run():
+    coll = FakeIncubationCollection()
+    provider = make_provider(coll)
+    update(provider, 'upstream-a', 'a-exec-1')
+    incubating = update(provider, 'upstream-a', 'a-exec-2')
+    assert incubating.triggers == {'upstream-a': 'a-exec-2', 'upstream-b': 'waiting'}
+    assert len(coll.docs) == 1
+
+
+def test_concurrent_open_retries_as_an_update_of_the_winning_run():
+    coll = FakeIncubationCollection(race=True)
+    incubating = update(make_provider(coll), 'upstream-a', 'a-exec')
+    assert coll.calls == 2
+    assert len(coll.docs) == 1
+    assert incubating.triggers == {'upstream-a': 'a-exec', 'upstream-b': 'b-exec'}
+    assert incubating.is_satisfied()
+
+
+_MISSING = object()
+
+
+def _get_path(doc, path):
+    for part in path.split('.'):
+        if isinstance(doc, list) and part.isdigit():
+            doc = doc[int(part)] if int(part) < len(doc) else _MISSING
+        elif isinstance(doc, dict):
+            doc = doc.get(part, _MISSING)
+        else:
+            return _MISSING
+    return doc
+
+
+def _matches(doc, filter_dict) -> bool:
+    for key, condition in filter_dict.items():
+        if key == '$or':
+            if not any(_matches(doc, f) for f in condition):
+                return False
+            continue
+        value = _get_path(doc, key)
+        if isinstance(condition, dict):
+            for op, arg in condition.items():
+                if op == '$exists' and (value is not _MISSING) != arg:
+                    return False
+                if op == '$lt' and (value is _MISSING or not value < arg):
+                    return False
+                if op == '$gt' and (value is _MISSING or not value > arg):
+                    return False
+                if op == '$in' and value not in arg:
+                    return False
+        elif isinstance(value, list):
+            # Equality on an array field matches any element, as it does in Mongo
+            if condition not in value:
+                return False
+        elif (None if value is _MISSING else value) != condition:
+            return False
+    return True
+
+
+class FakeCollection():
+    """An in-memory collection for the filters and updates of the execution ledger, the slot counters and deferred runs.
+    A document sharing a value of any field in unique with another collides, as on the collection's unique indexes.
+    before_write, when set, runs once ahead of the next update_one - a concurrent writer slipping in between a read and a write"""
+
+    def __init__(self, unique=('_id',)):
+        self.docs = []
+        self.unique = unique
+        self.before_write = None
+
+    def find(self, filter_dict, projection=None):
+        return [copy.deepcopy(d) for d in self.docs if _matches(d, filter_dict)]
+
+    def find_one(self, filter_dict):
+        return next(iter(self.find(filter_dict)), None)
+
+    def count_documents(self, filter_dict):
+        return len(self.find(filter_dict))
+
+    def update_one(self, filter_dict, update, upsert=False):
+        if self.before_write is not None:
+            before_write, self.before_write = self.before_write, None
+            before_write()
+        doc = next((d for d in self.docs if _matches(d, filter_dict)), None)
+        if doc is not None:
+            _apply_update(doc, update)
+            return SimpleNamespace(modified_count=1, upserted_id=None)
+        if not upsert:
+            return SimpleNamespace(modified_count=0, upserted_id=None)
+        doc = {key: value for key, value in filter_dict.items() if not key.startswith('$') and not isinstance(value, dict)}
+        doc.setdefault('_id', ObjectId())
+        for key, value in update.get('$setOnInsert', {}).items():
+            _set_path(doc, key, value)
+        _apply_update(doc, update)
+        if any(field in doc and any(d.get(field) == doc[field] for d in self.docs) for field in self.unique):
+            raise DuplicateKeyError('E11000 duplicate key error')
+        self.docs.append(doc)
+        return SimpleNamespace(modified_count=0, upserted_id=doc['_id'])
+
+    def find_one_and_update(self, filter_dict, update, projection=None, return_document=None):
+        doc = next((d for d in self.docs if _matches(d, filter_dict)), None)
+        if doc is None:
+            return None
+        before = copy.deepcopy(doc)
+        _apply_update(doc, update)
+        return before
+
+    def find_one_and_delete(self, filter_dict, sort=None):
+        found = [d for d in self.docs if _matches(d, filter_dict)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda d: d[key], reverse=direction < 0)
+        if len(found) == 0:
+            return None
+        self.docs.remove(found[0])
+        return found[0]
+
+    def delete_one(self, filter_dict):
+        found = [d for d in self.docs if _matches(d, filter_dict)]
+        if len(found) > 0:
+            self.docs.remove(found[0])
+
+
+def _apply_update(doc, update):
+    for key, value in update.get('$set', {}).items():
+        _set_path(doc, key, value)
+    for key, value in update.get('$inc', {}).items():
+        _set_path(doc, key, (_get_path(doc, key) if _get_path(doc, key) is not _MISSING else 0) + value)
+    for key in update.get('$unset', {}):
+        doc.pop(key, None)
+
+
+class FakeHistoryBuffer():
+    async def append(self, records):
+        pass
+
+
+class FakeEngineManager():
+    async def submit_job(self, header_model: PipelineHeaderModel, exec_uuid: str, source_uuid: str = None, retry_count: int = 0) -> RunningPipelineModel:
+        return RunningPipelineModel(exec_uuid=exec_uuid, pipeline_uuid=header_model.pipeline_uuid, engine=header_model.engine,
+                                    engine_tracking_id=f"{exec_uuid}-pod", engine_status='pending')
+
+
+def make_ledger_provider() -> MongoDBProvider:
+    provider = MongoDBProvider.__new__(MongoDBProvider)
+    provider.log = get_logger('data_provider_test')
+    provider._executor = None
+    provider._executions_coll = FakeCollection(unique=('_id', 'exec_uuid'))
+    provider._concurrency_slots_coll = FakeCollection()
+    provider._run_incubation_coll = FakeCollection()
+    provider._history_buffer = FakeHistoryBuffer()
+    return provider
+
+
+def used_slots(provider: MongoDBProvider) -> dict:
+    return {d['_id']: d['used'] for d in provider._concurrency_slots_coll.docs}
+
+
+def test_acquires_slots_up_to_the_cap_and_gives_back_a_partial_acquire():
+    provider = make_ledger_provider()
+    # global is taken first, so the third run has to give it back when the pipeline cap refuses it
+    limits = {'global': 5, 'pipeline:load': 2}
+
+    async def run():
+        acquired = [await provider.acquire_execution_slots(exec_uuid=f"run-{n}", pipeline_uuid='load', limits=limits) for n in range(3)]
+        assert acquired == [True, True, False]
+        assert not await provider.has_free_slots(limits=limits)
+
+    asyncio.run(run())
+    assert used_slots(provider) == {'global': 2, 'pipeline:load': 2}
+    # The refused run left nothing in the ledger to release later
+    assert [d['exec_uuid'] for d in provider._executions_coll.docs] == ['run-0', 'run-1']
+
+
+def test_runs_past_the_cap_are_deferred_and_a_release_wakes_the_oldest():
+    provider = make_ledger_provider()
+    dispatcher = KDispatcher(data_provider=provider, engine_mgr=FakeEngineManager())
+    header = PipelineHeaderModel(pipeline_uuid='load', description='load', engine='K8sPodEngine', engine_args={}, max_concurrency=1)
+
+    async def head_pipeline_definition(pipeline_uuid: str) -> PipelineHeaderModel:
+        return header
+    lookups = SimpleNamespace(head_pipeline_definition=head_pipeline_definition)
+
+    async def run():
+        first = await dispatcher.queue_pipeline(header_model=header, exec_uuid='run-a')
+        assert isinstance(first, RunningPipelineModel)
+        for exec_uuid in ['run-b', 'run-c']:
+            assert not isinstance(await dispatcher.queue_pipeline(header_model=header, exec_uuid=exec_uuid), RunningPipelineModel)
+        # Nothing to wake while run-a holds the only slot
+        assert await dispatcher.wake_deferred_runs(pipeline_uuid='load', lookups=lookups) == []
+
+        await provider.update_execution(exec_uuid='run-a', pipeline_uuid='load', state='succeeded')
+        woken = await dispatcher.wake_deferred_runs(pipeline_uuid='load', lookups=lookups)
+        assert [r.exec_uuid for r in woken] == ['run-b']
+
+    asyncio.run(run())
+    assert used_slots(provider) == {'pipeline:load': 1}
+    assert [d['exec_uuid'] for d in provider._run_incubation_coll.docs] == ['run-c']
+
+
+def test_repair_does_not_overwrite_an_acquire_that_races_it():
+    provider = make_ledger_provider()
+
+    async def run():
+        await provider.acquire_execution_slots(exec_uuid='run-a', pipeline_uuid='load', limits={'pipeline:load': 5})
+        # Two slots leaked by a crash mid-release
+        provider._concurrency_slots_coll.docs[0]['used'] = 3
+
+        def racing_acquire():
+            # Lands between the repair counting holders and writing the count back
+            provider._executions_coll.docs.append({'_id': ObjectId(), 'exec_uuid': 'run-b', 'state': 'pending', 'slots': ['pipeline:load']})
+            _apply_update(provider._concurrency_slots_coll.docs[0], {'$inc': {'used': 1, 'version': 1}})
+        provider._concurrency_slots_coll.before_write = racing_acquire
+        assert await provider._repair_slot(slot_key='pipeline:load')
+
+    asyncio.run(run())
+    # Not 1 - the first write missed on the version the acquire bumped, and the second counted run-b too
+    assert used_slots(provider) == {'pipeline:load': 2}
@@ -0,0 +1,115 @@
+import asyncio
+from src.kalytical.core.dispatcher import MaxPipelineRetryReachedException
+from src.kalytical.core.mq_poller import MQ_Poller
+from src.kalytical.core.mq_transport import SqsTransport
+from src.kalytical.models import LifecycleEventModel, JobLifecycleEventBody
+
+QUEUE_URL = 'https://sqs.test/events'
+DEAD_LETTER_URL = 'https://sqs.test/events-dead'
+
+
+class FakeSqsClient():
+    """Hands out the queued batches one receive at a time, then long-polls until cancelled. Every call is recorded in calls"""
+
+    def __init__(self, batches: list, calls: list):
+        self.batches = list(batches)
+        self.calls = calls
+        self.receives = []
+        self.fail_visibility_changes = False
+
+    async def receive_message(self, **kwargs):
+        self.receives.append(kwargs)
+        if len(self.batches) == 0:
+            await asyncio.Event().wait()
+        return {'Messages': self.batches.pop(0)}
+
+    async def delete_message_batch(self, QueueUrl: str, Entries: list):
+        self.calls.append(('delete', QueueUrl, sorted(entry['ReceiptHandle'] for entry in Entries)))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    async def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int):
+        if self.fail_visibility_changes:
+            raise ConnectionError('sqs is unreachable')
+        self.calls.append(('visibility', ReceiptHandle, VisibilityTimeout))
+
+    async def send_message(self, QueueUrl: str, MessageBody: str):
+        self.calls.append(('send', QueueUrl, MessageBody))
+
+
+class FakeDispatcher():
+    def __init__(self, calls: list, failures: dict = None):
+        self.calls = calls
+        # exec_uuid -> the exception dispatching it raises
+        self.failures = failures or {}
+
+    async def dispatch(self, lifecycle_event: LifecycleEventModel):
+        self.calls.append(('dispatch', lifecycle_event.event_body.exec_uuid))
+        if lifecycle_event.event_body.exec_uuid in self.failures:
+            raise self.failures[lifecycle_event.event_body.exec_uuid]
+
+
+def sqs_message(exec_uuid: str, receive_count: int = 1, pipeline_uuid: str = 'nightly-load', body: str = None) -> dict:
+    event = LifecycleEventModel(event_type='job_exec_update', event_body=JobLifecycleEventBody(
+        pipeline_uuid=pipeline_uuid, exec_uuid=exec_uuid, event_subtype='success', event_time='2021-03-01T10:00:00'))
+    return {'MessageId': f"id-{exec_uuid}", 'ReceiptHandle': f"handle-{exec_uuid}", 'Body': body or event.json(),
+            'Attributes': {'ApproximateReceiveCount': str(receive_count)}}
+
+
+def run_poller(batches: list, failures: dict = None, settled: int = 1, fail_visibility_changes: bool = False) -> tuple:
+    """Poll until settled calls other than dispatches were made, and return the fake client and every call in order"""
+    calls = []
+
+    async def run():
+        sqs = FakeSqsClient(batches=batches, calls=calls)
+        sqs.fail_visibility_changes = fail_visibility_changes
+        poller = MQ_Poller(transport=SqsTransport(sqs_client=sqs, queue_url=QUEUE_URL, dead_letter_url=DEAD_LETTER_URL),
+                           dispatcher=FakeDispatcher(calls=calls, failures=failures))
+        task = asyncio.create_task(poller.fetch_message_loop())
+        deadline = asyncio.get_running_loop().time() + 2
+        while len([call for call in calls if call[0] != 'dispatch']) < settled:
+            assert asyncio.get_running_loop().time() < deadline, calls
+            await asyncio.sleep(0.01)
+        poller.shutdown()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return sqs
+
+    return asyncio.run(run()), calls
+
+
+def test_receives_a_batch_and_deletes_it_together_once_dispatched():
+    sqs, calls = run_poller([[sqs_message('a1'), sqs_message('b1', pipeline_uuid='other'), sqs_message('c1', pipeline_uuid='third')]])
+    assert sqs.receives[0]['MaxNumberOfMessages'] == 10
+    assert sqs.receives[0]['AttributeNames'] == ['ApproximateReceiveCount']
+    assert sorted(calls[:3]) == [('dispatch', 'a1'), ('dispatch', 'b1'), ('dispatch', 'c1')]
+    assert calls[3:] == [('delete', QUEUE_URL, ['handle-a1', 'handle-b1', 'handle-c1'])]
+
+
+def test_a_failed_dispatch_is_released_with_backoff_and_not_deleted():
+    sqs, calls = run_poller([[sqs_message('a1', receive_count=3)]], failures={'a1': RuntimeError('mongo is down')})
+    # Third delivery, so two failures before it - mq_release_backoff_seconds * 2 ** 2
+    assert calls == [('dispatch', 'a1'), ('visibility', 'handle-a1', 4)]
+
+
+def test_a_message_out_of_deliveries_is_dead_lettered():
+    sqs, calls = run_poller([[sqs_message('a1', receive_count=5)]], failures={'a1': RuntimeError('mongo is down')}, settled=2)
+    assert calls[0] == ('dispatch', 'a1')
+    assert calls[1][:2] == ('send', DEAD_LETTER_URL)
+    assert calls[2] == ('delete', QUEUE_URL, ['handle-a1'])
+
+
+def test_an_undecodable_message_is_dead_lettered_without_dispatch():
+    sqs, calls = run_poller([[sqs_message('a1', body='not json')]], settled=2)
+    assert calls == [('send', DEAD_LETTER_URL, 'not json'), ('delete', QUEUE_URL, ['handle-a1'])]
+
+
+def test_out_of_retries_is_deleted_rather_than_redelivered():
+    sqs, calls = run_poller([[sqs_message('a1')]], failures={'a1': MaxPipelineRetryReachedException('retry_count=3')})
+    assert calls == [('dispatch', 'a1'), ('delete', QUEUE_URL, ['handle-a1'])]
+
+
+def test_a_failed_release_does_not_stop_the_worker():
+    # Both messages are for one pipeline, so they land on the same worker
+    sqs, calls = run_poller([[sqs_message('a1')], [sqs_message('a2')]], failures={'a1': RuntimeError('mongo is down')},
+                            fail_visibility_changes=True)
+    assert calls == [('dispatch', 'a1'), ('dispatch', 'a2'), ('delete', QUEUE_URL, ['handle-a2'])]
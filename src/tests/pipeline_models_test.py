@@ -0,0 +1,32 @@
+from src.kalytical.models import PipelineModel
+
+
+def pipeline(**overrides) -> PipelineModel:
+    fields = {'pipeline_uuid': 'nightly-load', 'description': 'nightly load', 'engine': 'K8sPodEngine', 'schedule': '0 2 * * *',
+              'engine_args': {'pipeline_image': 'load:1.0', 'cpu_count': 2, 'memory_gi': 4}, 'pipeline_body': {'steps': ['extract', 'load']},
+              'tags': {'team': 'data'}}
+    return PipelineModel(**{**fields, **overrides})
+
+
+def test_content_hash_is_stable_for_the_same_definition():
+    assert pipeline().content_hash() == pipeline().content_hash()
+    assert len(pipeline().content_hash()) == 64
+
+
+def test_content_hash_ignores_key_order():
+    reordered = pipeline(engine_args={'memory_gi': 4, 'cpu_count': 2, 'pipeline_image': 'load:1.0'})
+    assert reordered.content_hash() == pipeline().content_hash()
+
+
+def test_content_hash_ignores_fields_stamped_when_stored():
+    stored = pipeline(version=7, scheduler_tracking_id='kalytical-cron-nightly-load')
+    assert stored.content_hash() == pipeline().content_hash()
+
+
+def test_content_hash_changes_with_any_field_a_caller_sets():
+    base = pipeline().content_hash()
+    for overrides in [{'description': 'nightly load v2'}, {'schedule': '0 3 * * *'}, {'retry_max': 1},
+                      {'engine_args': {'pipeline_image': 'load:1.1', 'cpu_count': 2, 'memory_gi': 4}},
+                      {'pipeline_body': {'steps': ['extract']}}, {'tags': {'team': 'ml'}},
+                      {'triggers_on': {'operator': 'all', 'pipeline_uuids': ['upstream']}}]:
+        assert pipeline(**overrides).content_hash() != base, overrides
@@ -0,0 +1,50 @@
+"""Compares building a pod body from scratch on every submit against rendering a compiled PodTemplate.
+Both bodies are passed through sanitize_for_serialization, as create_namespaced_pod does before sending them.
+
+    python -m src.tests.pod_template_bench
+"""
+import json
+import timeit
+from kubernetes import client
+from src.kalytical.core.pod_template import PodTemplate
+from src.kalytical.models import PipelineHeaderModel
+
+HEADER_MODEL = PipelineHeaderModel(pipeline_uuid='bench-pipeline', description='benchmark', engine='K8sPodEngine', version=1,
+                                   engine_args={'cpu_count': 2, 'memory_gi': 8, 'instance_type': 'm5.large', 'pipeline_image': 'bench:latest',
+                                                'pipeline_args': ['--mode', 'shard'], 'pipeline_command': ['python', '-m', 'job']})
+SOURCE_UUIDS = {'upstream-a': 'a1b2c3d4', 'upstream-b': 'e5f6a7b8'}
+API_CLIENT = client.ApiClient()
+
+
+def build_pod_objects(exec_uuid: str, retry_count: int) -> client.V1Pod:
+    engine_args = HEADER_MODEL.engine_args
+    container = client.V1Container(
+        name='pipeline', image=engine_args['pipeline_image'], args=engine_args['pipeline_args'], command=engine_args['pipeline_command'],
+        env=[client.V1EnvVar(name='PIPELINE_UUID', value=HEADER_MODEL.pipeline_uuid),
+             client.V1EnvVar(name='SOURCE_UUID', value=json.dumps(json.dumps(SOURCE_UUIDS))),
+             client.V1EnvVar(name='EXEC_UUID', value=exec_uuid),
+             client.V1EnvVar(name='RETRY_COUNT', value=str(retry_count)),
+             client.V1EnvVar(name='MQ_CALLBACK_URL', value='http://mq'),
+             client.V1EnvVar(name='KALYTICAL_AUTH_SECRET', value='secret'),
+             client.V1EnvVar(name='KALYTICAL_API_ENDPOINT', value='http://api')],
+        resources=client.V1ResourceRequirements(limits={'cpu': '2', 'memory': '8Gi'}))
+    spec = client.V1PodSpec(service_account_name='pipelines', node_selector={'kalytical.k8s.node/workload': 'pipeline', 'beta.kubernetes.io/instance-type': 'm5.large'},
+                            tolerations=[client.V1Toleration(key='node.kubernetes.io/pipeline', operator='Exists', effect='NoSchedule')],
+                            security_context=client.V1PodSecurityContext(fs_group=100), restart_policy='Never', containers=[container])
+    return client.V1Pod(spec=spec, metadata=client.V1ObjectMeta(name=f"{exec_uuid}-{HEADER_MODEL.pipeline_uuid}-{retry_count}",
+                                                                labels={'pod_source': 'kalytical', 'exec_uuid': exec_uuid, 'pipeline_uuid': HEADER_MODEL.pipeline_uuid}))
+
+
+def main(number: int = 20000):
+    template = PodTemplate(header_model=HEADER_MODEL)
+    cases = {
+        'object graph per submit': lambda: API_CLIENT.sanitize_for_serialization(build_pod_objects('a1b2c3d4', 0)),
+        'compiled template': lambda: API_CLIENT.sanitize_for_serialization(template.render(exec_uuid='a1b2c3d4', retry_count=0, source_uuid=SOURCE_UUIDS))
+    }
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=3))
+        print(f"{name:<25} {seconds / number * 1e6:8.2f} us/pod")
+
+
+if __name__ == '__main__':
+    main()
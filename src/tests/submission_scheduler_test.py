@@ -0,0 +1,189 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from kubernetes.client.rest import ApiException
+from src.kalytical.core import submission_scheduler
+from src.kalytical.core.submission_scheduler import SubmissionScheduler, QuotaExceededException, AdmissionTimeoutException
+from src.kalytical.models import PipelineHeaderModel
+
+
+class FakeK8sClient():
+    """Serves one ResourceQuota whose hard and used figures the test changes as it goes"""
+
+    def __init__(self, hard: dict, used: dict):
+        self.quota = SimpleNamespace(status=SimpleNamespace(hard=hard, used=used))
+        self.core_v1 = SimpleNamespace(list_namespaced_resource_quota=self.list_namespaced_resource_quota)
+        # Raised by the next quota read instead of returning it
+        self.quota_error = None
+        self.quota_reads = 0
+
+    def list_namespaced_resource_quota(self, namespace: str):
+        self.quota_reads += 1
+        if self.quota_error is not None:
+            raise self.quota_error
+        return SimpleNamespace(items=[self.quota])
+
+    async def call(self, fn, **kwargs):
+        return fn(**kwargs)
+
+
+def header(pipeline_uuid: str, priority_class: str = 'normal', engine: str = 'K8sPodEngine', **engine_args) -> PipelineHeaderModel:
+    return PipelineHeaderModel(pipeline_uuid=pipeline_uuid, description='test', engine=engine, tags={'priority_class': priority_class},
+                               engine_args={'cpu_count': 1, 'memory_gi': 1, **engine_args})
+
+
+async def wait_until(condition, timeout_seconds: float = 2) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_seconds
+    while not condition():
+        assert loop.time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_admits_higher_priority_classes_first_once_there_is_room():
+    order = []
+
+    async def run():
+        k8s = FakeK8sClient(hard={'requests.cpu': '4'}, used={'requests.cpu': '4'})
+        scheduler = SubmissionScheduler(k8s_client=k8s, namespace='pipelines')
+        scheduler.start()
+
+        async def submit(header_model: PipelineHeaderModel):
+            async def create():
+                order.append(header_model.pipeline_uuid)
+            await scheduler.submit(header_model=header_model, submit=create)
+
+        submits = [asyncio.create_task(submit(header(uuid, priority_class)))
+                   for uuid, priority_class in [('low-run', 'low'), ('normal-run', 'normal'), ('critical-run', 'critical')]]
+        await wait_until(lambda: len(scheduler._queue) == 3)
+        assert order == []
+        k8s.quota.status.used = {'requests.cpu': '0'}
+        scheduler._headroom_expires = 0
+        scheduler._wakeup.set()
+        await asyncio.gather(*submits)
+        scheduler.shutdown()
+
+    asyncio.run(run())
+    assert order == ['critical-run', 'normal-run', 'low-run']
+
+
+def test_admits_only_what_fits_in_the_remaining_quota():
+    order = []
+
+    async def run():
+        k8s = FakeK8sClient(hard={'requests.cpu': '4'}, used={'requests.cpu': '2'})
+        scheduler = SubmissionScheduler(k8s_client=k8s, namespace='pipelines')
+        scheduler.start()
+
+        async def create():
+            order.append('created')
+        submits = [asyncio.create_task(scheduler.submit(header_model=header(f"run-{n}"), submit=create)) for n in range(3)]
+        await wait_until(lambda: len(order) == 2)
+        await asyncio.sleep(0.05)
+        assert len(order) == 2 and len(scheduler._queue) == 1
+        scheduler.shutdown()
+        await asyncio.gather(*submits, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_rejects_demand_above_the_hard_limit_when_queued():
+    created = []
+
+    async def run():
+        scheduler = SubmissionScheduler(k8s_client=FakeK8sClient(hard={'requests.cpu': '4'}, used={}), namespace='pipelines')
+        scheduler.start()
+
+        async def create():
+            created.append(True)
+        with pytest.raises(QuotaExceededException):
+            await scheduler.submit(header_model=header('too-big', cpu_count=8), submit=create)
+        assert len(scheduler._queue) == 0
+        scheduler.shutdown()
+
+    asyncio.run(run())
+    assert created == []
+
+
+def test_fails_a_run_that_waits_past_the_admission_deadline(monkeypatch):
+    monkeypatch.setattr(submission_scheduler.kalytical_config, 'submission_admission_timeout_seconds', 0.05)
+    monkeypatch.setattr(submission_scheduler.kalytical_config, 'submission_quota_refresh_seconds', 0.01)
+
+    async def run():
+        scheduler = SubmissionScheduler(k8s_client=FakeK8sClient(hard={'requests.cpu': '4'}, used={'requests.cpu': '4'}), namespace='pipelines')
+        scheduler.start()
+
+        async def create():
+            pass
+        with pytest.raises(AdmissionTimeoutException):
+            await scheduler.submit(header_model=header('starved'), submit=create)
+        assert scheduler.stats()['expired'] == 1
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_indexed_job_demand_is_per_pod_requests_times_parallelism():
+    demand = SubmissionScheduler._demand(header('sharded', engine='K8sIndexedJobEngine', cpu_count=2, memory_gi=4, completions=10, parallelism=3))
+    assert demand == {'cpu': 6, 'memory': 12 * 2 ** 30}
+    # Parallelism defaults to completions, and never counts more pods than there are shards
+    assert SubmissionScheduler._demand(header('sharded', engine='K8sIndexedJobEngine', completions=5))['cpu'] == 5
+    assert SubmissionScheduler._demand(header('sharded', engine='K8sIndexedJobEngine', completions=2, parallelism=8))['cpu'] == 2
+
+
+def test_admits_without_a_quota_it_is_not_allowed_to_read():
+    created = []
+
+    async def run():
+        k8s = FakeK8sClient(hard={'requests.cpu': '1'}, used={'requests.cpu': '1'})
+        k8s.quota_error = ApiException(status=403)
+        scheduler = SubmissionScheduler(k8s_client=k8s, namespace='pipelines')
+        scheduler.start()
+
+        async def create():
+            created.append(True)
+        await scheduler.submit(header_model=header('unchecked', cpu_count=8), submit=create)
+        assert scheduler.stats()['headroom'] is None
+        scheduler.shutdown()
+
+    asyncio.run(run())
+    assert created == [True]
+
+
+def test_keeps_the_last_known_headroom_and_backs_off_when_a_quota_read_fails():
+    async def run():
+        k8s = FakeK8sClient(hard={'requests.cpu': '4'}, used={'requests.cpu': '1'})
+        scheduler = SubmissionScheduler(k8s_client=k8s, namespace='pipelines')
+        await scheduler._refresh_quota()
+        k8s.quota_error = ApiException(status=500)
+        scheduler._headroom_expires = 0
+        await scheduler._refresh_quota()
+        assert scheduler._headroom == {'cpu': 3}
+        # Not read again until the backoff has passed
+        await scheduler._refresh_quota()
+        assert k8s.quota_reads == 2
+
+    asyncio.run(run())
+
+
+def test_a_retry_that_conflicts_returns_what_the_earlier_attempt_created(monkeypatch):
+    monkeypatch.setattr(submission_scheduler.kalytical_config, 'submission_backoff_max_seconds', 0)
+    attempts = []
+
+    async def run():
+        scheduler = SubmissionScheduler(k8s_client=FakeK8sClient(hard={}, used={}), namespace='pipelines')
+        scheduler.start()
+
+        async def create():
+            attempts.append(True)
+            # The first create timed out at the API server, but the pod was made
+            raise ApiException(status=504 if len(attempts) == 1 else 409)
+
+        async def read_existing():
+            return 'existing-pod'
+        assert await scheduler.submit(header_model=header('flaky'), submit=create, read_existing=read_existing) == 'existing-pod'
+        assert scheduler.stats()['submitted'] == 1
+        scheduler.shutdown()
+
+    asyncio.run(run())
+    assert len(attempts) == 2